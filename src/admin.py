@@ -1,16 +1,50 @@
+import io
+import json
 import discord
 from discord import app_commands
 from discord.ext import commands
 from typing import Optional
-from database import (
-    get_admin_roles, get_admin_users, add_admin_role, remove_admin_role,
+from async_db import (
+    auto_defer, get_admin_roles, get_admin_users, add_admin_role, remove_admin_role,
     add_admin_user, remove_admin_user, get_formatted_settings, save_ui_settings,
-    get_balance, update_balance, get_faction_by_name, hex_to_color,
+    get_balance, update_balance, get_faction_by_name,
     create_faction, get_role_based_factions, get_all_balances,
     get_total_balance, add_role_salary, remove_role_salary,
-    get_all_role_salaries, get_role_salary
+    get_all_role_salaries, get_role_salary, get_guild_stats, set_balance,
+    update_faction_balance, set_faction_leader, rename_faction, set_faction_description,
+    get_admin_acl, verify_ledger, get_top_balances, pay_guild_salaries, get_jobs
 )
-import sqlite3
+from database import db, hex_to_color
+from ledger import describe_account
+from faction_index import faction_name_autocomplete
+from money import Money
+from metrics import metrics, COMMAND, QUERY
+from slow_queries import slow_query_log
+
+
+async def resolve_admin_access(ctx) -> bool:
+    """Есть ли у автора команды доступ к админ-панели.
+
+    Результат вычисляется один раз за вызов и сохраняется в ctx.admin_access,
+    поэтому проверка группы и подкоманды не повторяют работу.
+    """
+    access = getattr(ctx, 'admin_access', None)
+    if access is not None:
+        return access
+
+    if not ctx.guild:
+        access = False
+    elif ctx.author.id == ctx.guild.owner_id:
+        # Владелец сервера всегда имеет доступ
+        access = True
+    else:
+        admin_roles, admin_users = await get_admin_acl(ctx.guild.id)
+        # Доступ по ID пользователя или хотя бы по одной админской роли
+        access = (ctx.author.id in admin_users
+                  or not admin_roles.isdisjoint(role.id for role in getattr(ctx.author, 'roles', ())))
+
+    ctx.admin_access = access
+    return access
 
 
 # Декоратор для проверки прав доступа к админ-панели
@@ -22,24 +56,9 @@ def has_admin_access():
                 await ctx.send("Эта команда доступна только на сервере!", ephemeral=True)
             return False
 
-        # Владелец сервера всегда имеет доступ
-        if ctx.author == ctx.guild.owner:
+        if await resolve_admin_access(ctx):
             return True
 
-        # Проверяем права пользователя (по ID)
-        admin_users = get_admin_users(ctx.guild.id)
-        if ctx.author.id in admin_users:
-            return True
-
-        # Проверяем роли пользователя
-        user_role_ids = [role.id for role in ctx.author.roles]
-        admin_roles = get_admin_roles(ctx.guild.id)
-
-        # Проверяем, есть ли у пользователя хоть одна админская роль
-        for role_id in admin_roles:
-            if role_id in user_role_ids:
-                return True
-
         if hasattr(ctx, 'send'):
             await ctx.send("❌ У вас нет доступа к админ-панели!", ephemeral=True)
         return False
@@ -74,16 +93,14 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
 
     @admin_roles.command(name="добавить_роль", description="Добавить роль с доступом к админ-панели")
     @app_commands.describe(роль="Роль для добавления")
+    @auto_defer(ephemeral=True)
     async def add_admin_role_cmd(ctx, роль: discord.Role):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет прав для управления админ-ролями!", ephemeral=True)
-                    return
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет прав для управления админ-ролями!", ephemeral=True)
+                return
 
-            if add_admin_role(ctx.guild.id, роль.id, ctx.author.id):
+            if await add_admin_role(ctx.guild.id, роль.id, ctx.author.id):
                 embed = discord.Embed(
                     title="✅ Роль добавлена",
                     description=f"Роль {роль.mention} теперь имеет доступ к админ-панели.",
@@ -99,13 +116,14 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
 
     @admin_roles.command(name="удалить_роль", description="Удалить роль из списка админов")
     @app_commands.describe(роль="Роль для удаления")
+    @auto_defer(ephemeral=True)
     async def remove_admin_role_cmd(ctx, роль: discord.Role):
         try:
             if ctx.author != ctx.guild.owner:
                 await ctx.send("❌ Только владелец сервера может удалять админ-роли!", ephemeral=True)
                 return
 
-            remove_admin_role(ctx.guild.id, роль.id)
+            await remove_admin_role(ctx.guild.id, роль.id)
 
             embed = discord.Embed(
                 title="✅ Роль удалена",
@@ -118,9 +136,10 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
             await ctx.send("❌ Произошла ошибка при удалении роли", ephemeral=True)
 
     @admin_roles.command(name="список", description="Показать все роли с доступом к админ-панели")
+    @auto_defer(ephemeral=True)
     async def list_admin_roles_cmd(ctx):
         try:
-            admin_role_ids = get_admin_roles(ctx.guild.id)
+            admin_role_ids = await get_admin_roles(ctx.guild.id)
 
             if not admin_role_ids:
                 embed = discord.Embed(
@@ -153,34 +172,22 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
     # АДМИН ПАНЕЛЬ (основная)
     @bot.hybrid_group(name="админ", description="Админ панель")
     @has_admin_access()
+    @auto_defer(ephemeral=True)
     async def admin(ctx):
         if ctx.invoked_subcommand is None:
             try:
-                settings = get_formatted_settings(ctx.guild.id)
+                settings = await get_formatted_settings(ctx.guild.id)
 
                 # Получаем статистику
-                conn = sqlite3.connect('economy.db')
-                c = conn.cursor()
-
-                c.execute('SELECT COUNT(*) FROM users WHERE guild_id = ?', (ctx.guild.id,))
-                user_count = c.fetchone()[0]
-
-                c.execute('SELECT COUNT(*) FROM factions WHERE guild_id = ?', (ctx.guild.id,))
-                faction_count = c.fetchone()[0]
-
-                c.execute('SELECT SUM(balance) FROM users WHERE guild_id = ?', (ctx.guild.id,))
-                total_balance_result = c.fetchone()
-                total_balance = total_balance_result[0] if total_balance_result[0] is not None else 0
-
-                c.execute('SELECT SUM(balance) FROM factions WHERE guild_id = ?', (ctx.guild.id,))
-                faction_total_balance_result = c.fetchone()
-                faction_total_balance = faction_total_balance_result[0] if faction_total_balance_result[
-                                                                               0] is not None else 0
-
-                conn.close()
+                stats = await get_guild_stats(ctx.guild.id)
+                user_count = stats['user_count']
+                faction_count = stats['faction_count']
+                total_balance = stats['total_balance']
+                faction_total_balance = stats['faction_total_balance']
 
-                admin_roles_count = len(get_admin_roles(ctx.guild.id))
-                admin_users_count = len(get_admin_users(ctx.guild.id))
+                admin_roles, admin_users = await get_admin_acl(ctx.guild.id)
+                admin_roles_count = len(admin_roles)
+                admin_users_count = len(admin_users)
 
                 embed = discord.Embed(
                     title="⚙️ Админ Панель",
@@ -208,7 +215,12 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                                       f"`{PREFIX}админ настройки_интерфейса` - Настройки интерфейса\n"
                                       f"`{PREFIX}админ общий_баланс` - Общий баланс сервера\n"
                                       f"`{PREFIX}админ зарплаты` - Управление зарплатами\n"
-                                      f"'{PREFIX}админ add_balance` - пополняет баланс участнику",
+                                      f"`{PREFIX}админ выплатить_зарплаты` - Выплатить зарплаты по ролям\n"
+                                      f"'{PREFIX}админ add_balance` - пополняет баланс участнику\n"
+                                      f"`{PREFIX}админ сверка_журнала` - Сверка балансов с журналом\n"
+                                      f"`{PREFIX}админ задачи` - Фоновые задачи\n"
+                                      f"`{PREFIX}админ метрики` - Время выполнения команд и запросов\n"
+                                      f"`{PREFIX}админ медленные_запросы` - Журнал медленных запросов",
                                 inline=True)
 
                 embed.set_footer(text=settings['footer'])
@@ -219,27 +231,15 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
 
     @admin.command(name="установить_баланс", description="Установить баланс игрока")
     @app_commands.describe(участник="Участник", сумма="Новый баланс")
+    @auto_defer(ephemeral=True)
     async def admin_set_balance(ctx, участник: discord.Member, сумма: float):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
-                    return
-
-            conn = sqlite3.connect('economy.db')
-            c = conn.cursor()
-
-            c.execute('UPDATE users SET balance = ? WHERE user_id = ? AND guild_id = ?',
-                      (сумма, участник.id, ctx.guild.id))
-
-            if c.rowcount == 0:
-                c.execute('INSERT INTO users (user_id, guild_id, balance) VALUES (?, ?, ?)',
-                          (участник.id, ctx.guild.id, сумма))
+            сумма = Money.from_major(сумма)
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
 
-            conn.commit()
-            conn.close()
+            await set_balance(участник.id, ctx.guild.id, сумма, actor_id=ctx.author.id)
 
             await ctx.send(f"✅ Баланс {участник.mention} установлен на **{сумма:.2f}**{CURRENCY}", ephemeral=True)
         except Exception as e:
@@ -250,32 +250,26 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
     @app_commands.describe(название="Название фракции",
                            действие="Действие: добавить_деньги/убрать_деньги/назначить_лидера/переименовать/изменить_описание",
                            значение="Значение")
+    @app_commands.autocomplete(название=faction_name_autocomplete)
+    @auto_defer(ephemeral=True)
     async def admin_edit_faction(ctx, название: str, действие: str, значение: str):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
-                    return
-
-            conn = sqlite3.connect('economy.db')
-            c = conn.cursor()
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
 
-            faction = get_faction_by_name(ctx.guild.id, название)
+            faction = await get_faction_by_name(ctx.guild.id, название)
 
             if not faction:
                 await ctx.send("❌ Фракция не найдена!", ephemeral=True)
-                conn.close()
                 return
 
             faction_id, guild_id, name, balance, leader_id, color, created_at, description, role_id, is_role_based = faction
 
             if действие == "добавить_деньги":
                 try:
-                    amount = float(значение)
-                    c.execute('UPDATE factions SET balance = balance + ? WHERE faction_id = ?',
-                              (amount, faction_id))
+                    amount = Money.from_major(значение)
+                    await update_faction_balance(faction_id, amount, kind='admin', actor_id=ctx.author.id)
                     embed = discord.Embed(
                         title="✅ Баланс фракции обновлен",
                         description=f"Добавлено {amount:.2f}{CURRENCY} в казну фракции {name}",
@@ -287,14 +281,12 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
 
             elif действие == "убрать_деньги":
                 try:
-                    amount = float(значение)
+                    amount = Money.from_major(значение)
                     if balance < amount:
                         await ctx.send(f"❌ Недостаточно средств в казне! Доступно: {balance:.2f}{CURRENCY}",
                                        ephemeral=True)
-                        conn.close()
                         return
-                    c.execute('UPDATE factions SET balance = balance - ? WHERE faction_id = ?',
-                              (amount, faction_id))
+                    await update_faction_balance(faction_id, -amount, kind='admin', actor_id=ctx.author.id)
                     embed = discord.Embed(
                         title="✅ Баланс фракции обновлен",
                         description=f"Списано {amount:.2f}{CURRENCY} из казны фракции {name}",
@@ -316,21 +308,13 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                     # Для ролевых фракций нельзя назначить лидера
                     if is_role_based:
                         await ctx.send("❌ Для ролевых фракций нельзя назначать лидера!", ephemeral=True)
-                        conn.close()
                         return
 
-                    # Проверяем, что пользователь состоит во фракции
-                    c.execute('SELECT 1 FROM faction_members WHERE faction_id = ? AND user_id = ?',
-                              (faction_id, user_id))
-                    if not c.fetchone():
+                    # Проверяем, что пользователь состоит во фракции, и назначаем его лидером
+                    if not await set_faction_leader(faction_id, user_id):
                         await ctx.send("❌ Этот пользователь не состоит во фракции!", ephemeral=True)
-                        conn.close()
                         return
 
-                    c.execute('UPDATE factions SET leader_id = ? WHERE faction_id = ?',
-                              (user_id, faction_id))
-                    c.execute('UPDATE faction_members SET role = ? WHERE faction_id = ? AND user_id = ?',
-                              ('Лидер', faction_id, user_id))
                     embed = discord.Embed(
                         title="✅ Лидер фракции изменен",
                         description=f"Новый лидер фракции {name} установлен",
@@ -341,7 +325,7 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                     await ctx.send("❌ Неверный ID пользователя!", ephemeral=True)
 
             elif действие == "переименовать":
-                c.execute('UPDATE factions SET name = ? WHERE faction_id = ?', (значение, faction_id))
+                await rename_faction(faction_id, значение)
                 embed = discord.Embed(
                     title="✅ Название фракции изменено",
                     description=f"Новое название: {значение}",
@@ -350,7 +334,7 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 await ctx.send(embed=embed, ephemeral=True)
 
             elif действие == "изменить_описание":
-                c.execute('UPDATE factions SET description = ? WHERE faction_id = ?', (значение[:500], faction_id))
+                await set_faction_description(faction_id, значение[:500])
                 embed = discord.Embed(
                     title="✅ Описание фракции обновлено",
                     description="Описание фракции было изменено",
@@ -361,9 +345,6 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 await ctx.send(
                     "❌ Неизвестное действие! Доступные действия: добавить_деньги, убрать_деньги, назначить_лидера, переименовать, изменить_описание",
                     ephemeral=True)
-
-            conn.commit()
-            conn.close()
         except Exception as e:
             print(f"Ошибка в команде редактировать_фракцию: {e}")
             await ctx.send("❌ Произошла ошибка при редактировании фракции", ephemeral=True)
@@ -371,15 +352,13 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
     @admin.command(name="создать_ролевую_фракцию", description="Создать фракцию, привязанную к роли")
     @app_commands.describe(название="Название фракции", роль="Роль для привязки", описание="Описание фракции",
                            цвет="Цвет в формате HEX (например, FF0000)")
+    @auto_defer(ephemeral=True)
     async def admin_create_faction_role(ctx, название: str, роль: discord.Role,
                                         описание: Optional[str] = None, цвет: Optional[str] = None):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
-                    return
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
 
             # Проверяем валидность HEX цвета
             цвет_hex = цвет or "3498db"
@@ -387,7 +366,7 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 цвет_hex = "3498db"
 
             # Создаем ролевую фракцию
-            faction_id = create_faction(
+            faction_id = await create_faction(
                 guild_id=ctx.guild.id,
                 name=название,
                 leader_id=0,  # Для ролевых фракций лидер не нужен
@@ -396,7 +375,7 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 role_id=роль.id
             )
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
             embed = discord.Embed(
                 title="✅ Ролевая фракция создана",
                 description=f"**Название:** {название}\n**Привязана к роли:** {роль.mention}",
@@ -422,9 +401,10 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
             await ctx.send("❌ Произошла ошибка при создании ролевой фракции", ephemeral=True)
 
     @admin.command(name="список_ролевых_фракций", description="Список всех ролевых фракций")
+    @auto_defer(ephemeral=True)
     async def admin_list_role_factions(ctx):
         try:
-            role_factions = get_role_based_factions(ctx.guild.id)
+            role_factions = await get_role_based_factions(ctx.guild.id)
 
             if not role_factions:
                 embed = discord.Embed(
@@ -435,7 +415,7 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 await ctx.send(embed=embed, ephemeral=True)
                 return
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
             embed = discord.Embed(
                 title="🏛️ Ролевые фракции сервера",
                 color=settings['color']
@@ -462,21 +442,19 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
 
     @admin.command(name="настройки_интерфейса", description="Настройки интерфейса")
     @app_commands.describe(цвет="Цвет embed (HEX, например FF0000)", подвал="Текст в подвале")
+    @auto_defer(ephemeral=True)
     async def admin_ui_settings(ctx, цвет: Optional[str] = None, подвал: Optional[str] = None):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
-                    return
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
 
             # Проверяем валидность цвета HEX
             if цвет and not all(c in "0123456789ABCDEFabcdef" for c in цвет):
                 await ctx.send("❌ Неверный формат цвета HEX!", ephemeral=True)
                 return
 
-            save_ui_settings(ctx.guild.id, цвет, подвал)
+            await save_ui_settings(ctx.guild.id, цвет, подвал)
 
             await ctx.send("✅ Настройки интерфейса обновлены!", ephemeral=True)
         except Exception as e:
@@ -485,21 +463,22 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
 
     @admin.command(name="общий_баланс", description="Общий баланс сервера")
     @app_commands.describe(игнорировать_роль="Роль, которую игнорировать при подсчете")
+    @auto_defer(ephemeral=True)
     async def admin_total_balance(ctx, игнорировать_роль: Optional[discord.Role] = None):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
-                    return
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
 
-            # Получаем все балансы
-            all_balances = get_all_balances(ctx.guild.id)
+            # Участники исключаемой роли берутся один раз из role.members, подсчет — одним запросом
+            ignored_ids = {member.id for member in игнорировать_роль.members} if игнорировать_роль else set()
+            total, user_count, ignored_count = await get_total_balance(
+                ctx.guild.id, ignored_ids, [member.id for member in ctx.guild.members]
+            )
 
-            if not all_balances:
+            if user_count + ignored_count == 0:
                 embed = discord.Embed(
                     title="💰 Общий баланс сервера",
                     description="На сервере еще нет зарегистрированных игроков",
@@ -508,34 +487,12 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 await ctx.send(embed=embed, ephemeral=True)
                 return
 
-            # Фильтруем пользователей по ролям если нужно
-            total = 0
-            user_count = 0
-            ignored_count = 0
-
-            for user_id, balance in all_balances:
-                user = ctx.guild.get_member(user_id)
-                if not user:
-                    continue
-
-                # Проверяем игнорируемую роль
-                if игнорировать_роль and игнорировать_роль in user.roles:
-                    ignored_count += 1
-                    continue
-
-                total += balance
-                user_count += 1
-
-            # Получаем топ-10 самых богатых игроков
-            rich_players = []
-            for user_id, balance in all_balances:
-                user = ctx.guild.get_member(user_id)
-                if user and (not игнорировать_роль or игнорировать_роль not in user.roles):
-                    rich_players.append((user, balance))
-
-            # Сортируем по балансу
-            rich_players.sort(key=lambda x: x[1], reverse=True)
-            top_10 = rich_players[:10]
+            # Топ-10 из рейтинга: только участники сервера без игнорируемой роли
+            top_balances = await get_top_balances(
+                ctx.guild.id, 10,
+                predicate=lambda user_id: user_id not in ignored_ids and ctx.guild.get_member(user_id) is not None
+            )
+            top_10 = [(ctx.guild.get_member(user_id), balance) for user_id, balance in top_balances]
 
             # Создаем embed
             embed = discord.Embed(
@@ -579,6 +536,7 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
 
     # КОМАНДА ПРОВЕРКИ ДОСТУПА
     @bot.hybrid_command(name="проверить_админ", description="Проверить доступ к админ-панели")
+    @auto_defer(ephemeral=True)
     async def check_admin_access(ctx):
         try:
             has_access = False
@@ -588,20 +546,12 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 has_access = True
                 reasons.append("✅ Вы владелец сервера")
 
-            admin_users = get_admin_users(ctx.guild.id)
+            admin_roles, admin_users = await get_admin_acl(ctx.guild.id)
             if ctx.author.id in admin_users:
                 has_access = True
                 reasons.append("✅ Вы в списке пользователей с доступом")
 
-            user_role_ids = [role.id for role in ctx.author.roles]
-            admin_roles_list = get_admin_roles(ctx.guild.id)
-
-            matching_roles = []
-            for role_id in admin_roles_list:
-                if role_id in user_role_ids:
-                    role = ctx.guild.get_role(role_id)
-                    if role:
-                        matching_roles.append(role.name)
+            matching_roles = [role.name for role in ctx.author.roles if role.id in admin_roles]
 
             if matching_roles:
                 has_access = True
@@ -637,23 +587,23 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
     @admin.command(name="add_balance", description="Пополнить баланс игрока")
     @app_commands.rename(участник="участник", сумма="сумма")
     @app_commands.describe(участник="Участник для пополнения", сумма="Сумма пополнения")
+    @auto_defer(ephemeral=True)
     async def admin_balance_add(ctx, участник: discord.Member, сумма: float):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
-                    return
+            сумма = Money.from_major(сумма)
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
 
             if сумма <= 0:
                 await ctx.send("❌ Сумма должна быть положительной!", ephemeral=True)
                 return
 
             # Начисляем сумму получателю
-            update_balance(участник.id, ctx.guild.id, сумма, DEFAULT_BALANCE)
+            await update_balance(участник.id, ctx.guild.id, сумма, DEFAULT_BALANCE,
+                                 kind='admin', actor_id=ctx.author.id)
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
 
             embed = discord.Embed(
                 title="✅ Пополнение выполнено",
@@ -661,7 +611,7 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 color=discord.Color.green()
             )
             embed.add_field(name="Баланс получателя",
-                            value=f"{get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
+                            value=f"{await get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
             embed.set_footer(text=settings['footer'])
 
             await ctx.send(embed=embed)
@@ -673,21 +623,20 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
     @admin.command(name="remove_balance", description="Списать баланс у игрока")
     @app_commands.rename(участник="участник", сумма="сумма")
     @app_commands.describe(участник="Участник для списания", сумма="Сумма списания")
+    @auto_defer(ephemeral=True)
     async def admin_balance_remove(ctx, участник: discord.Member, сумма: float):
         try:
-            if ctx.author != ctx.guild.owner and ctx.author.id not in get_admin_users(ctx.guild.id):
-                user_roles = [r.id for r in ctx.author.roles]
-                admin_roles_list = get_admin_roles(ctx.guild.id)
-                if not any(role_id in admin_roles_list for role_id in user_roles):
-                    await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
-                    return
+            сумма = Money.from_major(сумма)
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
 
             if сумма <= 0:
                 await ctx.send("❌ Сумма должна быть положительной!", ephemeral=True)
                 return
 
             # Получаем текущий баланс перед списанием
-            current_balance = get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE)
+            current_balance = await get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE)
 
             # Проверяем, достаточно ли средств для списания
             if сумма > current_balance:
@@ -697,9 +646,10 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 return
 
             # Вычитаем сумму из баланса получателя (передаем отрицательное значение)
-            update_balance(участник.id, ctx.guild.id, -сумма, DEFAULT_BALANCE)
+            await update_balance(участник.id, ctx.guild.id, -сумма, DEFAULT_BALANCE,
+                                 kind='admin', actor_id=ctx.author.id)
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
 
             embed = discord.Embed(
                 title="✅ Списание выполнено",
@@ -707,11 +657,199 @@ def setup_admin_commands(bot: commands.Bot, config: dict):
                 color=discord.Color.orange()
             )
             embed.add_field(name="Новый баланс получателя",
-                            value=f"{get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
+                            value=f"{await get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
             embed.set_footer(text=settings['footer'])
 
             await ctx.send(embed=embed)
 
         except Exception as e:
             print(f"Ошибка в команде admin_balance_remove: {e}")
-            await ctx.send("❌ Произошла ошибка при выполнении списания", ephemeral=True)
\ No newline at end of file
+            await ctx.send("❌ Произошла ошибка при выполнении списания", ephemeral=True)
+
+    @admin.command(name="сверка_журнала", description="Сверить балансы с журналом операций")
+    @auto_defer(ephemeral=True)
+    async def admin_verify_ledger(ctx):
+        try:
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
+
+            mismatches = await verify_ledger(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
+
+            if not mismatches:
+                embed = discord.Embed(
+                    title="✅ Журнал сходится",
+                    description="Все балансы совпадают с журналом операций",
+                    color=discord.Color.green()
+                )
+            else:
+                lines = [f"{describe_account(account)}: в базе {stored:.2f}{CURRENCY}, по журналу {ledger:.2f}{CURRENCY}"
+                         for account, stored, ledger in mismatches[:15]]
+                if len(mismatches) > 15:
+                    lines.append(f"... и еще {len(mismatches) - 15}")
+                embed = discord.Embed(
+                    title=f"⚠️ Расхождений: {len(mismatches)}",
+                    description="\n".join(lines),
+                    color=discord.Color.red()
+                )
+
+            embed.set_footer(text=settings['footer'])
+            await ctx.send(embed=embed, ephemeral=True)
+        except Exception as e:
+            print(f"Ошибка в команде сверка_журнала: {e}")
+            await ctx.send("❌ Произошла ошибка при сверке журнала", ephemeral=True)
+
+    @admin.command(name="выплатить_зарплаты", description="Выплатить зарплаты всем ролям сервера")
+    @auto_defer(ephemeral=True)
+    async def admin_pay_salaries(ctx):
+        try:
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
+
+            paid_count, total = await pay_guild_salaries(ctx.guild, DEFAULT_BALANCE, paid_by=str(ctx.author.id))
+            settings = await get_formatted_settings(ctx.guild.id)
+
+            if paid_count == 0:
+                embed = discord.Embed(
+                    title="💼 Зарплаты",
+                    description="Нет ролей с зарплатой или участников с такими ролями",
+                    color=settings['color']
+                )
+            else:
+                embed = discord.Embed(
+                    title="✅ Зарплаты выплачены",
+                    description=f"Выплат: **{paid_count}**\nОбщая сумма: **{total:.2f}**{CURRENCY}",
+                    color=discord.Color.green()
+                )
+
+            embed.set_footer(text=settings['footer'])
+            await ctx.send(embed=embed, ephemeral=True)
+        except Exception as e:
+            print(f"Ошибка в команде выплатить_зарплаты: {e}")
+            await ctx.send("❌ Произошла ошибка при выплате зарплат", ephemeral=True)
+
+    @admin.command(name="задачи", description="Состояние фоновых задач")
+    @auto_defer(ephemeral=True)
+    async def admin_jobs(ctx):
+        try:
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
+
+            settings = await get_formatted_settings(ctx.guild.id)
+            embed = discord.Embed(title="⏱️ Фоновые задачи", color=settings['color'])
+
+            for (name, interval, next_run_at, last_run_at, last_duration,
+                 max_duration, total_duration, run_count, failure_count, last_error) in await get_jobs():
+                average = total_duration / run_count if run_count else 0
+                value = (f"Интервал: {interval / 60:.0f} мин\n"
+                         f"Следующий запуск: <t:{int(next_run_at)}:R>\n"
+                         f"Запусков: {run_count}, ошибок: {failure_count}\n"
+                         f"Время: последнее {last_duration or 0:.3f}с, среднее {average:.3f}с, макс. {max_duration:.3f}с")
+                if last_error:
+                    value += f"\nОшибка: {last_error[:200]}"
+                embed.add_field(name=name, value=value, inline=False)
+
+            if not embed.fields:
+                embed.description = "Фоновые задачи еще не запускались"
+
+            embed.set_footer(text=settings['footer'])
+            await ctx.send(embed=embed, ephemeral=True)
+        except Exception as e:
+            print(f"Ошибка в команде задачи: {e}")
+            await ctx.send("❌ Произошла ошибка при получении списка задач", ephemeral=True)
+
+    @admin.command(name="метрики", description="Время выполнения команд и запросов к базе")
+    @app_commands.describe(сбросить="Обнулить замеры (только владелец бота)")
+    @auto_defer(ephemeral=True)
+    async def admin_metrics(ctx, сбросить: bool = False):
+        try:
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
+
+            # Замеры общие для всех серверов процесса, поэтому сбрасывать их может только владелец бота
+            if сбросить:
+                if not await bot.is_owner(ctx.author):
+                    await ctx.send("❌ Сбросить замеры может только владелец бота!", ephemeral=True)
+                    return
+                metrics.reset()
+
+            def format_rows(rows) -> str:
+                lines = [f"`{row.name}` {row.count}× всего {row.total:.2f}с, "
+                         f"p50/p95/p99 {row.p50 * 1000:.1f}/{row.p95 * 1000:.1f}/{row.p99 * 1000:.1f} мс"
+                         + (f", ошибок {row.errors}" if row.errors else "")
+                         for row in rows]
+                text = "\n".join(lines) or "Замеров пока нет"
+                return text if len(text) <= 1024 else text[:1021] + "..."
+
+            settings = await get_formatted_settings(ctx.guild.id)
+            embed = discord.Embed(title="📈 Метрики производительности",
+                                  description=f"Замеры с <t:{int(metrics.started_at)}:R>, по суммарному времени",
+                                  color=settings['color'])
+            embed.add_field(name="Команды", value=format_rows(metrics.summary(COMMAND, 8)), inline=False)
+            embed.add_field(name="Функции базы данных", value=format_rows(metrics.summary(QUERY, 8)), inline=False)
+
+            stats = db.stats()
+            embed.add_field(name="Соединения SQLite",
+                            value=f"Открыто всего: {stats['connections_opened']}, сейчас: {stats['connections_open']}\n"
+                                  f"Транзакций: {stats['transactions']}, откатов: {stats['rollbacks']}\n"
+                                  f"Ожиданий блокировки: {stats['busy_retries']}, неудач: {stats['busy_failures']}",
+                            inline=False)
+
+            embed.set_footer(text=settings['footer'])
+            await ctx.send(embed=embed, ephemeral=True)
+        except Exception as e:
+            print(f"Ошибка в команде метрики: {e}")
+            await ctx.send("❌ Произошла ошибка при получении метрик", ephemeral=True)
+
+    @admin.command(name="медленные_запросы", description="Самые медленные запросы к базе с планами выполнения")
+    @auto_defer(ephemeral=True)
+    async def admin_slow_queries(ctx):
+        try:
+            if not await resolve_admin_access(ctx):
+                await ctx.send("❌ У вас нет доступа к этой команде!", ephemeral=True)
+                return
+
+            settings = await get_formatted_settings(ctx.guild.id)
+            threshold = slow_query_log.threshold
+            embed = discord.Embed(
+                title="🐢 Медленные запросы",
+                description=(f"Порог: {threshold * 1000:.0f} мс, по суммарному времени"
+                             if threshold is not None else "Журнал медленных запросов выключен"),
+                color=settings['color']
+            )
+
+            worst = slow_query_log.worst(50)
+            for stats in worst[:5]:
+                plan = "\n".join(stats.plan) if stats.plan else "—"
+                value = (f"```sql\n{stats.sql[:400]}\n```"
+                         f"{stats.count}× всего {stats.total:.2f}с, макс. {stats.max * 1000:.0f} мс, "
+                         f"параметры {stats.params}\n"
+                         f"План:\n```\n{plan[:300]}\n```")
+                embed.add_field(name=f"{stats.total:.2f}с", value=value[:1024], inline=False)
+
+            if not worst:
+                embed.description += "\nМедленных запросов пока нет"
+                embed.set_footer(text=settings['footer'])
+                await ctx.send(embed=embed, ephemeral=True)
+                return
+
+            # Полная выгрузка: сводка и последние записи
+            dump = {
+                'threshold_ms': threshold * 1000 if threshold is not None else None,
+                'worst': [{'sql': stats.sql, 'count': stats.count, 'total_ms': round(stats.total * 1000, 2),
+                           'max_ms': round(stats.max * 1000, 2), 'params': stats.params, 'plan': stats.plan}
+                          for stats in worst],
+                'recent': [entry.to_dict() for entry in list(slow_query_log.recent)],
+            }
+            file = discord.File(io.BytesIO(json.dumps(dump, ensure_ascii=False, indent=2).encode('utf-8')),
+                                filename="slow_queries.json")
+
+            embed.set_footer(text=settings['footer'])
+            await ctx.send(embed=embed, file=file, ephemeral=True)
+        except Exception as e:
+            print(f"Ошибка в команде медленные_запросы: {e}")
+            await ctx.send("❌ Произошла ошибка при получении журнала медленных запросов", ephemeral=True)
\ No newline at end of file
@@ -0,0 +1,326 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import discord
+
+import database
+from money import Money
+
+# Чтение выполняется на небольшом пуле потоков, запись — в одном выделенном потоке,
+# чтобы запросы к SQLite не блокировали цикл событий discord.py
+_read_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='db-read')
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+
+
+def _run_in(executor: ThreadPoolExecutor, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    return wrapper
+
+
+def _reader(func):
+    return _run_in(_read_executor, func)
+
+
+def _writer(func):
+    return _run_in(_write_executor, func)
+
+
+class GroupCommitQueue:
+    """Групповая фиксация изменений балансов.
+
+    Одна фоновая задача забирает операции из очереди и фиксирует их пачками:
+    до max_batch операций или раз в max_delay_ms миллисекунд, что наступит раньше.
+    Вызывающий получает результат после фиксации транзакции со своей операцией;
+    соединения работают с synchronous=FULL, поэтому фиксация означает запись на диск.
+    """
+
+    def __init__(self, max_batch: int = 64, max_delay_ms: float = 5.0):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.batches = 0
+        self.operations = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, func, *args, **kwargs):
+        """Поставить операцию в очередь и дождаться фиксации"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((functools.partial(func, *args, **kwargs), future))
+        return await future
+
+    async def _collect(self) -> Tuple[List[Tuple[Callable, asyncio.Future]], bool]:
+        """Собрать пачку операций. Второй элемент — получен сигнал остановки"""
+        batch = []
+        loop = asyncio.get_running_loop()
+        item = await self._queue.get()
+        deadline = loop.time() + self.max_delay
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.max_batch:
+                return batch, False
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    return batch, False
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    return batch, False
+            else:
+                item = self._queue.get_nowait()
+        return batch, True
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            batch, stop = await self._collect()
+            if not batch:
+                continue
+            operations = [operation for operation, _ in batch]
+            try:
+                results = await loop.run_in_executor(_write_executor, database.db.run_batch, operations)
+            except Exception as e:
+                print(f"Ошибка групповой фиксации: {e}")
+                results = [(False, e)] * len(batch)
+
+            self.batches += 1
+            self.operations += len(batch)
+            for (_, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    async def flush(self):
+        """Зафиксировать все поставленные операции и остановить задачу"""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'average_batch': self.operations / self.batches if self.batches else 0,
+        }
+
+
+group_commit = GroupCommitQueue()
+
+
+def _batched(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await group_commit.submit(func, *args, **kwargs)
+
+    return wrapper
+
+
+def shutdown():
+    """Дождаться завершения запросов и остановить потоки"""
+    _read_executor.shutdown(wait=True)
+    _write_executor.shutdown(wait=True)
+
+
+# Асинхронные аналоги функций database.py
+init_db = _writer(database.init_db)
+
+get_admin_roles = _reader(database.get_admin_roles)
+get_admin_users = _reader(database.get_admin_users)
+add_admin_role = _writer(database.add_admin_role)
+remove_admin_role = _writer(database.remove_admin_role)
+add_admin_user = _writer(database.add_admin_user)
+remove_admin_user = _writer(database.remove_admin_user)
+_load_admin_acl = _reader(database.get_admin_acl)
+
+
+async def get_admin_acl(guild_id: int):
+    """Админ-роли и админ-пользователи из кэша; к базе обращается только при промахе"""
+    acl = database.get_cached_admin_acl(guild_id)
+    if acl is not None:
+        return acl
+    return await _load_admin_acl(guild_id)
+
+
+get_ui_settings = _reader(database.get_ui_settings)
+save_ui_settings = _writer(database.save_ui_settings)
+preload_ui_settings = _reader(database.preload_ui_settings)
+_load_formatted_settings = _reader(database.get_formatted_settings)
+
+
+async def get_formatted_settings(guild_id: int):
+    """Настройки интерфейса из кэша; к базе обращается только при промахе"""
+    settings = database.get_cached_settings(guild_id)
+    if settings is not None:
+        return settings
+    return await _load_formatted_settings(guild_id)
+
+
+_get_stored_balance = _reader(database.get_stored_balance)
+ensure_user = _writer(database.ensure_user)
+
+
+async def get_balance(user_id: int, guild_id: int, default_balance: float = 1000.0) -> Money:
+    """Баланс игрока: чтение на пуле, создание записи при первом обращении — в потоке записи"""
+    balance = await _get_stored_balance(user_id, guild_id)
+    if balance is not None:
+        return balance
+    return await ensure_user(user_id, guild_id, default_balance)
+
+
+update_balance = _batched(database.update_balance)
+set_balance = _writer(database.set_balance)
+transfer = _writer(database.transfer)
+get_all_balances = _reader(database.get_all_balances)
+get_balances = _reader(database.get_balances)
+preload_leaderboard = _reader(database.preload_leaderboard)
+_load_top_balances = _reader(database.get_top_balances)
+_load_balance_rank = _reader(database.get_balance_rank)
+
+
+async def get_top_balances(guild_id: int, limit: int = 10, offset: int = 0, predicate=None):
+    """Рейтинг из памяти; до его построения — запросом к базе"""
+    if database.leaderboard.loaded:
+        return database.get_top_balances(guild_id, limit, offset, predicate)
+    return await _load_top_balances(guild_id, limit, offset, predicate)
+
+
+async def get_balance_rank(guild_id: int, user_id: int):
+    """Место игрока из памяти; до построения рейтинга — запросом к базе"""
+    if database.leaderboard.loaded:
+        return database.get_balance_rank(guild_id, user_id)
+    return await _load_balance_rank(guild_id, user_id)
+
+
+get_total_balance = _reader(database.get_total_balance)
+get_guild_stats = _reader(database.get_guild_stats)
+recount_guild_stats = _writer(database.recount_guild_stats)
+
+get_faction_balance = _reader(database.get_faction_balance)
+update_faction_balance = _batched(database.update_faction_balance)
+get_user_faction = _reader(database.get_user_faction)
+get_faction_by_name = _reader(database.get_faction_by_name)
+search_factions = _reader(database.search_factions)
+get_faction_member_count = _reader(database.get_faction_member_count)
+get_faction_top_members = _reader(database.get_faction_top_members)
+create_faction = _writer(database.create_faction)
+join_faction = _writer(database.join_faction)
+leave_faction = _writer(database.leave_faction)
+set_faction_leader = _writer(database.set_faction_leader)
+rename_faction = _writer(database.rename_faction)
+set_faction_description = _writer(database.set_faction_description)
+get_faction_members = _reader(database.get_faction_members)
+get_all_factions = _reader(database.get_all_factions)
+get_faction_members_page = _reader(database.get_faction_members_page)
+get_factions_page = _reader(database.get_factions_page)
+get_role_based_factions = _reader(database.get_role_based_factions)
+
+add_role_salary = _writer(database.add_role_salary)
+remove_role_salary = _writer(database.remove_role_salary)
+get_role_salary = _reader(database.get_role_salary)
+get_all_role_salaries = _reader(database.get_all_role_salaries)
+record_salary_payment = _batched(database.record_salary_payment)
+get_salary_history = _reader(database.get_salary_history)
+pay_role_salaries = _writer(database.pay_role_salaries)
+
+
+async def pay_guild_salaries(guild: discord.Guild, default_balance: float,
+                             paid_by: str = "system") -> Tuple[int, Money]:
+    """Выплатить зарплаты всех ролей сервера одной транзакцией. Возвращает (выплат, сумма)"""
+    payouts = []
+    for role_id, amount, *_ in await get_all_role_salaries(guild.id):
+        role = guild.get_role(role_id)
+        if role is None:
+            continue
+        payouts.append((role_id, amount, [member.id for member in role.members if not member.bot]))
+    return await pay_role_salaries(guild.id, payouts, default_balance, paid_by)
+
+
+async def pay_all_salaries(guilds: List[discord.Guild], default_balance: float) -> Dict[int, Tuple[int, Money]]:
+    """Выплатить зарплаты на всех серверах по очереди.
+
+    Запись идет в одном потоке, поэтому параллельный запуск серверов ничего не ускорил бы;
+    ошибка на одном сервере не останавливает выплаты на остальных.
+    """
+    results = {}
+    for guild in guilds:
+        try:
+            results[guild.id] = await pay_guild_salaries(guild, default_balance)
+        except Exception as e:
+            print(f"Ошибка при выплате зарплат на сервере {guild.id}: {e}")
+            results[guild.id] = (0, Money())
+    return results
+
+
+
+get_meta = _reader(database.get_meta)
+set_meta = _writer(database.set_meta)
+
+register_job = _writer(database.register_job)
+record_job_run = _writer(database.record_job_run)
+get_jobs = _reader(database.get_jobs)
+
+get_account_history = _reader(database.get_account_history)
+take_balance_snapshot = _writer(database.take_balance_snapshot)
+take_all_balance_snapshots = _writer(database.take_all_balance_snapshots)
+rebuild_account_balance = _reader(database.rebuild_account_balance)
+verify_ledger = _reader(database.verify_ledger)
+
+
+# Автоматическое откладывание ответа
+def auto_defer(delay: float = 2.0, ephemeral: bool = False):
+    """Откладывает ответ на слэш-команду, если обработчик не ответил за delay секунд.
+
+    Discord ждет первый ответ на взаимодействие не дольше 3 секунд.
+    После откладывания видимость первого ответа задает ephemeral, а не параметр send:
+    команды со скрытыми ответами должны откладывать ответ скрыто.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(ctx, *args, **kwargs):
+            interaction = ctx.interaction
+            if interaction is None:
+                return await func(ctx, *args, **kwargs)
+
+            # Отправка и откладывание не должны пересекаться, иначе ответ уйдет дважды
+            lock = asyncio.Lock()
+            original_send = ctx.send
+
+            async def send(*send_args, **send_kwargs):
+                async with lock:
+                    return await original_send(*send_args, **send_kwargs)
+
+            ctx.send = send
+
+            task = asyncio.create_task(func(ctx, *args, **kwargs))
+            done, _ = await asyncio.wait({task}, timeout=delay)
+            if not done:
+                async with lock:
+                    if not interaction.response.is_done():
+                        try:
+                            await ctx.defer(ephemeral=ephemeral)
+                        except discord.HTTPException:
+                            pass
+            return await task
+
+        return wrapper
+
+    return decorator
@@ -2,18 +2,23 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 from typing import Optional
-from database import (
-    get_balance, update_balance, get_user_faction, get_faction_balance,
-    update_faction_balance, create_pending_transfer, get_pending_transfer,
-    delete_pending_transfer, get_formatted_settings, hex_to_color,
+from async_db import (
+    auto_defer, get_balance, update_balance, get_user_faction, get_faction_balance,
+    update_faction_balance, get_formatted_settings,
     get_faction_by_name,
     get_admin_roles, get_admin_users, add_admin_role, remove_admin_role,
     add_admin_user, remove_admin_user, get_formatted_settings, save_ui_settings,
-    get_balance, update_balance, get_faction_by_name, hex_to_color,
+    get_balance, update_balance, get_faction_by_name,
     create_faction, get_role_based_factions, get_all_balances,
     get_total_balance, add_role_salary, remove_role_salary,
-    get_all_role_salaries, get_role_salary
+    get_all_role_salaries, get_role_salary, transfer, get_account_history,
+    get_top_balances, get_balance_rank
 )
+from database import TransferNotFound, InsufficientFunds
+from ledger import KIND_LABELS, user_account, describe_account
+from money import Money
+from pending_transfers import pending_transfers
+from paginator import Paginator, send_paginated
 from datetime import datetime
 
 
@@ -26,15 +31,16 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
 
     @bot.hybrid_command(name="баланс", description="Показать баланс")
     @app_commands.describe(участник="Участник для проверки баланса")
+    @auto_defer()
     async def balance_command(ctx, участник: Optional[discord.Member] = None):
         try:
             target = участник or ctx.author
-            balance_amount = get_balance(target.id, ctx.guild.id, DEFAULT_BALANCE)
+            balance_amount = await get_balance(target.id, ctx.guild.id, DEFAULT_BALANCE)
 
             # Получаем информацию о фракции, если есть
-            faction_info = get_user_faction(target.id, ctx.guild.id)
+            faction_info = await get_user_faction(target.id, ctx.guild.id)
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
             embed = discord.Embed(
                 title=f"💰 Баланс {target.display_name}",
                 description=f"**Личный баланс:** {balance_amount:.2f}{CURRENCY}",
@@ -57,8 +63,10 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
 
     @bot.hybrid_command(name="перевод", description="Перевести деньги другому игроку")
     @app_commands.describe(участник="Участник для перевода", сумма="Сумма перевода")
+    @auto_defer()
     async def pay_command(ctx, участник: discord.Member, сумма: float):
         try:
+            сумма = Money.from_major(сумма)
             if сумма <= 0:
                 await ctx.send("❌ Сумма должна быть положительной!", ephemeral=True)
                 return
@@ -67,14 +75,14 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
                 await ctx.send("❌ Нельзя переводить самому себе!", ephemeral=True)
                 return
 
-            sender_balance = get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE)
+            sender_balance = await get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE)
 
             if sender_balance < сумма:
                 await ctx.send(f"❌ Недостаточно средств! Ваш баланс: {sender_balance:.2f}{CURRENCY}", ephemeral=True)
                 return
 
             # Создаем ожидающий перевод
-            transfer_id = create_pending_transfer(
+            pending = pending_transfers.create(
                 guild_id=ctx.guild.id,
                 from_user_id=ctx.author.id,
                 to_user_id=участник.id,
@@ -83,12 +91,13 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
                 transfer_type='player_to_player'
             )
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
 
             class TransferConfirmView(discord.ui.View):
-                def __init__(self, timeout=300):
-                    super().__init__(timeout=timeout)
-                    self.transfer_id = transfer_id
+                def __init__(self):
+                    # Срок подтверждения отслеживает хранилище ожидающих переводов, а не таймер view
+                    super().__init__(timeout=None)
+                    self.transfer_id = pending.transfer_id
 
                 @discord.ui.button(label="✅ Подтвердить перевод", style=discord.ButtonStyle.success, emoji="✅")
                 async def confirm_button(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -97,27 +106,33 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
                                                                 ephemeral=True)
                         return
 
-                    # Получаем информацию о переводе
-                    transfer = get_pending_transfer(self.transfer_id)
-                    if not transfer:
+                    try:
+                        # Забираем ожидающий перевод (повторное нажатие получит TransferNotFound)
+                        pending_transfers.take(self.transfer_id)
+
+                        # Выполняем перевод одной транзакцией
+                        sender_new_balance, receiver_new_balance = await transfer(
+                            guild_id=ctx.guild.id,
+                            from_user_id=ctx.author.id,
+                            amount=сумма,
+                            to_user_id=участник.id,
+                            default_balance=DEFAULT_BALANCE
+                        )
+                    except TransferNotFound:
                         await interaction.response.send_message("❌ Перевод не найден или истекло время подтверждения!",
                                                                 ephemeral=True)
                         return
-
-                    # Проверяем баланс снова
-                    current_balance = get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE)
-                    if current_balance < сумма:
+                    except InsufficientFunds as e:
                         await interaction.response.send_message(
-                            f"❌ Недостаточно средств! Текущий баланс: {current_balance:.2f}{CURRENCY}", ephemeral=True)
-                        delete_pending_transfer(self.transfer_id)
+                            f"❌ Недостаточно средств! Текущий баланс: {e.balance:.2f}{CURRENCY}", ephemeral=True)
+                        return
+                    except Exception as e:
+                        print(f"Ошибка при выполнении перевода: {e}")
+                        await interaction.response.send_message("❌ Произошла ошибка при выполнении перевода",
+                                                                ephemeral=True)
                         return
 
                     try:
-                        # Выполняем перевод
-                        update_balance(ctx.author.id, ctx.guild.id, -сумма, DEFAULT_BALANCE)
-                        update_balance(участник.id, ctx.guild.id, сумма, DEFAULT_BALANCE)
-                        delete_pending_transfer(self.transfer_id)
-
                         # Обновляем сообщение
                         embed = discord.Embed(
                             title="✅ Перевод выполнен",
@@ -125,15 +140,16 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
                             color=discord.Color.green()
                         )
                         embed.add_field(name="Новый баланс отправителя",
-                                        value=f"{get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
+                                        value=f"{sender_new_balance:.2f}{CURRENCY}")
                         embed.add_field(name="Новый баланс получателя",
-                                        value=f"{get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
+                                        value=f"{receiver_new_balance:.2f}{CURRENCY}")
                         embed.set_footer(text=settings['footer'])
 
                         for child in self.children:
                             child.disabled = True
 
                         await interaction.response.edit_message(embed=embed, view=self)
+                        self.stop()
 
                         # Отправляем уведомление получателю
                         try:
@@ -143,7 +159,7 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
                                 color=discord.Color.green()
                             )
                             notify_embed.add_field(name="Ваш новый баланс",
-                                                   value=f"{get_balance(участник.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
+                                                   value=f"{receiver_new_balance:.2f}{CURRENCY}")
                             await участник.send(embed=notify_embed)
                         except:
                             pass
@@ -159,7 +175,8 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
                                                                 ephemeral=True)
                         return
 
-                    delete_pending_transfer(self.transfer_id)
+                    pending_transfers.cancel(self.transfer_id)
+                    self.stop()
 
                     embed = discord.Embed(
                         title="❌ Перевод отменен",
@@ -172,9 +189,9 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
 
                     await interaction.response.edit_message(embed=embed, view=self)
 
-                async def on_timeout(self):
+                async def expire(self):
+                    self.stop()
                     try:
-                        delete_pending_transfer(self.transfer_id)
                         embed = discord.Embed(
                             title="⏰ Время истекло",
                             description=f"Подтверждение перевода на сумму {сумма:.2f}{CURRENCY} отменено из-за неактивности.",
@@ -198,8 +215,80 @@ def setup_balance_commands(bot: commands.Bot, config: dict):
             embed.set_footer(text="У вас есть 5 минут на подтверждение")
 
             view = TransferConfirmView()
+            pending.on_expire = view.expire
             message = await ctx.send(embed=embed, view=view)
             view.message = message
         except Exception as e:
             print(f"Ошибка в команде перевод: {e}")
             await ctx.send("❌ Произошла ошибка при создании перевода", ephemeral=True)
+
+    @bot.hybrid_command(name="история", description="История операций по балансу")
+    @app_commands.describe(участник="Участник (по умолчанию — вы)")
+    @auto_defer()
+    async def history_command(ctx, участник: Optional[discord.Member] = None):
+        try:
+            target = участник or ctx.author
+            account = user_account(target.id)
+            per_page = 10
+            settings = await get_formatted_settings(ctx.guild.id)
+
+            # Страницы читаются по ключу: before_id — id последней строки предыдущей страницы
+            async def fetch_history(before_id: Optional[int], limit: int):
+                return await get_account_history(ctx.guild.id, account, before_id, limit)
+
+            def render_history(rows, page: int) -> discord.Embed:
+                embed = discord.Embed(title=f"📜 История операций {target.display_name}", color=settings['color'])
+                if not rows:
+                    embed.description = "Операций пока нет"
+                else:
+                    lines = []
+                    for _, amount, kind, memo, actor_id, created_at, counterparty in rows:
+                        try:
+                            when = datetime.fromisoformat(created_at).strftime('%d.%m.%Y %H:%M')
+                        except ValueError:
+                            when = "Неизвестно"
+                        direction = "от" if amount > 0 else "→"
+                        lines.append(f"`{when}` **{amount:+.2f}**{CURRENCY} — {KIND_LABELS.get(kind, kind)}, "
+                                     f"{direction} {describe_account(counterparty)}")
+                    embed.description = "\n".join(lines)
+                embed.set_footer(text=f"Страница {page} | {settings['footer']}")
+                return embed
+
+            await send_paginated(ctx, Paginator(fetch_history, lambda row: row[0], render_history, per_page),
+                                 prev_label="⬅️ Новее", next_label="Старее ➡️")
+        except Exception as e:
+            print(f"Ошибка в команде история: {e}")
+            await ctx.send("❌ Произошла ошибка при получении истории", ephemeral=True)
+
+    @bot.hybrid_command(name="топ", description="Самые богатые игроки сервера")
+    @app_commands.describe(страница="Номер страницы рейтинга")
+    @auto_defer()
+    async def top_command(ctx, страница: Optional[int] = 1):
+        try:
+            per_page = 10
+            page = max(страница or 1, 1)
+
+            top_balances = await get_top_balances(ctx.guild.id, per_page, (page - 1) * per_page)
+            rank, total = await get_balance_rank(ctx.guild.id, ctx.author.id)
+            settings = await get_formatted_settings(ctx.guild.id)
+
+            embed = discord.Embed(title="🏆 Самые богатые игроки", color=settings['color'])
+            if not top_balances:
+                embed.description = "На этой странице рейтинга никого нет"
+            else:
+                lines = []
+                for place, (user_id, balance) in enumerate(top_balances, (page - 1) * per_page + 1):
+                    member = ctx.guild.get_member(user_id)
+                    name = member.display_name if member else f"<@{user_id}>"
+                    lines.append(f"**{place}.** {name}: {balance:.2f}{CURRENCY}")
+                embed.description = "\n".join(lines)
+
+            embed.add_field(name="Ваше место",
+                            value=f"{rank} из {total}" if rank else "Вы еще не в рейтинге",
+                            inline=False)
+            embed.set_footer(text=f"Страница {page} | {settings['footer']}")
+
+            await ctx.send(embed=embed)
+        except Exception as e:
+            print(f"Ошибка в команде топ: {e}")
+            await ctx.send("❌ Произошла ошибка при получении рейтинга", ephemeral=True)
@@ -0,0 +1,209 @@
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from slow_queries import SlowQueryLog, TimedConnection
+
+
+class ConnectionManager:
+    """Долгоживущие соединения SQLite: по одному на поток, WAL, повтор при блокировке"""
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000, cache_size_kb: int = 16384,
+                 mmap_size: int = 64 * 1024 * 1024, retries: int = 5, retry_delay: float = 0.05,
+                 slow_log: Optional[SlowQueryLog] = None):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # Журнал медленных запросов: с ним соединения создают замеряющие курсоры
+        self.slow_log = slow_log
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Фиксации и их обработчики выполняются по очереди, в порядке транзакций
+        self._commit_lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._counters: Dict[str, float] = {
+            'connections_opened': 0,
+            'transactions': 0,
+            'rollbacks': 0,
+            'busy_retries': 0,
+            'busy_failures': 0,
+            'busy_wait_seconds': 0.0,
+            'batched_operations': 0,
+        }
+
+    def _count(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _open(self) -> sqlite3.Connection:
+        factory = TimedConnection if self.slow_log is not None else sqlite3.Connection
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000,
+                               isolation_level=None, check_same_thread=False, factory=factory)
+        if self.slow_log is not None:
+            conn.slow_log = self.slow_log
+        self._retry(lambda: conn.execute('PRAGMA journal_mode=WAL'))
+        # FULL: фиксация в WAL доходит до диска (fsync) до того, как вызывающий получит результат.
+        # С NORMAL подтвержденное изменение баланса может пропасть при отключении питания;
+        # групповая фиксация делает один fsync на пачку операций, поэтому FULL обходится дешево
+        conn.execute('PRAGMA synchronous=FULL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+
+        with self._lock:
+            self._connections.append(conn)
+            self._counters['connections_opened'] += 1
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (открывается один раз)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    def _retry(self, func: Callable):
+        """Повтор операции при 'database is locked' с экспоненциальной задержкой"""
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except sqlite3.OperationalError as e:
+                message = str(e).lower()
+                if 'locked' not in message and 'busy' not in message:
+                    raise
+                if attempt == self.retries:
+                    self._count('busy_failures')
+                    raise
+                delay = self.retry_delay * (2 ** attempt) * (1 + random.random())
+                self._count('busy_retries')
+                self._count('busy_wait_seconds', delay)
+                time.sleep(delay)
+
+    @contextmanager
+    def cursor(self):
+        """Курсор для чтения (автокоммит, без явной транзакции)"""
+        c = self.connection().cursor()
+        try:
+            yield c
+        finally:
+            c.close()
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция записи (BEGIN IMMEDIATE). Вложенные вызовы присоединяются к внешней"""
+        conn = self.connection()
+        if conn.in_transaction:
+            c = conn.cursor()
+            try:
+                yield c
+            finally:
+                c.close()
+            return
+
+        self._retry(lambda: conn.execute('BEGIN IMMEDIATE'))
+        self._count('transactions')
+        self._local.on_commit = []
+        c = conn.cursor()
+        try:
+            yield c
+        except BaseException:
+            conn.rollback()
+            self._local.on_commit = []
+            self._count('rollbacks')
+            raise
+        else:
+            with self._commit_lock:
+                conn.commit()
+                callbacks, self._local.on_commit = self._local.on_commit, []
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        print(f"Ошибка в обработчике фиксации: {e}")
+        finally:
+            c.close()
+
+    def on_commit(self, callback: Callable):
+        """Выполнить callback после фиксации текущей транзакции; при откате он отбрасывается"""
+        if not self.connection().in_transaction:
+            callback()
+            return
+        self._local.on_commit.append(callback)
+
+    @contextmanager
+    def commits_paused(self):
+        """Задержать фиксации и их обработчики на время блока.
+
+        Кэш, построенный из прочитанного внутри блока, не пропустит обновления из on_commit:
+        фиксации до блока уже обработаны, а после — дойдут до нового кэша.
+        """
+        with self._commit_lock:
+            yield
+
+    @contextmanager
+    def read_transaction(self):
+        """Согласованное чтение несколькими запросами (BEGIN DEFERRED, без блокировки записи)"""
+        conn = self.connection()
+        if conn.in_transaction:
+            with self.cursor() as c:
+                yield c
+            return
+
+        conn.execute('BEGIN')
+        c = conn.cursor()
+        try:
+            yield c
+        finally:
+            c.close()
+            conn.rollback()
+
+    def run_batch(self, operations: List[Callable]) -> List[Tuple[bool, object]]:
+        """Выполнить операции записи одной транзакцией (групповая фиксация).
+
+        Каждая операция идет в своей точке сохранения: ошибка откатывает только ее.
+        Возвращает (успех, результат или исключение) для каждой операции.
+        """
+        results: List[Tuple[bool, object]] = []
+        with self.transaction() as c:
+            for operation in operations:
+                c.execute('SAVEPOINT batch_op')
+                callbacks_mark = len(self._local.on_commit)
+                try:
+                    value = operation()
+                except Exception as e:
+                    c.execute('ROLLBACK TO batch_op')
+                    c.execute('RELEASE batch_op')
+                    del self._local.on_commit[callbacks_mark:]
+                    results.append((False, e))
+                else:
+                    c.execute('RELEASE batch_op')
+                    results.append((True, value))
+        self._count('batched_operations', len(operations))
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        """Счетчики соединений и конкуренции за блокировку"""
+        with self._lock:
+            result = dict(self._counters)
+            result['connections_open'] = len(self._connections)
+        return result
+
+    def close_all(self):
+        """Закрыть все соединения (при остановке бота)"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
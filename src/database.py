@@ -1,519 +1,1033 @@
 import sqlite3
 from datetime import datetime
-from typing import Optional, List, Tuple
+from typing import Callable, Optional, List, Tuple, Dict, FrozenSet, Iterable
 import discord
 
+from connection import ConnectionManager
+from faction_index import faction_index
+from guild_cache import GuildCache
+from leaderboard import leaderboard, faction_leaderboards
+from ledger import MINT_ACCOUNT, user_account, faction_account, post_entry, post_entries
+from migrations import migrate, faction_name_key, GUILD_STATS_RECOUNT_SQL
+from metrics import metrics
+from money import Money, Amount
+from slow_queries import slow_query_log
+
+DB_PATH = 'economy.db'
+
+# Общий менеджер соединений: долгоживущие соединения вместо connect/close на каждый вызов
+db = ConnectionManager(DB_PATH, slow_log=slow_query_log)
+
+
+class TransferNotFound(ValueError):
+    """Ожидающий перевод уже выполнен, отменен или истек"""
+
+
+class InsufficientFunds(ValueError):
+    """Недостаточно средств для списания"""
+
+    def __init__(self, balance: Money):
+        super().__init__("Недостаточно средств")
+        self.balance = balance
+
 
 def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-
-    # Таблица пользователей
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id INTEGER, guild_id INTEGER, balance REAL, 
-                  PRIMARY KEY (user_id, guild_id))''')
-
-    # Таблица фракций
-    c.execute('''CREATE TABLE IF NOT EXISTS factions
-                 (faction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  guild_id INTEGER, name TEXT, balance REAL,
-                  leader_id INTEGER, color TEXT, created_at TEXT,
-                  description TEXT DEFAULT '', role_id INTEGER DEFAULT NULL,
-                  is_role_based INTEGER DEFAULT 0)''')
-
-    # Таблица членов фракций
-    c.execute('''CREATE TABLE IF NOT EXISTS faction_members
-                 (user_id INTEGER, guild_id INTEGER, faction_id INTEGER,
-                  role TEXT, joined_at TEXT)''')
-
-    # Таблица настроек интерфейса
-    c.execute('''CREATE TABLE IF NOT EXISTS ui_settings
-                 (guild_id INTEGER PRIMARY KEY, 
-                  embed_color TEXT, footer_text TEXT,
-                  admin_channel_id INTEGER)''')
-
-    # Проверяем наличие столбцов
-    c.execute("PRAGMA table_info(factions)")
-    columns = [column[1] for column in c.fetchall()]
-
-    if 'role_id' not in columns:
-        c.execute('ALTER TABLE factions ADD COLUMN role_id INTEGER DEFAULT NULL')
-    if 'is_role_based' not in columns:
-        c.execute('ALTER TABLE factions ADD COLUMN is_role_based INTEGER DEFAULT 0')
-
-    # Таблица ролей с доступом к админ-панели
-    c.execute('''CREATE TABLE IF NOT EXISTS admin_roles
-                 (guild_id INTEGER, role_id INTEGER,
-                  added_by INTEGER, added_at TEXT,
-                  PRIMARY KEY (guild_id, role_id))''')
-
-    # Таблица пользователей с доступом к админ-панели
-    c.execute('''CREATE TABLE IF NOT EXISTS admin_users
-                 (guild_id INTEGER, user_id INTEGER,
-                  added_by INTEGER, added_at TEXT,
-                  PRIMARY KEY (guild_id, user_id))''')
-
-    # Таблица зарплат по ролям
-    c.execute('''CREATE TABLE IF NOT EXISTS role_salaries
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  guild_id INTEGER, role_id INTEGER,
-                  salary_amount REAL, added_by INTEGER,
-                  added_at TEXT, last_paid TEXT,
-                  UNIQUE(guild_id, role_id))''')
-
-    # Таблица истории выплат
-    c.execute('''CREATE TABLE IF NOT EXISTS salary_history
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  guild_id INTEGER, user_id INTEGER,
-                  role_id INTEGER, amount REAL,
-                  paid_at TEXT, paid_by TEXT DEFAULT 'system')''')
-
-    # Таблица ожидающих переводов
-    c.execute('''CREATE TABLE IF NOT EXISTS pending_transfers
-                 (transfer_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  guild_id INTEGER, from_user_id INTEGER, to_user_id INTEGER,
-                  to_faction_id INTEGER, amount REAL, type TEXT,
-                  created_at TEXT, expires_at TEXT)''')
-
-    conn.commit()
-    conn.close()
+    """Инициализация базы данных: применяет недостающие миграции схемы"""
+    migrate(db)
 
 
 # Функции для работы с ролями админов
 def get_admin_roles(guild_id: int) -> List[int]:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('SELECT role_id FROM admin_roles WHERE guild_id = ?', (guild_id,))
-    roles = [row[0] for row in c.fetchall()]
-    conn.close()
-    return roles
+    with db.cursor() as c:
+        c.execute('SELECT role_id FROM admin_roles WHERE guild_id = ?', (guild_id,))
+        return [row[0] for row in c.fetchall()]
 
 
 def get_admin_users(guild_id: int) -> List[int]:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM admin_users WHERE guild_id = ?', (guild_id,))
-    users = [row[0] for row in c.fetchall()]
-    conn.close()
-    return users
+    with db.cursor() as c:
+        c.execute('SELECT user_id FROM admin_users WHERE guild_id = ?', (guild_id,))
+        return [row[0] for row in c.fetchall()]
+
+
+# Кэш прав доступа к админ-панели: (роли, пользователи) по серверам
+_acl_cache = GuildCache()
+
+
+def get_cached_admin_acl(guild_id: int) -> Optional[Tuple[FrozenSet[int], FrozenSet[int]]]:
+    """Права доступа из кэша без обращения к базе; None, если их нужно загрузить"""
+    return _acl_cache.get(guild_id)
+
+
+def get_admin_acl(guild_id: int) -> Tuple[FrozenSet[int], FrozenSet[int]]:
+    """Админ-роли и админ-пользователи сервера"""
+    acl = _acl_cache.get(guild_id)
+    if acl is None:
+        generation = _acl_cache.generation(guild_id)
+        # Обе таблицы читаются в одной транзакции — роли и пользователи из одного состояния базы
+        with db.read_transaction() as c:
+            c.execute('SELECT role_id FROM admin_roles WHERE guild_id = ?', (guild_id,))
+            roles = frozenset(row[0] for row in c.fetchall())
+            c.execute('SELECT user_id FROM admin_users WHERE guild_id = ?', (guild_id,))
+            users = frozenset(row[0] for row in c.fetchall())
+        acl = (roles, users)
+        # Если права изменились во время чтения, результат не кэшируется
+        _acl_cache.store(guild_id, acl, generation)
+    return acl
+
+
+def _invalidate_admin_acl(guild_id: int):
+    """Сбросить кэш прав после фиксации текущей транзакции"""
+    db.on_commit(lambda: _acl_cache.invalidate(guild_id))
 
 
 def add_admin_role(guild_id: int, role_id: int, added_by: int) -> bool:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
     try:
-        c.execute('INSERT INTO admin_roles (guild_id, role_id, added_by, added_at) VALUES (?, ?, ?, ?)',
-                  (guild_id, role_id, added_by, datetime.now().isoformat()))
-        conn.commit()
-        return True
+        with db.transaction() as c:
+            c.execute('INSERT INTO admin_roles (guild_id, role_id, added_by, added_at) VALUES (?, ?, ?, ?)',
+                      (guild_id, role_id, added_by, datetime.now().isoformat()))
+            _invalidate_admin_acl(guild_id)
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
+    return True
 
 
 def remove_admin_role(guild_id: int, role_id: int):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM admin_roles WHERE guild_id = ? AND role_id = ?', (guild_id, role_id))
-    conn.commit()
-    conn.close()
+    with db.transaction() as c:
+        c.execute('DELETE FROM admin_roles WHERE guild_id = ? AND role_id = ?', (guild_id, role_id))
+        _invalidate_admin_acl(guild_id)
 
 
 def add_admin_user(guild_id: int, user_id: int, added_by: int) -> bool:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
     try:
-        c.execute('INSERT INTO admin_users (guild_id, user_id, added_by, added_at) VALUES (?, ?, ?, ?)',
-                  (guild_id, user_id, added_by, datetime.now().isoformat()))
-        conn.commit()
-        return True
+        with db.transaction() as c:
+            c.execute('INSERT INTO admin_users (guild_id, user_id, added_by, added_at) VALUES (?, ?, ?, ?)',
+                      (guild_id, user_id, added_by, datetime.now().isoformat()))
+            _invalidate_admin_acl(guild_id)
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
+    return True
 
 
 def remove_admin_user(guild_id: int, user_id: int):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM admin_users WHERE guild_id = ? AND user_id = ?', (guild_id, user_id))
-    conn.commit()
-    conn.close()
+    with db.transaction() as c:
+        c.execute('DELETE FROM admin_users WHERE guild_id = ? AND user_id = ?', (guild_id, user_id))
+        _invalidate_admin_acl(guild_id)
 
 
 # Получение настроек интерфейса
+def _ui_settings_from_row(row) -> dict:
+    embed_color, footer_text, admin_channel_id = row if row else (None, None, None)
+    return {
+        'color_hex': embed_color or "3498db",
+        'footer': footer_text or f"© {datetime.now().year} Экономика сервера",
+        'admin_channel': admin_channel_id
+    }
+
+
 def get_ui_settings(guild_id: int):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-
-    # Проверяем структуру таблицы
-    c.execute("PRAGMA table_info(ui_settings)")
-    columns = [column[1] for column in c.fetchall()]
-
-    # Определяем какие столбцы запрашивать
-    select_columns = []
-    if 'embed_color' in columns:
-        select_columns.append('embed_color')
-    if 'footer_text' in columns:
-        select_columns.append('footer_text')
-    if 'admin_channel_id' in columns:
-        select_columns.append('admin_channel_id')
-
-    if not select_columns:
-        conn.close()
-        return {
-            'color_hex': "3498db",
-            'footer': f"© {datetime.now().year} Экономика сервера",
-            'admin_channel': None
-        }
-
-    select_query = f"SELECT {', '.join(select_columns)} FROM ui_settings WHERE guild_id = ?"
-    c.execute(select_query, (guild_id,))
-    result = c.fetchone()
-    conn.close()
+    with db.cursor() as c:
+        c.execute('SELECT embed_color, footer_text, admin_channel_id FROM ui_settings WHERE guild_id = ?',
+                  (guild_id,))
+        return _ui_settings_from_row(c.fetchone())
 
-    if result:
-        result_dict = {}
-        for i, col in enumerate(select_columns):
-            result_dict[col] = result[i]
 
-        return {
-            'color_hex': result_dict.get('embed_color') or "3498db",
-            'footer': result_dict.get('footer_text') or f"© {datetime.now().year} Экономика сервера",
-            'admin_channel': result_dict.get('admin_channel_id')
-        }
+def save_ui_settings(guild_id: int, embed_color: Optional[str] = None, footer_text: Optional[str] = None):
+    """Сохранение настроек интерфейса"""
+    with db.transaction() as c:
+        c.execute('SELECT * FROM ui_settings WHERE guild_id = ?', (guild_id,))
+        if c.fetchone():
+            if embed_color:
+                c.execute('UPDATE ui_settings SET embed_color = ? WHERE guild_id = ?', (embed_color, guild_id))
+            if footer_text:
+                c.execute('UPDATE ui_settings SET footer_text = ? WHERE guild_id = ?', (footer_text, guild_id))
+        else:
+            c.execute('INSERT INTO ui_settings (guild_id, embed_color, footer_text) VALUES (?, ?, ?)',
+                      (guild_id, embed_color or "3498db", footer_text or ""))
+
+        # Новые настройки попадают в кэш после фиксации; читатели с более старыми данными их не перезапишут
+        c.execute('SELECT embed_color, footer_text, admin_channel_id FROM ui_settings WHERE guild_id = ?',
+                  (guild_id,))
+        settings = _format_settings(_ui_settings_from_row(c.fetchone()))
+        db.on_commit(lambda: _settings_cache.put(guild_id, settings))
+
 
+# Кэш настроек интерфейса по серверам: готовые discord.Color и подвалы
+_settings_cache = GuildCache()
+_settings_preloaded = False
+
+
+def _format_settings(settings: dict) -> dict:
     return {
-        'color_hex': "3498db",
-        'footer': f"© {datetime.now().year} Экономика сервера",
-        'admin_channel': None
+        'color': hex_to_color(settings['color_hex']),
+        'footer': settings['footer'],
+        'admin_channel': settings['admin_channel']
     }
 
 
-def save_ui_settings(guild_id: int, embed_color: Optional[str] = None, footer_text: Optional[str] = None):
-    """Сохранение настроек интерфейса"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
+def preload_ui_settings() -> int:
+    """Загрузить настройки всех серверов одним запросом. Возвращает число загруженных серверов"""
+    global _settings_preloaded
 
-    c.execute('SELECT * FROM ui_settings WHERE guild_id = ?', (guild_id,))
-    if c.fetchone():
-        if embed_color:
-            c.execute('UPDATE ui_settings SET embed_color = ? WHERE guild_id = ?', (embed_color, guild_id))
-        if footer_text:
-            c.execute('UPDATE ui_settings SET footer_text = ? WHERE guild_id = ?', (footer_text, guild_id))
-    else:
-        c.execute('INSERT INTO ui_settings (guild_id, embed_color, footer_text) VALUES (?, ?, ?)',
-                  (guild_id, embed_color or "3498db", footer_text or ""))
+    with db.cursor() as c:
+        c.execute('SELECT guild_id, embed_color, footer_text, admin_channel_id FROM ui_settings')
+        rows = c.fetchall()
 
-    conn.commit()
-    conn.close()
+    _settings_cache.load((guild_id, _format_settings(_ui_settings_from_row(row))) for guild_id, *row in rows)
+    _settings_preloaded = True
+    return len(rows)
 
 
-# Функции для работы с балансом
-def get_balance(user_id: int, guild_id: int, default_balance: float = 1000.0) -> float:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id))
-    result = c.fetchone()
+def get_cached_settings(guild_id: int) -> Optional[dict]:
+    """Настройки из кэша без обращения к базе; None, если их нужно загрузить"""
+    settings = _settings_cache.get(guild_id)
+    if settings is None and _settings_preloaded:
+        # После предзагрузки отсутствие записи означает настройки по умолчанию
+        settings = _settings_cache.setdefault(guild_id, _format_settings(_ui_settings_from_row(None)))
+    return dict(settings) if settings is not None else None
 
-    if not result:
-        c.execute('INSERT INTO users (user_id, guild_id, balance) VALUES (?, ?, ?)',
-                  (user_id, guild_id, default_balance))
-        conn.commit()
-        conn.close()
-        return default_balance
 
-    conn.close()
-    return result[0]
+def _with_money(row, *indices):
+    """Строка результата с денежными столбцами в виде Money (NULL остается None)"""
+    if row is None:
+        return None
+    row = list(row)
+    for index in indices:
+        if row[index] is not None:
+            row[index] = Money.from_db(row[index])
+    return tuple(row)
 
 
-def update_balance(user_id: int, guild_id: int, amount: float, default_balance: float = 1000.0) -> float:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    current = get_balance(user_id, guild_id, default_balance)
-    new_balance = current + amount
+# Функции для работы с балансом
+def _track_balance(guild_id: int, user_id: int, balance: Money):
+    """Обновить рейтинг игроков и топ участников фракции после фиксации транзакции"""
+    def update():
+        leaderboard.update(guild_id, user_id, balance)
+        faction_leaderboards.update_balance(guild_id, user_id, balance)
+
+    db.on_commit(update)
+
+
+def _ensure_user(c, user_id: int, guild_id: int, default_balance: Amount):
+    """Создать запись игрока со стартовым балансом (проводка со счета выпуска)"""
+    default_balance = Money.from_major(default_balance)
+    c.execute('INSERT OR IGNORE INTO users (user_id, guild_id, balance) VALUES (?, ?, ?)',
+              (user_id, guild_id, default_balance))
+    if c.rowcount == 1:
+        post_entry(c, guild_id, MINT_ACCOUNT, user_account(user_id), default_balance, 'grant',
+                   memo='Стартовый баланс')
+        _track_balance(guild_id, user_id, default_balance)
+
+
+def get_stored_balance(user_id: int, guild_id: int) -> Optional[Money]:
+    """Баланс игрока без создания записи; None, если игрока еще нет"""
+    with db.cursor() as c:
+        c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id))
+        result = c.fetchone()
+    return Money.from_db(result[0]) if result else None
+
+
+def ensure_user(user_id: int, guild_id: int, default_balance: Amount = 1000.0) -> Money:
+    """Создать игрока со стартовым балансом, если его нет; возвращает баланс (запись)"""
+    with db.transaction() as c:
+        _ensure_user(c, user_id, guild_id, default_balance)
+        c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id))
+        return Money.from_db(c.fetchone()[0])
+
+
+def get_balance(user_id: int, guild_id: int, default_balance: Amount = 1000.0) -> Money:
+    balance = get_stored_balance(user_id, guild_id)
+    if balance is not None:
+        return balance
+    return ensure_user(user_id, guild_id, default_balance)
+
+
+def update_balance(user_id: int, guild_id: int, amount: Amount, default_balance: Amount = 1000.0,
+                   kind: str = 'adjust', memo: Optional[str] = None, actor_id: Optional[int] = None) -> Money:
+    """Изменить баланс игрока на amount (проводка со счета выпуска или на него)"""
+    amount = Money.from_major(amount)
+    with db.transaction() as c:
+        _ensure_user(c, user_id, guild_id, default_balance)
+        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ? AND guild_id = ?',
+                  (amount, user_id, guild_id))
+        post_entry(c, guild_id, MINT_ACCOUNT, user_account(user_id), amount, kind, memo, actor_id)
+        c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id))
+        balance = Money.from_db(c.fetchone()[0])
+        _track_balance(guild_id, user_id, balance)
+        return balance
+
+
+def set_balance(user_id: int, guild_id: int, amount: Amount, actor_id: Optional[int] = None):
+    """Установить баланс игрока (в журнал записывается разница)"""
+    amount = Money.from_major(amount)
+    with db.transaction() as c:
+        c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id))
+        result = c.fetchone()
+        if result:
+            c.execute('UPDATE users SET balance = ? WHERE user_id = ? AND guild_id = ?',
+                      (amount, user_id, guild_id))
+        else:
+            c.execute('INSERT INTO users (user_id, guild_id, balance) VALUES (?, ?, ?)',
+                      (user_id, guild_id, amount))
+        previous = Money.from_db(result[0] if result else 0)
+        post_entry(c, guild_id, MINT_ACCOUNT, user_account(user_id), amount - previous, 'set',
+                   memo='Установка баланса', actor_id=actor_id)
+        _track_balance(guild_id, user_id, amount)
+
+
+def transfer(guild_id: int, from_user_id: int, amount: Amount, to_user_id: Optional[int] = None,
+             to_faction_id: Optional[int] = None, default_balance: Amount = 1000.0) -> Tuple[Money, Money]:
+    """Атомарный перевод игроку или в казну фракции.
+
+    Списание и зачисление выполняются в одной транзакции.
+    Списание условное (balance >= amount), поэтому повторное подтверждение не спишет деньги дважды.
+    Возвращает новые балансы отправителя и получателя.
+    """
+    amount = Money.from_major(amount)
+    insufficient_balance = None
+
+    with db.transaction() as c:
+        _ensure_user(c, from_user_id, guild_id, default_balance)
+        c.execute('''UPDATE users SET balance = balance - ?
+                     WHERE user_id = ? AND guild_id = ? AND balance >= ?''',
+                  (amount, from_user_id, guild_id, amount))
+        debited = c.rowcount == 1
+
+        c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (from_user_id, guild_id))
+        sender_balance = Money.from_db(c.fetchone()[0])
+        _track_balance(guild_id, from_user_id, sender_balance)
+
+        if not debited:
+            # Списания не было: зачисление пропускается, ошибка — после выхода из транзакции
+            insufficient_balance = sender_balance
+        elif to_faction_id is not None:
+            c.execute('UPDATE factions SET balance = balance + ? WHERE faction_id = ?', (amount, to_faction_id))
+            if c.rowcount == 0:
+                raise ValueError("Фракция не найдена")
+            c.execute('SELECT balance FROM factions WHERE faction_id = ?', (to_faction_id,))
+            receiver_balance = Money.from_db(c.fetchone()[0])
+            post_entry(c, guild_id, user_account(from_user_id), faction_account(to_faction_id), amount,
+                       'faction_transfer', actor_id=from_user_id)
+        else:
+            _ensure_user(c, to_user_id, guild_id, default_balance)
+            c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ? AND guild_id = ?',
+                      (amount, to_user_id, guild_id))
+            c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (to_user_id, guild_id))
+            receiver_balance = Money.from_db(c.fetchone()[0])
+            _track_balance(guild_id, to_user_id, receiver_balance)
+            post_entry(c, guild_id, user_account(from_user_id), user_account(to_user_id), amount,
+                       'transfer', actor_id=from_user_id)
+
+    if insufficient_balance is not None:
+        raise InsufficientFunds(insufficient_balance)
 
-    c.execute('UPDATE users SET balance = ? WHERE user_id = ? AND guild_id = ?',
-              (new_balance, user_id, guild_id))
-    conn.commit()
-    conn.close()
-    return new_balance
+    return sender_balance, receiver_balance
 
 
 def get_all_balances(guild_id: int) -> List[tuple]:
     """Получить все балансы на сервере"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id, balance FROM users WHERE guild_id = ?', (guild_id,))
-    all_balances = c.fetchall()
-    conn.close()
-    return all_balances
+    with db.cursor() as c:
+        c.execute('SELECT user_id, balance FROM users WHERE guild_id = ?', (guild_id,))
+        return [(user_id, Money.from_db(balance)) for user_id, balance in c.fetchall()]
+
+
+def get_balances(guild_id: int, user_ids: Iterable[int], default_balance: Amount = 1000.0) -> Dict[int, Money]:
+    """Балансы нескольких игроков одним запросом (соединение с временной таблицей id).
+
+    Игрокам без записи возвращается default_balance; записи при этом не создаются.
+    """
+    user_ids = list(user_ids)
+    default_balance = Money.from_major(default_balance)
+    balances = dict.fromkeys(user_ids, default_balance)
+    if not user_ids:
+        return balances
+
+    with db.cursor() as c:
+        _fill_id_table(c, 'balance_lookup', user_ids)
+        c.execute('''SELECT u.user_id, u.balance FROM temp.balance_lookup b
+                     JOIN users u ON u.user_id = b.user_id AND u.guild_id = ?''', (guild_id,))
+        for user_id, balance in c.fetchall():
+            balances[user_id] = Money.from_db(balance)
+    return balances
+
+
+def preload_leaderboard() -> int:
+    """Построить рейтинг игроков всех серверов и рейтинги участников фракций. Возвращает число игроков"""
+    # Снимок и замена рейтингов — при приостановленных фиксациях, иначе обновление,
+    # зафиксированное между чтением и load(), потерялось бы
+    with db.commits_paused(), db.cursor() as c:
+        c.execute('SELECT guild_id, user_id, balance FROM users')
+        rows = c.fetchall()
+        c.execute('''SELECT fm.faction_id, fm.guild_id, fm.user_id, u.balance
+                     FROM faction_members fm
+                     LEFT JOIN users u ON fm.user_id = u.user_id AND fm.guild_id = u.guild_id''')
+        faction_rows = c.fetchall()
+        leaderboard.load(rows)
+        faction_leaderboards.load(faction_rows)
+    return len(rows)
+
+
+def get_top_balances(guild_id: int, limit: int = 10, offset: int = 0,
+                     predicate: Optional[Callable[[int], bool]] = None) -> List[Tuple[int, Money]]:
+    """Самые богатые игроки сервера; с predicate учитываются только подходящие user_id"""
+    if leaderboard.loaded:
+        return leaderboard.top(guild_id, limit, offset, predicate)
+
+    # До построения рейтинга — чтение по индексу (guild_id, balance DESC)
+    result = []
+    skipped = 0
+    with db.cursor() as c:
+        c.execute('''SELECT user_id, balance FROM users WHERE guild_id = ?
+                     ORDER BY balance DESC, user_id''', (guild_id,))
+        for user_id, balance in c:
+            if predicate is not None and not predicate(user_id):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            result.append((user_id, Money.from_db(balance)))
+            if len(result) >= limit:
+                break
+    return result
 
 
-def get_total_balance(guild_id: int, exclude_role_id: Optional[int] = None) -> Tuple[float, int, int]:
-    """Получить общий баланс, количество игроков и количество игроков с исключенной ролью"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
+def get_balance_rank(guild_id: int, user_id: int) -> Tuple[Optional[int], int]:
+    """Место игрока в рейтинге сервера и число игроков"""
+    if leaderboard.loaded:
+        return leaderboard.rank(guild_id, user_id)
+
+    with db.cursor() as c:
+        c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id))
+        result = c.fetchone()
+        c.execute('SELECT COUNT(*) FROM users WHERE guild_id = ?', (guild_id,))
+        total = c.fetchone()[0]
+        if not result:
+            return None, total
+        c.execute('''SELECT COUNT(*) FROM users WHERE guild_id = ?
+                     AND (balance > ? OR (balance = ? AND user_id < ?))''',
+                  (guild_id, result[0], result[0], user_id))
+        return c.fetchone()[0] + 1, total
+
+
+def _fill_id_table(c, table: str, ids: Iterable[int]):
+    """Заполнить временную таблицу идентификаторов соединения"""
+    c.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (user_id INTEGER PRIMARY KEY)')
+    c.execute(f'DELETE FROM temp.{table}')
+    c.executemany(f'INSERT OR IGNORE INTO temp.{table} (user_id) VALUES (?)', ((user_id,) for user_id in ids))
+
+
+def get_total_balance(guild_id: int, exclude_member_ids: Optional[Iterable[int]] = None,
+                      member_ids: Optional[Iterable[int]] = None) -> Tuple[Money, int, int]:
+    """Получить общий баланс, количество игроков и количество игроков с исключенной ролью.
+
+    exclude_member_ids — участники исключаемой роли (role.members), member_ids — если задан,
+    учитываются только эти игроки (например, текущие участники сервера).
+    Все считается одним запросом с анти-соединением по временной таблице.
+    """
+    with db.cursor() as c:
+        _fill_id_table(c, 'total_excluded', exclude_member_ids or ())
+        members_join = ''
+        if member_ids is not None:
+            _fill_id_table(c, 'total_members', member_ids)
+            members_join = 'JOIN temp.total_members m ON m.user_id = u.user_id'
+
+        c.execute(f'''SELECT SUM(CASE WHEN e.user_id IS NULL THEN u.balance ELSE 0 END),
+                            COALESCE(SUM(e.user_id IS NULL), 0),
+                            COALESCE(SUM(e.user_id IS NOT NULL), 0)
+                     FROM users u
+                     {members_join}
+                     LEFT JOIN temp.total_excluded e ON e.user_id = u.user_id
+                     WHERE u.guild_id = ?''', (guild_id,))
+        total_balance, total_users, ignored_users = c.fetchone()
+
+    return Money.from_db(total_balance), total_users, ignored_users
+
+
+def get_guild_stats(guild_id: int) -> dict:
+    """Статистика сервера для админ-панели (счетчики guild_stats, которые ведут триггеры)"""
+    with db.cursor() as c:
+        c.execute('''SELECT user_count, user_balance, faction_count, faction_balance
+                     FROM guild_stats WHERE guild_id = ?''', (guild_id,))
+        row = c.fetchone() or (0, 0, 0, 0)
+
+    user_count, total_balance, faction_count, faction_total_balance = row
+    return {
+        'user_count': user_count,
+        'faction_count': faction_count,
+        'total_balance': Money.from_db(total_balance),
+        'faction_total_balance': Money.from_db(faction_total_balance)
+    }
 
-    c.execute('SELECT SUM(balance), COUNT(*) FROM users WHERE guild_id = ?', (guild_id,))
-    result = c.fetchone()
 
-    total_balance = result[0] if result and result[0] is not None else 0.0
-    total_users = result[1] if result else 0
+def recount_guild_stats() -> List[int]:
+    """Пересчитать счетчики всех серверов и исправить расхождения. Возвращает серверы с расхождением"""
+    with db.transaction() as c:
+        c.execute(GUILD_STATS_RECOUNT_SQL)
+        actual = {row[0]: tuple(row[1:]) for row in c.fetchall()}
+        c.execute('SELECT guild_id, user_count, user_balance, faction_count, faction_balance FROM guild_stats')
+        stored = {row[0]: tuple(row[1:]) for row in c.fetchall()}
 
-    conn.close()
-    return total_balance, total_users, 0
+        drifted = sorted(guild_id for guild_id in actual.keys() | stored.keys()
+                         if actual.get(guild_id, (0, 0, 0, 0)) != stored.get(guild_id, (0, 0, 0, 0)))
+        for guild_id in drifted:
+            c.execute('''INSERT OR REPLACE INTO guild_stats
+                         (guild_id, user_count, user_balance, faction_count, faction_balance)
+                         VALUES (?, ?, ?, ?, ?)''', (guild_id, *actual.get(guild_id, (0, 0, 0, 0))))
+    return drifted
 
 
 # Функции для работы с фракциями
-def get_faction_balance(faction_id: int) -> float:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('SELECT balance FROM factions WHERE faction_id = ?', (faction_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else 0
+def get_faction_balance(faction_id: int) -> Money:
+    with db.cursor() as c:
+        c.execute('SELECT balance FROM factions WHERE faction_id = ?', (faction_id,))
+        result = c.fetchone()
+    return Money.from_db(result[0] if result else 0)
 
 
-def update_faction_balance(faction_id: int, amount: float):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('UPDATE factions SET balance = balance + ? WHERE faction_id = ?', (amount, faction_id))
-    conn.commit()
-    conn.close()
+def update_faction_balance(faction_id: int, amount: Amount, kind: str = 'adjust',
+                           memo: Optional[str] = None, actor_id: Optional[int] = None):
+    """Изменить казну фракции на amount (проводка со счета выпуска или на него)"""
+    amount = Money.from_major(amount)
+    with db.transaction() as c:
+        c.execute('UPDATE factions SET balance = balance + ? WHERE faction_id = ?', (amount, faction_id))
+        c.execute('SELECT guild_id FROM factions WHERE faction_id = ?', (faction_id,))
+        result = c.fetchone()
+        if result:
+            post_entry(c, result[0], MINT_ACCOUNT, faction_account(faction_id), amount, kind, memo, actor_id)
+
+
+# Столбцы фракции в порядке исходной схемы (служебный name_key не возвращается)
+FACTION_COLUMNS = ('faction_id, guild_id, name, balance, leader_id, color, created_at, '
+                   'description, role_id, is_role_based')
+_FACTION_COLUMNS_F = ', '.join(f'f.{column}' for column in FACTION_COLUMNS.split(', '))
 
 
 def get_user_faction(user_id: int, guild_id: int):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''SELECT f.* FROM factions f
-                 JOIN faction_members fm ON f.faction_id = fm.faction_id
-                 WHERE fm.user_id = ? AND f.guild_id = ?''',
-              (user_id, guild_id))
-    result = c.fetchone()
-    conn.close()
-    return result
+    with db.cursor() as c:
+        c.execute(f'''SELECT {_FACTION_COLUMNS_F} FROM factions f
+                     JOIN faction_members fm ON f.faction_id = fm.faction_id
+                     WHERE fm.user_id = ? AND f.guild_id = ?''',
+                  (user_id, guild_id))
+        return _with_money(c.fetchone(), 3)
+
+
+def _has_faction_search(c) -> bool:
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'faction_search'")
+    return c.fetchone() is not None
+
+
+def search_factions(guild_id: int, query: str, limit: int = 25) -> List[tuple]:
+    """Поиск фракций по названию: сначала точное совпадение, затем по началу, затем по подстроке.
+
+    Внутри каждой группы — более короткие названия раньше, дальше по алфавиту.
+    """
+    key = faction_name_key(query).strip()
+    if not key:
+        return []
+
+    results: List[tuple] = []
+    seen = set()
+
+    def collect(c):
+        for row in c.fetchall():
+            if row[0] not in seen and len(results) < limit:
+                seen.add(row[0])
+                results.append(_with_money(row, 3))
+
+    with db.cursor() as c:
+        # Точное совпадение и совпадение по началу — диапазон по индексу (guild_id, name_key)
+        c.execute(f'''SELECT {FACTION_COLUMNS} FROM factions
+                      WHERE guild_id = ? AND name_key >= ? AND name_key < ?
+                      ORDER BY name_key != ?, length(name_key), name_key, faction_id
+                      LIMIT ?''',
+                  (guild_id, key, key + '\U0010ffff', key, limit))
+        collect(c)
+        if len(results) >= limit:
+            return results
+
+        # Совпадение по подстроке — триграммный индекс FTS5 (от 3 символов)
+        if len(key) >= 3 and _has_faction_search(c):
+            match = '"' + key.replace('"', '""') + '"'
+            c.execute(f'''SELECT {_FACTION_COLUMNS_F} FROM faction_search s
+                          JOIN factions f ON f.faction_id = s.rowid
+                          WHERE faction_search MATCH ? AND f.guild_id = ?
+                          ORDER BY length(f.name_key), f.name_key, f.faction_id''',
+                      (match, guild_id))
+        else:
+            c.execute(f'''SELECT {FACTION_COLUMNS} FROM factions
+                          WHERE guild_id = ? AND instr(name_key, ?) > 0
+                          ORDER BY length(name_key), name_key, faction_id''',
+                      (guild_id, key))
+        collect(c)
+    return results
 
 
 def get_faction_by_name(guild_id: int, faction_name: str):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''SELECT * FROM factions 
-                 WHERE guild_id = ? AND LOWER(name) LIKE LOWER(?)''',
-              (guild_id, f"%{faction_name}%"))
+    """Лучшее совпадение по названию (см. search_factions)"""
+    results = search_factions(guild_id, faction_name, limit=1)
+    return results[0] if results else None
+
+
+def get_faction_member_count(faction_id: int) -> int:
+    """Количество участников фракции (столбец member_count, его ведут триггеры)"""
+    with db.cursor() as c:
+        c.execute('SELECT member_count FROM factions WHERE faction_id = ?', (faction_id,))
+        result = c.fetchone()
+    return result[0] if result else 0
+
+
+def get_faction_top_members(faction_id: int, limit: int = 3) -> List[tuple]:
+    """Топ участников фракции по балансу"""
+    if faction_leaderboards.loaded:
+        return faction_leaderboards.top(faction_id, limit)
+
+    with db.cursor() as c:
+        c.execute('''SELECT fm.user_id, u.balance
+                     FROM faction_members fm
+                     JOIN users u ON fm.user_id = u.user_id AND fm.guild_id = u.guild_id
+                     WHERE fm.faction_id = ?
+                     ORDER BY u.balance DESC, fm.user_id LIMIT ?''',
+                  (faction_id, limit))
+        return [_with_money(row, 1) for row in c.fetchall()]
+
+
+def _track_membership(c, faction_id: int, guild_id: int, user_id: int):
+    """Добавить игрока в рейтинг участников фракции после фиксации транзакции"""
+    c.execute('SELECT balance FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id))
     result = c.fetchone()
-    conn.close()
-    return result
+    balance = Money.from_db(result[0]) if result else None
+    db.on_commit(lambda: faction_leaderboards.join(faction_id, guild_id, user_id, balance))
 
 
 def create_faction(guild_id: int, name: str, leader_id: int, description: str = "",
                    color: str = "3498db", role_id: Optional[int] = None) -> int:
     """Создание новой фракции"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-
-    # Проверяем, не существует ли уже фракция с таким именем
-    c.execute('SELECT faction_id FROM factions WHERE guild_id = ? AND LOWER(name) = LOWER(?)',
-              (guild_id, name))
-    if c.fetchone():
-        conn.close()
-        raise ValueError("Фракция с таким названием уже существует")
-
-    is_role_based = 1 if role_id is not None else 0
-
-    c.execute('''INSERT INTO factions (guild_id, name, balance, leader_id, color, 
-                                       description, role_id, is_role_based)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (guild_id, name, 0.0, leader_id, color,
-               description, role_id, is_role_based))
-    faction_id = c.lastrowid
-
-    # Если фракция не привязана к роли, добавляем лидера в члены
-    if role_id is None:
+    with db.transaction() as c:
+        # Проверяем, не существует ли уже фракция с таким именем
+        name_key = faction_name_key(name)
+        c.execute('SELECT faction_id FROM factions WHERE guild_id = ? AND name_key = ?',
+                  (guild_id, name_key))
+        if c.fetchone():
+            raise ValueError("Фракция с таким названием уже существует")
+
+        is_role_based = 1 if role_id is not None else 0
+
+        c.execute('''INSERT INTO factions (guild_id, name, balance, leader_id, color,
+                                           description, role_id, is_role_based, name_key)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                  (guild_id, name, 0.0, leader_id, color,
+                   description, role_id, is_role_based, name_key))
+        faction_id = c.lastrowid
+
+        # Если фракция не привязана к роли, добавляем лидера в члены
+        if role_id is None:
+            c.execute('''INSERT INTO faction_members (user_id, guild_id, faction_id, role, joined_at)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      (leader_id, guild_id, faction_id, 'Лидер', datetime.now().isoformat()))
+            _track_membership(c, faction_id, guild_id, leader_id)
+
+    faction_index.add(guild_id, faction_id, name)
+    return faction_id
+
+
+def join_faction(user_id: int, guild_id: int, faction_id: int) -> Optional[int]:
+    """Вступление во фракцию. Возвращает ID текущей фракции, если пользователь уже состоит в ней"""
+    with db.transaction() as c:
+        c.execute('SELECT faction_id FROM faction_members WHERE user_id = ? AND guild_id = ?',
+                  (user_id, guild_id))
+        existing_faction = c.fetchone()
+        if existing_faction:
+            return existing_faction[0]
+
         c.execute('''INSERT INTO faction_members (user_id, guild_id, faction_id, role, joined_at)
                      VALUES (?, ?, ?, ?, ?)''',
-                  (leader_id, guild_id, faction_id, 'Лидер', datetime.now().isoformat()))
+                  (user_id, guild_id, faction_id, 'Участник', datetime.now().isoformat()))
+        _track_membership(c, faction_id, guild_id, user_id)
+    return None
+
+
+def leave_faction(user_id: int, guild_id: int):
+    """Выход из фракции"""
+    with db.transaction() as c:
+        c.execute('DELETE FROM faction_members WHERE user_id = ? AND guild_id = ?',
+                  (user_id, guild_id))
+        db.on_commit(lambda: faction_leaderboards.leave(guild_id, user_id))
+
+
+def set_faction_leader(faction_id: int, user_id: int) -> bool:
+    """Назначить лидера фракции. False, если пользователь не состоит во фракции"""
+    with db.transaction() as c:
+        c.execute('SELECT 1 FROM faction_members WHERE faction_id = ? AND user_id = ?',
+                  (faction_id, user_id))
+        if not c.fetchone():
+            return False
+
+        c.execute('UPDATE factions SET leader_id = ? WHERE faction_id = ?',
+                  (user_id, faction_id))
+        c.execute('UPDATE faction_members SET role = ? WHERE faction_id = ? AND user_id = ?',
+                  ('Лидер', faction_id, user_id))
+    return True
+
+
+def rename_faction(faction_id: int, name: str):
+    """Переименовать фракцию"""
+    with db.transaction() as c:
+        c.execute('UPDATE factions SET name = ?, name_key = ? WHERE faction_id = ?',
+                  (name, faction_name_key(name), faction_id))
+        c.execute('SELECT guild_id FROM factions WHERE faction_id = ?', (faction_id,))
+        result = c.fetchone()
 
-    conn.commit()
-    conn.close()
-    return faction_id
+    if result:
+        faction_index.add(result[0], faction_id, name)
+
+
+def set_faction_description(faction_id: int, description: str):
+    """Изменить описание фракции"""
+    with db.transaction() as c:
+        c.execute('UPDATE factions SET description = ? WHERE faction_id = ?', (description, faction_id))
+
+
+def preload_faction_index() -> int:
+    """Построить индекс названий фракций для автодополнения. Возвращает число фракций"""
+    with db.cursor() as c:
+        c.execute('SELECT faction_id, guild_id, name FROM factions')
+        rows = c.fetchall()
+    faction_index.load(rows)
+    return len(rows)
 
 
 def get_faction_members(faction_id: int):
     """Получить всех членов фракции"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''SELECT fm.user_id, fm.role, fm.joined_at, u.balance 
-                 FROM faction_members fm
-                 LEFT JOIN users u ON fm.user_id = u.user_id AND fm.guild_id = u.guild_id
-                 WHERE fm.faction_id = ?''', (faction_id,))
-    members = c.fetchall()
-    conn.close()
-    return members
+    with db.cursor() as c:
+        c.execute('''SELECT fm.user_id, fm.role, fm.joined_at, u.balance
+                     FROM faction_members fm
+                     LEFT JOIN users u ON fm.user_id = u.user_id AND fm.guild_id = u.guild_id
+                     WHERE fm.faction_id = ?''', (faction_id,))
+        return [_with_money(row, 3) for row in c.fetchall()]
+
+
+def get_faction_members_page(faction_id: int, after_user_id: Optional[int] = None,
+                             limit: int = 10) -> List[tuple]:
+    """Страница членов фракции по user_id (индекс (faction_id, user_id)): (user_id, role, joined_at, balance)"""
+    with db.cursor() as c:
+        c.execute('''SELECT fm.user_id, fm.role, fm.joined_at, u.balance
+                     FROM faction_members fm
+                     LEFT JOIN users u ON fm.user_id = u.user_id AND fm.guild_id = u.guild_id
+                     WHERE fm.faction_id = ? AND fm.user_id > ?
+                     ORDER BY fm.user_id LIMIT ?''',
+                  (faction_id, after_user_id if after_user_id is not None else -2 ** 63, limit))
+        return [_with_money(row, 3) for row in c.fetchall()]
 
 
 def get_all_factions(guild_id: int):
     """Получить все фракции на сервере"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''SELECT f.*, COUNT(fm.user_id) as member_count 
-                 FROM factions f
-                 LEFT JOIN faction_members fm ON f.faction_id = fm.faction_id
-                 WHERE f.guild_id = ?
-                 GROUP BY f.faction_id
-                 ORDER BY f.name''', (guild_id,))
-    factions = c.fetchall()
-    conn.close()
-    return factions
+    with db.cursor() as c:
+        c.execute(f'''SELECT {_FACTION_COLUMNS_F}, f.member_count
+                     FROM factions f
+                     WHERE f.guild_id = ?
+                     ORDER BY f.name''', (guild_id,))
+        return [_with_money(row, 3) for row in c.fetchall()]
+
+
+def get_factions_page(guild_id: int, after: Optional[Tuple[str, int]] = None, limit: int = 5) -> List[tuple]:
+    """Страница фракций сервера по ключу (название, faction_id) с количеством участников"""
+    after_name, after_id = after if after is not None else ('', -1)
+    with db.cursor() as c:
+        c.execute(f'''SELECT {_FACTION_COLUMNS_F}, f.member_count
+                     FROM factions f
+                     WHERE f.guild_id = ? AND (f.name, f.faction_id) > (?, ?)
+                     ORDER BY f.name, f.faction_id LIMIT ?''', (guild_id, after_name, after_id, limit))
+        return [_with_money(row, 3) for row in c.fetchall()]
 
 
 def get_role_based_factions(guild_id: int):
     """Получить фракции, привязанные к ролям"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''SELECT * FROM factions 
-                 WHERE guild_id = ? AND is_role_based = 1
-                 ORDER BY name''', (guild_id,))
-    factions = c.fetchall()
-    conn.close()
-    return factions
+    with db.cursor() as c:
+        c.execute(f'''SELECT {FACTION_COLUMNS} FROM factions
+                     WHERE guild_id = ? AND is_role_based = 1
+                     ORDER BY name''', (guild_id,))
+        return [_with_money(row, 3) for row in c.fetchall()]
 
 
 # Функции для зарплат
-def add_role_salary(guild_id: int, role_id: int, salary_amount: float, added_by: int) -> bool:
+def add_role_salary(guild_id: int, role_id: int, salary_amount: Amount, added_by: int) -> bool:
     """Добавить или обновить зарплату для роли"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
+    salary_amount = Money.from_major(salary_amount)
     try:
-        c.execute('''INSERT OR REPLACE INTO role_salaries 
-                     (guild_id, role_id, salary_amount, added_by, added_at)
-                     VALUES (?, ?, ?, ?, ?)''',
-                  (guild_id, role_id, salary_amount, added_by, datetime.now().isoformat()))
-        conn.commit()
+        with db.transaction() as c:
+            c.execute('''INSERT OR REPLACE INTO role_salaries
+                         (guild_id, role_id, salary_amount, added_by, added_at)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      (guild_id, role_id, salary_amount, added_by, datetime.now().isoformat()))
         return True
     except Exception as e:
         print(f"Ошибка при добавлении зарплаты: {e}")
         return False
-    finally:
-        conn.close()
 
 
 def remove_role_salary(guild_id: int, role_id: int) -> bool:
     """Удалить зарплату для роли"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
     try:
-        c.execute('DELETE FROM role_salaries WHERE guild_id = ? AND role_id = ?', (guild_id, role_id))
-        conn.commit()
+        with db.transaction() as c:
+            c.execute('DELETE FROM role_salaries WHERE guild_id = ? AND role_id = ?', (guild_id, role_id))
         return True
     except Exception as e:
         print(f"Ошибка при удалении зарплаты: {e}")
         return False
-    finally:
-        conn.close()
 
 
-def get_role_salary(guild_id: int, role_id: int) -> Optional[float]:
+def get_role_salary(guild_id: int, role_id: int) -> Optional[Money]:
     """Получить зарплату для роли"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('SELECT salary_amount FROM role_salaries WHERE guild_id = ? AND role_id = ?',
-              (guild_id, role_id))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
+    with db.cursor() as c:
+        c.execute('SELECT salary_amount FROM role_salaries WHERE guild_id = ? AND role_id = ?',
+                  (guild_id, role_id))
+        result = c.fetchone()
+    return Money.from_db(result[0]) if result else None
 
 
 def get_all_role_salaries(guild_id: int) -> List[tuple]:
     """Получить все зарплаты на сервере"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''SELECT role_id, salary_amount, added_by, added_at, last_paid 
-                 FROM role_salaries WHERE guild_id = ? ORDER BY salary_amount DESC''',
-              (guild_id,))
-    salaries = c.fetchall()
-    conn.close()
-    return salaries
+    with db.cursor() as c:
+        c.execute('''SELECT role_id, salary_amount, added_by, added_at, last_paid
+                     FROM role_salaries WHERE guild_id = ? ORDER BY salary_amount DESC''',
+                  (guild_id,))
+        return [_with_money(row, 1) for row in c.fetchall()]
 
 
-def record_salary_payment(guild_id: int, user_id: int, role_id: int, amount: float, paid_by: str = "system"):
+def record_salary_payment(guild_id: int, user_id: int, role_id: int, amount: Amount, paid_by: str = "system"):
     """Записать выплату зарплаты в историю"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO salary_history (guild_id, user_id, role_id, amount, paid_at, paid_by)
-                 VALUES (?, ?, ?, ?, ?, ?)''',
-              (guild_id, user_id, role_id, amount, datetime.now().isoformat(), paid_by))
-
-    # Обновляем время последней выплаты для роли
-    c.execute('UPDATE role_salaries SET last_paid = ? WHERE guild_id = ? AND role_id = ?',
-              (datetime.now().isoformat(), guild_id, role_id))
-
-    conn.commit()
-    conn.close()
+    amount = Money.from_major(amount)
+    with db.transaction() as c:
+        c.execute('''INSERT INTO salary_history (guild_id, user_id, role_id, amount, paid_at, paid_by)
+                     VALUES (?, ?, ?, ?, ?, ?)''',
+                  (guild_id, user_id, role_id, amount, datetime.now().isoformat(), paid_by))
+
+        # Обновляем время последней выплаты для роли
+        c.execute('UPDATE role_salaries SET last_paid = ? WHERE guild_id = ? AND role_id = ?',
+                  (datetime.now().isoformat(), guild_id, role_id))
+
+
+def pay_role_salaries(guild_id: int, payouts: List[Tuple[int, Amount, List[int]]],
+                      default_balance: Amount = 1000.0, paid_by: str = "system") -> Tuple[int, Money]:
+    """Выплатить зарплаты нескольких ролей сервера одной транзакцией.
+
+    payouts — (role_id, зарплата, участники роли). Балансы, журнал и история выплат
+    пишутся через executemany, last_paid ставится один раз на роль.
+    Возвращает количество выплат и их общую сумму.
+    """
+    now = datetime.now().isoformat()
+    default_balance = Money.from_major(default_balance)
+    credits: Dict[int, Money] = {}
+    history = []
+    entries = []
+    paid_roles = []
+    for role_id, amount, member_ids in payouts:
+        amount = Money.from_major(amount)
+        if amount <= 0 or not member_ids:
+            continue
+        paid_roles.append((now, guild_id, role_id))
+        for user_id in member_ids:
+            credits[user_id] = credits.get(user_id, Money()) + amount
+            history.append((guild_id, user_id, role_id, amount, now, paid_by))
+            entries.append((user_account(user_id), amount))
+
+    if not history:
+        return 0, Money()
+
+    with db.transaction() as c:
+        # Новые игроки получают стартовый баланс, как в _ensure_user
+        _fill_id_table(c, 'payroll_users', credits)
+        c.execute('''SELECT p.user_id FROM temp.payroll_users p
+                     LEFT JOIN users u ON u.user_id = p.user_id AND u.guild_id = ?
+                     WHERE u.user_id IS NULL''', (guild_id,))
+        new_users = [row[0] for row in c.fetchall()]
+        c.executemany('INSERT INTO users (user_id, guild_id, balance) VALUES (?, ?, ?)',
+                      [(user_id, guild_id, default_balance) for user_id in new_users])
+        post_entries(c, guild_id, MINT_ACCOUNT, [(user_account(user_id), default_balance) for user_id in new_users],
+                     'grant', memo='Стартовый баланс')
+
+        c.executemany('UPDATE users SET balance = balance + ? WHERE user_id = ? AND guild_id = ?',
+                      [(amount, user_id, guild_id) for user_id, amount in credits.items()])
+        post_entries(c, guild_id, MINT_ACCOUNT, entries, 'salary', memo='Зарплата по роли')
+        c.executemany('''INSERT INTO salary_history (guild_id, user_id, role_id, amount, paid_at, paid_by)
+                         VALUES (?, ?, ?, ?, ?, ?)''', history)
+        c.executemany('UPDATE role_salaries SET last_paid = ? WHERE guild_id = ? AND role_id = ?', paid_roles)
+
+        c.execute('''SELECT u.user_id, u.balance FROM temp.payroll_users p
+                     JOIN users u ON u.user_id = p.user_id AND u.guild_id = ?''', (guild_id,))
+        for user_id, balance in c.fetchall():
+            _track_balance(guild_id, user_id, Money.from_db(balance))
+
+    return len(history), sum((row[3] for row in history), Money())
 
 
 def get_salary_history(guild_id: int, limit: int = 20) -> List[tuple]:
     """Получить историю выплат зарплат"""
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('''SELECT sh.*, rs.salary_amount 
-                 FROM salary_history sh
-                 LEFT JOIN role_salaries rs ON sh.role_id = rs.role_id AND sh.guild_id = rs.guild_id
-                 WHERE sh.guild_id = ?
-                 ORDER BY sh.paid_at DESC LIMIT ?''', (guild_id, limit))
-    history = c.fetchall()
-    conn.close()
-    return history
-
-
-# Функции для ожидающих переводов
-def create_pending_transfer(guild_id: int, from_user_id: int, to_user_id: Optional[int],
-                            to_faction_id: Optional[int], amount: float, transfer_type: str) -> int:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-
-    expires_at = datetime.now().timestamp() + 300
-
-    c.execute('''INSERT INTO pending_transfers 
-                 (guild_id, from_user_id, to_user_id, to_faction_id, amount, type, created_at, expires_at)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (guild_id, from_user_id, to_user_id, to_faction_id, amount, transfer_type,
-               datetime.now().isoformat(), expires_at))
-
-    transfer_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return transfer_id
-
-
-def get_pending_transfer(transfer_id: int):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM pending_transfers WHERE transfer_id = ?', (transfer_id,))
-    result = c.fetchone()
-    conn.close()
-    return result
-
-
-def delete_pending_transfer(transfer_id: int):
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM pending_transfers WHERE transfer_id = ?', (transfer_id,))
-    conn.commit()
-    conn.close()
+    with db.cursor() as c:
+        c.execute('''SELECT sh.*, rs.salary_amount
+                     FROM salary_history sh
+                     LEFT JOIN role_salaries rs ON sh.role_id = rs.role_id AND sh.guild_id = rs.guild_id
+                     WHERE sh.guild_id = ?
+                     ORDER BY sh.paid_at DESC LIMIT ?''', (guild_id, limit))
+        return [_with_money(row, 4, 7) for row in c.fetchall()]
+
+
+# Ожидающие переводы
+def clear_pending_transfers() -> int:
+    """Удалить все ожидающие переводы из таблицы (при запуске). Возвращает число удаленных"""
+    with db.transaction() as c:
+        c.execute('DELETE FROM pending_transfers')
+        return c.rowcount
+
+
+# Служебные значения
+def get_meta(key: str) -> Optional[str]:
+    with db.cursor() as c:
+        c.execute('SELECT value FROM meta WHERE key = ?', (key,))
+        result = c.fetchone()
+    return result[0] if result else None
 
 
-def cleanup_expired_transfers() -> int:
-    conn = sqlite3.connect('economy.db')
-    c = conn.cursor()
-    now = datetime.now().timestamp()
-    c.execute('DELETE FROM pending_transfers WHERE expires_at < ?', (now,))
-    deleted = c.rowcount
-    conn.commit()
-    conn.close()
-    return deleted
+def set_meta(key: str, value: str):
+    with db.transaction() as c:
+        c.execute('''INSERT INTO meta (key, value, updated_at) VALUES (?, ?, ?)
+                     ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at''',
+                  (key, value, datetime.now().isoformat()))
+
+
+# Функции фоновых задач
+def register_job(name: str, interval_seconds: float, jitter_seconds: float, first_run_at: float) -> float:
+    """Добавить задачу или обновить ее интервал. Возвращает сохраненное время следующего запуска"""
+    with db.transaction() as c:
+        c.execute('''INSERT INTO jobs (name, interval_seconds, jitter_seconds, next_run_at)
+                     VALUES (?, ?, ?, ?)
+                     ON CONFLICT (name) DO UPDATE SET interval_seconds = excluded.interval_seconds,
+                                                      jitter_seconds = excluded.jitter_seconds''',
+                  (name, interval_seconds, jitter_seconds, first_run_at))
+        c.execute('SELECT next_run_at FROM jobs WHERE name = ?', (name,))
+        return c.fetchone()[0]
+
+
+def record_job_run(name: str, started_at: float, duration: float, next_run_at: float,
+                   error: Optional[str] = None):
+    """Записать результат запуска задачи и время следующего"""
+    with db.transaction() as c:
+        c.execute('''UPDATE jobs SET next_run_at = ?, last_run_at = ?, last_duration = ?,
+                                    max_duration = MAX(max_duration, ?), total_duration = total_duration + ?,
+                                    run_count = run_count + 1, failure_count = failure_count + ?,
+                                    last_error = ?
+                     WHERE name = ?''',
+                  (next_run_at, started_at, duration, duration, duration, 1 if error else 0, error, name))
+
+
+def get_jobs() -> List[tuple]:
+    """Задачи: (name, interval_seconds, next_run_at, last_run_at, last_duration,
+    max_duration, total_duration, run_count, failure_count, last_error)"""
+    with db.cursor() as c:
+        c.execute('''SELECT name, interval_seconds, next_run_at, last_run_at, last_duration,
+                            max_duration, total_duration, run_count, failure_count, last_error
+                     FROM jobs ORDER BY name''')
+        return c.fetchall()
+
+
+# Функции журнала операций
+def get_account_history(guild_id: int, account: str, before_id: Optional[int] = None,
+                        limit: int = 10) -> List[tuple]:
+    """История счета от новых к старым, постранично по id (before_id — id последней строки предыдущей страницы).
+
+    Возвращает (id, amount, kind, memo, actor_id, created_at, counterparty).
+    """
+    with db.cursor() as c:
+        c.execute('''SELECT l.id, l.amount, l.kind, l.memo, l.actor_id, l.created_at,
+                            (SELECT o.account FROM ledger o
+                             WHERE o.entry_id = l.entry_id AND o.id != l.id) AS counterparty
+                     FROM ledger l
+                     WHERE l.guild_id = ? AND l.account = ? AND l.id < ?
+                     ORDER BY l.id DESC LIMIT ?''',
+                  (guild_id, account, before_id if before_id is not None else 2 ** 63 - 1, limit))
+        return [_with_money(row, 1) for row in c.fetchall()]
+
+
+def _ledger_balances(c, guild_id: int) -> Tuple[Dict[str, int], Dict[str, int], int]:
+    """Балансы счетов сервера по журналу: последние снимки плюс хвост после них.
+
+    Каждый снимок сервера содержит все счета, изменившиеся с предыдущего,
+    поэтому хвост — это строки журнала после последнего снимка сервера.
+    Возвращает (балансы, изменения в хвосте, id последней учтенной строки); суммы в минимальных единицах.
+    """
+    c.execute('SELECT COALESCE(MAX(ledger_id), 0) FROM balance_snapshots WHERE guild_id = ?', (guild_id,))
+    since = c.fetchone()[0]
+    c.execute('SELECT COALESCE(MAX(id), 0) FROM ledger')
+    upto_id = c.fetchone()[0]
+
+    c.execute('''SELECT s.account, s.balance FROM balance_snapshots s
+                 WHERE s.guild_id = ? AND s.ledger_id = (SELECT MAX(ledger_id) FROM balance_snapshots
+                                                         WHERE guild_id = s.guild_id AND account = s.account)''',
+              (guild_id,))
+    balances: Dict[str, int] = dict(c.fetchall())
+
+    # Диапазон по первичному ключу; +guild_id не дает выбрать индекс по всему серверу
+    c.execute('''SELECT account, SUM(amount) FROM ledger
+                 WHERE id > ? AND id <= ? AND +guild_id = ?
+                 GROUP BY account''', (since, upto_id, guild_id))
+    tail: Dict[str, int] = dict(c.fetchall())
+    for account, amount in tail.items():
+        balances[account] = balances.get(account, 0) + amount
+    return balances, tail, upto_id
+
+
+def take_balance_snapshot(guild_id: int) -> int:
+    """Записать снимок балансов счетов сервера, изменившихся с прошлого снимка. Возвращает их число"""
+    with db.transaction() as c:
+        balances, tail, upto_id = _ledger_balances(c, guild_id)
+        if not tail:
+            return 0
+
+        now = datetime.now().isoformat()
+        c.executemany('''INSERT INTO balance_snapshots (guild_id, account, balance, ledger_id, taken_at)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      [(guild_id, account, balances[account], upto_id, now) for account in tail])
+    return len(tail)
+
+
+def take_all_balance_snapshots() -> int:
+    """Снимки балансов по всем серверам"""
+    with db.cursor() as c:
+        c.execute('SELECT DISTINCT guild_id FROM users UNION SELECT DISTINCT guild_id FROM factions')
+        guild_ids = [row[0] for row in c.fetchall()]
+    return sum(take_balance_snapshot(guild_id) for guild_id in guild_ids)
+
+
+def rebuild_account_balance(guild_id: int, account: str) -> Money:
+    """Баланс счета по журналу: последний снимок плюс строки после него"""
+    with db.cursor() as c:
+        c.execute('''SELECT balance, ledger_id FROM balance_snapshots
+                     WHERE guild_id = ? AND account = ?
+                     ORDER BY ledger_id DESC LIMIT 1''', (guild_id, account))
+        snapshot = c.fetchone()
+        balance, since = snapshot if snapshot else (0, 0)
+        c.execute('SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE guild_id = ? AND account = ? AND id > ?',
+                  (guild_id, account, since))
+        return Money.from_db(balance + c.fetchone()[0])
+
+
+def verify_ledger(guild_id: int) -> List[Tuple[str, Money, Money]]:
+    """Сверка балансов с журналом. Возвращает расхождения (счет, баланс в таблице, баланс по журналу)"""
+    with db.read_transaction() as c:
+        ledger_balances, _, _ = _ledger_balances(c, guild_id)
+
+        c.execute('SELECT user_id, balance FROM users WHERE guild_id = ?', (guild_id,))
+        stored = {user_account(user_id): balance or 0 for user_id, balance in c.fetchall()}
+        c.execute('SELECT faction_id, balance FROM factions WHERE guild_id = ?', (guild_id,))
+        stored.update({faction_account(faction_id): balance or 0 for faction_id, balance in c.fetchall()})
+
+    # Суммы целые, поэтому сравнение точное
+    mismatches = []
+    for account in sorted((set(stored) | set(ledger_balances)) - {MINT_ACCOUNT}):
+        stored_balance = stored.get(account, 0)
+        ledger_balance = ledger_balances.get(account, 0)
+        if stored_balance != ledger_balance:
+            mismatches.append((account, Money.from_db(stored_balance), Money.from_db(ledger_balance)))
+    return mismatches
 
 
 # Вспомогательные функции
@@ -530,9 +1044,15 @@ def hex_to_color(hex_color: str) -> discord.Color:
 
 def get_formatted_settings(guild_id: int):
     """Получение форматированных настроек интерфейса"""
-    settings = get_ui_settings(guild_id)
-    return {
-        'color': hex_to_color(settings['color_hex']),
-        'footer': settings['footer'],
-        'admin_channel': settings['admin_channel']
-    }
\ No newline at end of file
+    settings = get_cached_settings(guild_id)
+    if settings is None:
+        generation = _settings_cache.generation(guild_id)
+        settings = _format_settings(get_ui_settings(guild_id))
+        # Если настройки сохранили во время чтения, кэш уже содержит более новые
+        _settings_cache.store(guild_id, settings, generation)
+        settings = dict(settings)
+    return settings
+
+
+# Замер времени и ошибок всех функций модуля (смотреть: админ метрики, /metrics)
+metrics.instrument_module(globals())
\ No newline at end of file
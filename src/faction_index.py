@@ -0,0 +1,121 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from discord import app_commands
+
+from migrations import faction_name_key
+
+# Префиксное дерево названий фракций по серверам. Используется для автодополнения
+# в слэш-командах, чтобы каждое нажатие клавиши не обращалось к SQLite.
+
+MAX_CHOICES = 25  # Discord показывает не больше 25 вариантов
+MAX_CHOICE_LENGTH = 100  # и отклоняет весь ответ, если имя или значение варианта длиннее 100 символов
+
+
+class _Node:
+    __slots__ = ('children', 'factions')
+
+    def __init__(self):
+        self.children: Dict[str, '_Node'] = {}
+        self.factions: Dict[int, str] = {}  # faction_id -> название, заканчивающееся в этом узле
+
+
+class FactionNameTrie:
+    """Префиксное дерево названий фракций одного сервера"""
+
+    def __init__(self):
+        self._root = _Node()
+        self._names: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add(self, faction_id: int, name: str):
+        if faction_id in self._names:
+            self.remove(faction_id)
+        node = self._root
+        for char in faction_name_key(name):
+            node = node.children.setdefault(char, _Node())
+        node.factions[faction_id] = name
+        self._names[faction_id] = name
+
+    def remove(self, faction_id: int):
+        name = self._names.pop(faction_id, None)
+        if name is None:
+            return
+        path = [self._root]
+        key = faction_name_key(name)
+        for char in key:
+            path.append(path[-1].children[char])
+        del path[-1].factions[faction_id]
+        # Удаляем опустевшие узлы снизу вверх
+        for depth in range(len(key), 0, -1):
+            node = path[depth]
+            if node.factions or node.children:
+                break
+            del path[depth - 1].children[key[depth - 1]]
+
+    def complete(self, prefix: str, limit: int = MAX_CHOICES) -> List[Tuple[int, str]]:
+        """Фракции, название которых начинается с prefix: короткие раньше, затем по алфавиту"""
+        node = self._root
+        for char in faction_name_key(prefix):
+            node = node.children.get(char)
+            if node is None:
+                return []
+
+        # Обход в ширину дает названия в порядке длины; внутри уровня — по алфавиту
+        results: List[Tuple[int, str]] = []
+        level = [node]
+        while level and len(results) < limit:
+            next_level = []
+            for current in level:
+                for faction_id, name in sorted(current.factions.items(), key=lambda item: (item[1], item[0])):
+                    results.append((faction_id, name))
+                    if len(results) >= limit:
+                        return results
+                next_level.extend(current.children[char] for char in sorted(current.children))
+            level = next_level
+        return results
+
+
+class FactionIndex:
+    """Деревья названий фракций по всем серверам"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._guilds: Dict[int, FactionNameTrie] = {}
+
+    def load(self, rows: Iterable[Tuple[int, int, str]]):
+        """Полностью перестроить индекс из строк (faction_id, guild_id, name)"""
+        guilds: Dict[int, FactionNameTrie] = {}
+        for faction_id, guild_id, name in rows:
+            guilds.setdefault(guild_id, FactionNameTrie()).add(faction_id, name)
+        with self._lock:
+            self._guilds = guilds
+
+    def add(self, guild_id: int, faction_id: int, name: str):
+        """Добавить фракцию или обновить ее название"""
+        with self._lock:
+            self._guilds.setdefault(guild_id, FactionNameTrie()).add(faction_id, name)
+
+    def remove(self, guild_id: int, faction_id: int):
+        with self._lock:
+            trie = self._guilds.get(guild_id)
+            if trie is not None:
+                trie.remove(faction_id)
+
+    def complete(self, guild_id: Optional[int], prefix: str, limit: int = MAX_CHOICES) -> List[Tuple[int, str]]:
+        with self._lock:
+            trie = self._guilds.get(guild_id)
+            return trie.complete(prefix, limit) if trie is not None else []
+
+
+faction_index = FactionIndex()
+
+
+async def faction_name_autocomplete(interaction, current: str) -> List[app_commands.Choice[str]]:
+    """Автодополнение параметра «название» из индекса в памяти"""
+    # Название длиннее предела нельзя передать значением варианта, такие фракции не предлагаются
+    return [app_commands.Choice(name=name, value=name)
+            for _, name in faction_index.complete(interaction.guild_id, current)
+            if len(name) <= MAX_CHOICE_LENGTH]
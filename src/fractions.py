@@ -2,13 +2,19 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 from typing import Optional
-from database import (
-    get_user_faction, get_faction_by_name, get_formatted_settings,
-    create_faction, get_faction_members, hex_to_color, get_all_factions,
-    get_faction_balance, update_faction_balance, create_pending_transfer,
-    get_pending_transfer, delete_pending_transfer, get_balance, update_balance
+from async_db import (
+    auto_defer, get_user_faction, get_faction_by_name, get_formatted_settings,
+    create_faction, get_faction_members, get_all_factions, get_faction_members_page, get_factions_page,
+    get_guild_stats,
+    get_faction_balance, update_faction_balance, get_balance, get_balances, update_balance,
+    get_faction_member_count, get_faction_top_members, join_faction, leave_faction,
+    transfer
 )
-import sqlite3
+from database import hex_to_color, TransferNotFound, InsufficientFunds
+from faction_index import faction_name_autocomplete
+from money import Money
+from pending_transfers import pending_transfers
+from paginator import Paginator, send_paginated
 from datetime import datetime
 
 
@@ -38,17 +44,12 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
     @faction.command(name="создать", description="Создать новую фракцию")
     @app_commands.describe(название="Название фракции", описание="Описание фракции",
                            цвет="Цвет в формате HEX (например, FF0000)")
+    @auto_defer()
     async def create_faction_cmd(ctx, название: str, описание: Optional[str] = None, цвет: Optional[str] = None):
         try:
-            conn = sqlite3.connect('economy.db')
-            c = conn.cursor()
-
             # Проверяем, не состоит ли пользователь уже во фракции
-            c.execute('SELECT faction_id FROM faction_members WHERE user_id = ? AND guild_id = ?',
-                      (ctx.author.id, ctx.guild.id))
-            if c.fetchone():
+            if await get_user_faction(ctx.author.id, ctx.guild.id):
                 await ctx.send("❌ Вы уже состоите во фракции!", ephemeral=True)
-                conn.close()
                 return
 
             # Проверяем валидность HEX цвета
@@ -57,7 +58,7 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                 цвет_hex = "3498db"
 
             # Создаем фракцию через функцию из database
-            faction_id = create_faction(
+            faction_id = await create_faction(
                 guild_id=ctx.guild.id,
                 name=название,
                 leader_id=ctx.author.id,
@@ -65,9 +66,7 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                 color=цвет_hex
             )
 
-            conn.close()
-
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
             embed = discord.Embed(
                 title="✅ Фракция создана",
                 description=f"**Название:** {название}\n**Лидер:** {ctx.author.mention}",
@@ -86,42 +85,28 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
 
     @faction.command(name="информация", description="Информация о фракции")
     @app_commands.describe(название="Название фракции (оставьте пустым для своей фракции)")
+    @app_commands.autocomplete(название=faction_name_autocomplete)
+    @auto_defer()
     async def faction_info(ctx, название: Optional[str] = None):
         try:
-            conn = sqlite3.connect('economy.db')
-            c = conn.cursor()
-
             if название:
-                c.execute('''SELECT f.*, COUNT(fm.user_id) as members 
-                             FROM factions f 
-                             LEFT JOIN faction_members fm ON f.faction_id = fm.faction_id
-                             WHERE f.guild_id = ? AND LOWER(f.name) LIKE LOWER(?)
-                             GROUP BY f.faction_id''',
-                          (ctx.guild.id, f"%{название}%"))
+                faction = await get_faction_by_name(ctx.guild.id, название)
             else:
                 # Ищем фракцию пользователя
-                c.execute('''SELECT f.*, COUNT(fm2.user_id) as members 
-                             FROM factions f
-                             JOIN faction_members fm ON f.faction_id = fm.faction_id
-                             LEFT JOIN faction_members fm2 ON f.faction_id = fm2.faction_id
-                             WHERE fm.user_id = ? AND f.guild_id = ?
-                             GROUP BY f.faction_id''',
-                          (ctx.author.id, ctx.guild.id))
-
-            faction = c.fetchone()
-            conn.close()
+                faction = await get_user_faction(ctx.author.id, ctx.guild.id)
 
             if not faction:
                 await ctx.send("❌ Фракция не найдена!", ephemeral=True)
                 return
 
             (faction_id, guild_id, name, balance, leader_id, color, created_at,
-             description, role_id, is_role_based, members_count) = faction
+             description, role_id, is_role_based) = faction
+            members_count = await get_faction_member_count(faction_id)
 
             # Получаем лидера
             leader = ctx.guild.get_member(leader_id) if leader_id != 0 else None
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
             color_obj = hex_to_color(color) if color else settings['color']
 
             embed = discord.Embed(
@@ -156,17 +141,7 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
             # Для обычных фракций показываем топ участников
             if not is_role_based:
                 # Получаем топ-3 участников по балансу
-                conn = sqlite3.connect('economy.db')
-                c = conn.cursor()
-                c.execute('''SELECT fm.user_id, u.balance 
-                             FROM faction_members fm
-                             JOIN users u ON fm.user_id = u.user_id AND fm.guild_id = u.guild_id
-                             WHERE fm.faction_id = ?
-                             ORDER BY u.balance DESC LIMIT 3''',
-                          (faction_id,))
-
-                top_members = c.fetchall()
-                conn.close()
+                top_members = await get_faction_top_members(faction_id, 3)
 
                 if top_members:
                     members_text = ""
@@ -187,136 +162,87 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
 
     @faction.command(name="участники", description="Участники фракции")
     @app_commands.describe(название="Название фракции (оставьте пустым для своей фракции)")
+    @app_commands.autocomplete(название=faction_name_autocomplete)
+    @auto_defer()
     async def faction_members(ctx, название: Optional[str] = None):
         try:
-            conn = sqlite3.connect('economy.db')
-            c = conn.cursor()
-
             if название:
-                c.execute('''SELECT f.faction_id, f.name, f.leader_id, f.is_role_based, f.role_id
-                             FROM factions f 
-                             WHERE f.guild_id = ? AND LOWER(f.name) LIKE LOWER(?)''',
-                          (ctx.guild.id, f"%{название}%"))
+                faction = await get_faction_by_name(ctx.guild.id, название)
             else:
-                c.execute('''SELECT f.faction_id, f.name, f.leader_id, f.is_role_based, f.role_id
-                             FROM factions f
-                             JOIN faction_members fm ON f.faction_id = fm.faction_id
-                             WHERE fm.user_id = ? AND f.guild_id = ?''',
-                          (ctx.author.id, ctx.guild.id))
-
-            faction = c.fetchone()
+                faction = await get_user_faction(ctx.author.id, ctx.guild.id)
 
             if not faction:
                 await ctx.send("❌ Фракция не найдена!", ephemeral=True)
-                conn.close()
                 return
 
-            faction_id, faction_name, leader_id, is_role_based, role_id = faction
+            faction_id, faction_name, leader_id = faction[0], faction[2], faction[4]
+            role_id, is_role_based = faction[8], faction[9]
+
+            members_per_page = 10
 
             if is_role_based and role_id:
                 # Для ролевой фракции показываем всех пользователей с этой ролью
                 role = ctx.guild.get_role(role_id)
                 if not role:
                     await ctx.send("❌ Роль, привязанная к фракции, не найдена!", ephemeral=True)
-                    conn.close()
                     return
 
-                members = [member for member in ctx.guild.members if role in member.roles]
+                members = role.members
 
                 if not members:
                     await ctx.send("❌ В фракции нет участников с этой ролью!", ephemeral=True)
-                    conn.close()
                     return
 
-                # Разбиваем на страницы (по 10 участников на страницу)
-                members_per_page = 10
-                pages = []
+                total_pages = ((len(members) - 1) // members_per_page) + 1
 
-                for i in range(0, len(members), members_per_page):
-                    page_members = members[i:i + members_per_page]
+                # Ключ страницы — позиция в списке роли; балансы страницы читаются одним запросом
+                async def fetch_role_members(after: Optional[int], limit: int):
+                    start = 0 if after is None else after + 1
+                    page_members = members[start:start + limit]
+                    balances = await get_balances(ctx.guild.id, [member.id for member in page_members],
+                                                  DEFAULT_BALANCE)
+                    return [(start + offset, member, balances[member.id])
+                            for offset, member in enumerate(page_members)]
 
+                def render_role_members(rows, page: int) -> discord.Embed:
                     embed = discord.Embed(
                         title=f"👥 Участники фракции {faction_name} (ролевая)",
                         color=discord.Color.blue()
                     )
 
-                    for member in page_members:
-                        balance = get_balance(member.id, ctx.guild.id, DEFAULT_BALANCE)
+                    for _, member, balance in rows:
                         embed.add_field(
                             name=f"**{member.display_name}**",
                             value=f"Баланс: {balance:.2f}{CURRENCY}",
                             inline=False
                         )
 
-                    total_pages = ((len(members) - 1) // members_per_page) + 1
-                    current_page = (i // members_per_page) + 1
-                    embed.set_footer(text=f"Страница {current_page}/{total_pages} | Всего участников: {len(members)}")
-                    pages.append(embed)
+                    embed.set_footer(text=f"Страница {page}/{total_pages} | Всего участников: {len(members)}")
+                    return embed
 
-                if len(pages) == 1:
-                    await ctx.send(embed=pages[0])
-                else:
-                    current_page_idx = 0
-
-                    class MembersView(discord.ui.View):
-                        def __init__(self, timeout=120):
-                            super().__init__(timeout=timeout)
-
-                        @discord.ui.button(label="⬅️ Назад", style=discord.ButtonStyle.secondary, disabled=True)
-                        async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-                            nonlocal current_page_idx
-                            if interaction.user != ctx.author:
-                                await interaction.response.send_message(
-                                    "❌ Только автор команды может листать страницы!", ephemeral=True)
-                                return
-
-                            current_page_idx -= 1
-                            self.update_buttons()
-                            await interaction.response.edit_message(embed=pages[current_page_idx], view=self)
-
-                        @discord.ui.button(label="Вперед ➡️", style=discord.ButtonStyle.secondary)
-                        async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-                            nonlocal current_page_idx
-                            if interaction.user != ctx.author:
-                                await interaction.response.send_message(
-                                    "❌ Только автор команды может листать страницы!", ephemeral=True)
-                                return
-
-                            current_page_idx += 1
-                            self.update_buttons()
-                            await interaction.response.edit_message(embed=pages[current_page_idx], view=self)
-
-                        def update_buttons(self):
-                            self.prev_button.disabled = current_page_idx == 0
-                            self.next_button.disabled = current_page_idx == len(pages) - 1
-
-                    view = MembersView()
-                    await ctx.send(embed=pages[0], view=view)
-
-                conn.close()
+                await send_paginated(ctx, Paginator(fetch_role_members, lambda row: row[0],
+                                                    render_role_members, members_per_page))
                 return
 
             # Для обычной фракции
-            members = get_faction_members(faction_id)
+            members_count = await get_faction_member_count(faction_id)
 
-            if not members:
+            if not members_count:
                 await ctx.send("❌ В фракции нет участников!", ephemeral=True)
-                conn.close()
                 return
 
-            # Разбиваем на страницы (по 10 участников на страницу)
-            members_per_page = 10
-            pages = []
+            total_pages = ((members_count - 1) // members_per_page) + 1
 
-            for i in range(0, len(members), members_per_page):
-                page_members = members[i:i + members_per_page]
+            async def fetch_members(after: Optional[int], limit: int):
+                return await get_faction_members_page(faction_id, after, limit)
 
+            def render_members(rows, page: int) -> discord.Embed:
                 embed = discord.Embed(
                     title=f"👥 Участники фракции {faction_name}",
                     color=discord.Color.blue()
                 )
 
-                for user_id, role, joined_at, balance in page_members:
+                for user_id, role, joined_at, balance in rows:
                     user = ctx.guild.get_member(user_id)
                     if user:
                         member_text = f"**{user.display_name}**"
@@ -336,60 +262,21 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                             inline=False
                         )
 
-                total_pages = ((len(members) - 1) // members_per_page) + 1
-                current_page = (i // members_per_page) + 1
-                embed.set_footer(text=f"Страница {current_page}/{total_pages} | Всего участников: {len(members)}")
-                pages.append(embed)
+                embed.set_footer(text=f"Страница {page}/{total_pages} | Всего участников: {members_count}")
+                return embed
 
-            if len(pages) == 1:
-                await ctx.send(embed=pages[0])
-            else:
-                current_page_idx = 0
-
-                class MembersView(discord.ui.View):
-                    def __init__(self, timeout=120):
-                        super().__init__(timeout=timeout)
-
-                    @discord.ui.button(label="⬅️ Назад", style=discord.ButtonStyle.secondary, disabled=True)
-                    async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-                        nonlocal current_page_idx
-                        if interaction.user != ctx.author:
-                            await interaction.response.send_message("❌ Только автор команды может листать страницы!",
-                                                                    ephemeral=True)
-                            return
-
-                        current_page_idx -= 1
-                        self.update_buttons()
-                        await interaction.response.edit_message(embed=pages[current_page_idx], view=self)
-
-                    @discord.ui.button(label="Вперед ➡️", style=discord.ButtonStyle.secondary)
-                    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-                        nonlocal current_page_idx
-                        if interaction.user != ctx.author:
-                            await interaction.response.send_message("❌ Только автор команды может листать страницы!",
-                                                                    ephemeral=True)
-                            return
-
-                        current_page_idx += 1
-                        self.update_buttons()
-                        await interaction.response.edit_message(embed=pages[current_page_idx], view=self)
-
-                    def update_buttons(self):
-                        self.prev_button.disabled = current_page_idx == 0
-                        self.next_button.disabled = current_page_idx == len(pages) - 1
-
-                view = MembersView()
-                await ctx.send(embed=pages[0], view=view)
+            await send_paginated(ctx, Paginator(fetch_members, lambda row: row[0], render_members, members_per_page))
         except Exception as e:
             print(f"Ошибка в команде фракция участники: {e}")
             await ctx.send("❌ Произошла ошибка при получении списка участников", ephemeral=True)
 
     @faction.command(name="список", description="Список всех фракций на сервере")
+    @auto_defer()
     async def faction_list(ctx):
         try:
-            factions = get_all_factions(ctx.guild.id)
+            faction_count = (await get_guild_stats(ctx.guild.id))['faction_count']
 
-            if not factions:
+            if not faction_count:
                 embed = discord.Embed(
                     title="🏛️ Фракции сервера",
                     description="На сервере еще нет фракций",
@@ -398,20 +285,21 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                 await ctx.send(embed=embed)
                 return
 
-            # Разбиваем на страницы (по 5 фракций на страницу)
+            # По 5 фракций на страницу, страницы читаются по ключу (название, faction_id)
             factions_per_page = 5
-            pages = []
+            total_pages = ((faction_count - 1) // factions_per_page) + 1
 
-            for i in range(0, len(factions), factions_per_page):
-                page_factions = factions[i:i + factions_per_page]
+            async def fetch_factions(after: Optional[tuple], limit: int):
+                return await get_factions_page(ctx.guild.id, after, limit)
 
+            def render_factions(rows, page: int) -> discord.Embed:
                 embed = discord.Embed(
                     title="🏛️ Фракции сервера",
                     color=discord.Color.blue()
                 )
 
                 for (faction_id, guild_id, name, balance, leader_id, color,
-                     created_at, description, role_id, is_role_based, member_count) in page_factions:
+                     created_at, description, role_id, is_role_based, member_count) in rows:
 
                     leader = ctx.guild.get_member(leader_id) if leader_id != 0 else None
 
@@ -434,50 +322,11 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
 
                     embed.add_field(name=f"🏛️ {name}", value=faction_info, inline=False)
 
-                total_pages = ((len(factions) - 1) // factions_per_page) + 1
-                current_page = (i // factions_per_page) + 1
-                embed.set_footer(text=f"Страница {current_page}/{total_pages} | Всего фракций: {len(factions)}")
-                pages.append(embed)
+                embed.set_footer(text=f"Страница {page}/{total_pages} | Всего фракций: {faction_count}")
+                return embed
 
-            if len(pages) == 1:
-                await ctx.send(embed=pages[0])
-            else:
-                current_page_idx = 0
-
-                class FactionListView(discord.ui.View):
-                    def __init__(self, timeout=120):
-                        super().__init__(timeout=timeout)
-
-                    @discord.ui.button(label="⬅️ Назад", style=discord.ButtonStyle.secondary, disabled=True)
-                    async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-                        nonlocal current_page_idx
-                        if interaction.user != ctx.author:
-                            await interaction.response.send_message("❌ Только автор команды может листать страницы!",
-                                                                    ephemeral=True)
-                            return
-
-                        current_page_idx -= 1
-                        self.update_buttons()
-                        await interaction.response.edit_message(embed=pages[current_page_idx], view=self)
-
-                    @discord.ui.button(label="Вперед ➡️", style=discord.ButtonStyle.secondary)
-                    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-                        nonlocal current_page_idx
-                        if interaction.user != ctx.author:
-                            await interaction.response.send_message("❌ Только автор команды может листать страницы!",
-                                                                    ephemeral=True)
-                            return
-
-                        current_page_idx += 1
-                        self.update_buttons()
-                        await interaction.response.edit_message(embed=pages[current_page_idx], view=self)
-
-                    def update_buttons(self):
-                        self.prev_button.disabled = current_page_idx == 0
-                        self.next_button.disabled = current_page_idx == len(pages) - 1
-
-                view = FactionListView()
-                await ctx.send(embed=pages[0], view=view)
+            await send_paginated(ctx, Paginator(fetch_factions, lambda row: (row[2], row[0]),
+                                                render_factions, factions_per_page))
 
         except Exception as e:
             print(f"Ошибка в команде фракция список: {e}")
@@ -485,10 +334,12 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
 
     @faction.command(name="вступить", description="Вступить во фракцию")
     @app_commands.describe(название="Название фракции для вступления")
+    @app_commands.autocomplete(название=faction_name_autocomplete)
+    @auto_defer()
     async def faction_join(ctx, название: str):
         try:
             # Находим фракцию
-            faction = get_faction_by_name(ctx.guild.id, название)
+            faction = await get_faction_by_name(ctx.guild.id, название)
             if not faction:
                 await ctx.send("❌ Фракция не найдена!", ephemeral=True)
                 return
@@ -501,32 +352,18 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                                ephemeral=True)
                 return
 
-            conn = sqlite3.connect('economy.db')
-            c = conn.cursor()
-
-            # Проверяем, не состоит ли уже пользователь в другой фракции
-            c.execute('SELECT faction_id FROM faction_members WHERE user_id = ? AND guild_id = ?',
-                      (ctx.author.id, ctx.guild.id))
-            existing_faction = c.fetchone()
+            # Добавляем пользователя во фракцию, если он еще не состоит в другой
+            existing_faction_id = await join_faction(ctx.author.id, ctx.guild.id, faction_id)
 
-            if existing_faction:
-                if existing_faction[0] == faction_id:
+            if existing_faction_id is not None:
+                if existing_faction_id == faction_id:
                     await ctx.send("❌ Вы уже состоите в этой фракции!", ephemeral=True)
                 else:
                     await ctx.send("❌ Вы уже состоите в другой фракции! Сначала покиньте текущую фракцию.",
                                    ephemeral=True)
-                conn.close()
                 return
 
-            # Добавляем пользователя во фракцию
-            c.execute('''INSERT INTO faction_members (user_id, guild_id, faction_id, role, joined_at)
-                         VALUES (?, ?, ?, ?, ?)''',
-                      (ctx.author.id, ctx.guild.id, faction_id, 'Участник', datetime.now().isoformat()))
-
-            conn.commit()
-            conn.close()
-
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
             embed = discord.Embed(
                 title="✅ Вы вступили во фракцию",
                 description=f"Теперь вы участник фракции **{faction[2]}**",
@@ -541,42 +378,28 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
             await ctx.send("❌ Произошла ошибка при вступлении во фракцию", ephemeral=True)
 
     @faction.command(name="покинуть", description="Покинуть фракцию")
+    @auto_defer()
     async def faction_leave(ctx):
         try:
-            conn = sqlite3.connect('economy.db')
-            c = conn.cursor()
-
             # Получаем фракцию пользователя
-            c.execute('''SELECT f.faction_id, f.name, f.leader_id 
-                         FROM factions f
-                         JOIN faction_members fm ON f.faction_id = fm.faction_id
-                         WHERE fm.user_id = ? AND f.guild_id = ?''',
-                      (ctx.author.id, ctx.guild.id))
-
-            faction = c.fetchone()
+            faction = await get_user_faction(ctx.author.id, ctx.guild.id)
 
             if not faction:
                 await ctx.send("❌ Вы не состоите во фракции!", ephemeral=True)
-                conn.close()
                 return
 
-            faction_id, faction_name, leader_id = faction
+            faction_id, faction_name, leader_id = faction[0], faction[2], faction[4]
 
             # Проверяем, не лидер ли пользователь
             if leader_id == ctx.author.id:
                 await ctx.send("❌ Лидер не может покинуть фракцию! Сначала передайте лидерство другому участнику.",
                                ephemeral=True)
-                conn.close()
                 return
 
             # Удаляем пользователя из фракции
-            c.execute('DELETE FROM faction_members WHERE user_id = ? AND guild_id = ?',
-                      (ctx.author.id, ctx.guild.id))
+            await leave_faction(ctx.author.id, ctx.guild.id)
 
-            conn.commit()
-            conn.close()
-
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
             embed = discord.Embed(
                 title="✅ Вы покинули фракцию",
                 description=f"Вы больше не состоите в фракции **{faction_name}**",
@@ -593,14 +416,17 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
     # Новая команда для перевода в любую фракцию
     @bot.hybrid_command(name="перевод_фракции", description="Перевести деньги в фракцию")
     @app_commands.describe(название="Название фракции", сумма="Сумма перевода")
+    @app_commands.autocomplete(название=faction_name_autocomplete)
+    @auto_defer()
     async def faction_pay(ctx, название: str, сумма: float):
         try:
+            сумма = Money.from_major(сумма)
             if сумма <= 0:
                 await ctx.send("❌ Сумма должна быть положительной!", ephemeral=True)
                 return
 
             # Ищем фракцию по названию
-            faction_info = get_faction_by_name(ctx.guild.id, название)
+            faction_info = await get_faction_by_name(ctx.guild.id, название)
             if not faction_info:
                 await ctx.send("❌ Фракция не найдена!", ephemeral=True)
                 return
@@ -608,14 +434,14 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
             (faction_id, guild_id, name, faction_balance, leader_id, color,
              created_at, description, role_id, is_role_based) = faction_info
 
-            sender_balance = get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE)
+            sender_balance = await get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE)
 
             if sender_balance < сумма:
                 await ctx.send(f"❌ Недостаточно средств! Ваш баланс: {sender_balance:.2f}{CURRENCY}", ephemeral=True)
                 return
 
             # Создаем ожидающий перевод
-            transfer_id = create_pending_transfer(
+            pending = pending_transfers.create(
                 guild_id=ctx.guild.id,
                 from_user_id=ctx.author.id,
                 to_user_id=None,
@@ -624,12 +450,13 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                 transfer_type='player_to_faction'
             )
 
-            settings = get_formatted_settings(ctx.guild.id)
+            settings = await get_formatted_settings(ctx.guild.id)
 
             class FactionTransferConfirmView(discord.ui.View):
-                def __init__(self, timeout=300):
-                    super().__init__(timeout=timeout)
-                    self.transfer_id = transfer_id
+                def __init__(self):
+                    # Срок подтверждения отслеживает хранилище ожидающих переводов, а не таймер view
+                    super().__init__(timeout=None)
+                    self.transfer_id = pending.transfer_id
 
                 @discord.ui.button(label="✅ Подтвердить перевод", style=discord.ButtonStyle.success, emoji="✅")
                 async def confirm_button(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -638,36 +465,41 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                                                                 ephemeral=True)
                         return
 
-                    # Получаем информацию о переводе
-                    transfer = get_pending_transfer(self.transfer_id)
-                    if not transfer:
+                    try:
+                        # Забираем ожидающий перевод (повторное нажатие получит TransferNotFound)
+                        pending_transfers.take(self.transfer_id)
+
+                        # Выполняем перевод одной транзакцией
+                        sender_new_balance, new_faction_balance = await transfer(
+                            guild_id=ctx.guild.id,
+                            from_user_id=ctx.author.id,
+                            amount=сумма,
+                            to_faction_id=faction_id,
+                            default_balance=DEFAULT_BALANCE
+                        )
+                    except TransferNotFound:
                         await interaction.response.send_message("❌ Перевод не найден или истекло время подтверждения!",
                                                                 ephemeral=True)
                         return
-
-                    # Проверяем баланс снова
-                    current_balance = get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE)
-                    if current_balance < сумма:
+                    except InsufficientFunds as e:
                         await interaction.response.send_message(
-                            f"❌ Недостаточно средств! Текущий баланс: {current_balance:.2f}{CURRENCY}", ephemeral=True)
-                        delete_pending_transfer(self.transfer_id)
+                            f"❌ Недостаточно средств! Текущий баланс: {e.balance:.2f}{CURRENCY}", ephemeral=True)
+                        return
+                    except Exception as e:
+                        print(f"Ошибка при выполнении перевода фракции: {e}")
+                        await interaction.response.send_message("❌ Произошла ошибка при выполнении перевода",
+                                                                ephemeral=True)
                         return
 
                     try:
-                        # Выполняем перевод
-                        update_balance(ctx.author.id, ctx.guild.id, -сумма, DEFAULT_BALANCE)
-                        update_faction_balance(faction_id, сумма)
-                        delete_pending_transfer(self.transfer_id)
-
                         # Обновляем сообщение
-                        new_faction_balance = get_faction_balance(faction_id)
                         embed = discord.Embed(
                             title="✅ Перевод выполнен",
                             description=f"**{ctx.author.display_name}** → **Фракция {name}**\nСумма: **{сумма:.2f}**{CURRENCY}",
                             color=hex_to_color(color) if color else discord.Color.green()
                         )
                         embed.add_field(name="Новый личный баланс",
-                                        value=f"{get_balance(ctx.author.id, ctx.guild.id, DEFAULT_BALANCE):.2f}{CURRENCY}")
+                                        value=f"{sender_new_balance:.2f}{CURRENCY}")
                         embed.add_field(name="Новый баланс фракции",
                                         value=f"{new_faction_balance:.2f}{CURRENCY}")
                         embed.set_footer(text=settings['footer'])
@@ -676,6 +508,7 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                             child.disabled = True
 
                         await interaction.response.edit_message(embed=embed, view=self)
+                        self.stop()
 
                         # Уведомляем лидера фракции (если есть)
                         leader = ctx.guild.get_member(leader_id) if leader_id != 0 else None
@@ -703,7 +536,8 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
                                                                 ephemeral=True)
                         return
 
-                    delete_pending_transfer(self.transfer_id)
+                    pending_transfers.cancel(self.transfer_id)
+                    self.stop()
 
                     embed = discord.Embed(
                         title="❌ Перевод отменен",
@@ -716,9 +550,9 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
 
                     await interaction.response.edit_message(embed=embed, view=self)
 
-                async def on_timeout(self):
+                async def expire(self):
+                    self.stop()
                     try:
-                        delete_pending_transfer(self.transfer_id)
                         embed = discord.Embed(
                             title="⏰ Время истекло",
                             description=f"Подтверждение перевода в казну фракции {name} на сумму {сумма:.2f}{CURRENCY} отменено.",
@@ -743,6 +577,7 @@ def setup_fraction_commands(bot: commands.Bot, config: dict):
             embed.set_footer(text="У вас есть 5 минут на подтверждение")
 
             view = FactionTransferConfirmView()
+            pending.on_expire = view.expire
             message = await ctx.send(embed=embed, view=view)
             view.message = message
         except Exception as e:
@@ -0,0 +1,56 @@
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# Кэш по серверам, который читают потоки чтения, а меняет поток записи.
+# Читатель при промахе запоминает поколение записи до запроса к базе и сохраняет результат,
+# только если поколение не изменилось. Запись после фиксации увеличивает поколение,
+# поэтому данные, прочитанные до фиксации, не могут перезаписать более новые.
+
+
+class GuildCache:
+    """Кэш значений по guild_id с поколениями для защиты от устаревших записей"""
+
+    def __init__(self):
+        self._values: Dict[int, Any] = {}
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, guild_id: int) -> Optional[Any]:
+        return self._values.get(guild_id)
+
+    def generation(self, guild_id: int) -> int:
+        """Поколение записи; берется до чтения из базы и передается в store"""
+        with self._lock:
+            return self._generations.get(guild_id, 0)
+
+    def store(self, guild_id: int, value: Any, generation: int) -> bool:
+        """Сохранить прочитанное значение, если после чтения запись не менялась"""
+        with self._lock:
+            if self._generations.get(guild_id, 0) != generation:
+                return False
+            self._values[guild_id] = value
+            return True
+
+    def setdefault(self, guild_id: int, value: Any) -> Any:
+        with self._lock:
+            return self._values.setdefault(guild_id, value)
+
+    def put(self, guild_id: int, value: Any):
+        """Новое значение от записи (после фиксации)"""
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            self._values[guild_id] = value
+
+    def invalidate(self, guild_id: int):
+        """Сбросить значение после фиксации записи; незавершенные чтения его не вернут"""
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            self._values.pop(guild_id, None)
+
+    def load(self, items: Iterable[Tuple[int, Any]]):
+        """Заменить содержимое целиком (предзагрузка при запуске)"""
+        values = dict(items)
+        with self._lock:
+            for guild_id in set(self._values) | set(values):
+                self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            self._values = values
@@ -0,0 +1,154 @@
+import math
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from aiohttp import web
+from discord.ext import commands
+
+# HTTP-сервер проверки состояния на цикле событий бота (aiohttp входит в зависимости discord.py).
+# /healthz — жив ли процесс и соединение со шлюзом, /readyz — готов ли бот принимать команды,
+# /metrics — метрики в текстовом формате Prometheus.
+
+METRIC_PREFIX = 'discobot_'
+
+# Поставщик метрик возвращает готовые строки текстового формата Prometheus
+MetricsProvider = Callable[[], Iterable[str]]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _number(value: float) -> str:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def metric(name: str, value: float, help_text: str, metric_type: str = 'gauge',
+           labels: Optional[Dict[str, str]] = None) -> List[str]:
+    """Строки одной метрики (с HELP и TYPE)"""
+    name = METRIC_PREFIX + name
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name}{_labels(labels)} {_number(value)}']
+
+
+def metric_family(name: str, help_text: str, metric_type: str, samples: Iterable) -> List[str]:
+    """Строки метрики с несколькими значениями: samples — (метки, значение)"""
+    name = METRIC_PREFIX + name
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+    lines += [f'{name}{_labels(labels)} {_number(value)}' for labels, value in samples]
+    return lines
+
+
+def histogram_family(name: str, help_text: str, bounds: Iterable[float], samples: Iterable) -> List[str]:
+    """Строки гистограммы: samples — (метки, счетчики по корзинам, сумма, количество).
+
+    Счетчики не накопительные, последний — значения больше bounds[-1].
+    """
+    name = METRIC_PREFIX + name
+    bounds = list(bounds)
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for labels, buckets, total, count in samples:
+        cumulative = 0
+        for bound, value in zip(bounds + [float('inf')], buckets):
+            cumulative += value
+            lines.append(f'{name}_bucket{_labels({**labels, "le": _number(float(bound))})} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(float(total))}')
+        lines.append(f'{name}_count{_labels(labels)} {count}')
+    return lines
+
+
+class HealthServer:
+    """Эндпоинты проверки состояния и метрик"""
+
+    def __init__(self, bot: commands.Bot, host: str = '0.0.0.0', port: int = 8080):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.started_at = time.time()
+        self.last_event_at: Optional[float] = None
+        self._providers: List[MetricsProvider] = [self._bot_metrics]
+        self._runner: Optional[web.AppRunner] = None
+
+        bot.add_listener(self._on_socket_event_type, 'on_socket_event_type')
+
+    async def _on_socket_event_type(self, event_type: str):
+        self.last_event_at = time.time()
+
+    def add_metrics(self, provider: MetricsProvider):
+        """Добавить поставщика метрик для /metrics"""
+        self._providers.append(provider)
+
+    def last_event_age(self) -> Optional[float]:
+        return time.time() - self.last_event_at if self.last_event_at is not None else None
+
+    def _latency(self) -> Optional[float]:
+        latency = self.bot.latency
+        return latency if math.isfinite(latency) else None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/', self.home)
+        app.router.add_get('/healthz', self.healthz)
+        app.router.add_get('/readyz', self.readyz)
+        app.router.add_get('/metrics', self.metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"HTTP-сервер состояния запущен на порту {self.port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def home(self, request: web.Request) -> web.Response:
+        return web.Response(text="Bot is alive!")
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        latency = self._latency()
+        age = self.last_event_age()
+        # До первого heartbeat задержка неизвестна: процесс считается живым, пока идет подключение
+        healthy = not self.bot.is_closed() and (latency is not None or not self.bot.is_ready())
+        return web.json_response({
+            'status': 'ok' if healthy else 'unhealthy',
+            'gateway_latency_ms': round(latency * 1000, 1) if latency is not None else None,
+            'last_event_age_s': round(age, 1) if age is not None else None,
+            'uptime_s': round(time.time() - self.started_at, 1),
+        }, status=200 if healthy else 503)
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        ready = self.bot.is_ready() and not self.bot.is_closed()
+        return web.json_response({'ready': ready, 'guilds': len(self.bot.guilds)}, status=200 if ready else 503)
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        lines: List[str] = []
+        for provider in self._providers:
+            try:
+                lines.extend(provider())
+            except Exception as e:
+                print(f"Ошибка при сборе метрик: {e}")
+        return web.Response(text='\n'.join(lines) + '\n', content_type='text/plain', charset='utf-8')
+
+    def _bot_metrics(self) -> List[str]:
+        latency = self._latency()
+        age = self.last_event_age()
+        lines = []
+        lines += metric('up', 0 if self.bot.is_closed() else 1, 'Процесс бота работает')
+        lines += metric('ready', 1 if self.bot.is_ready() else 0, 'Бот подключен и готов к командам')
+        lines += metric('gateway_latency_seconds', latency if latency is not None else float('nan'),
+                        'Задержка heartbeat шлюза Discord')
+        lines += metric('last_event_age_seconds', age if age is not None else float('nan'),
+                        'Время с последнего события шлюза')
+        lines += metric('uptime_seconds', time.time() - self.started_at, 'Время работы процесса')
+        lines += metric('guilds', len(self.bot.guilds), 'Количество серверов')
+        return lines
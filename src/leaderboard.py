@@ -0,0 +1,291 @@
+import threading
+from bisect import bisect_left, insort
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from money import Money
+
+# Рейтинг игроков по балансу в памяти. Для каждого сервера хранятся отсортированные
+# ключи (-баланс, user_id): место игрока находится двоичным поиском,
+# первые N игроков — обход с начала. Обновляется после фиксации записей в users.
+
+
+class SortedKeys:
+    """Отсортированные ключи, разбитые на блоки до 2 * LOAD элементов (как SortedList из sortedcontainers).
+
+    Вставка и удаление — двоичный поиск по максимумам блоков и сдвиг внутри одного блока,
+    O(log n + LOAD) вместо O(n) у одного списка. Длины блоков хранятся в дереве Фенвика,
+    поэтому место ключа — двоичный поиск и сумма длин предыдущих блоков за O(log n).
+    Дерево перестраивается целиком только при разделении, слиянии и удалении блоков.
+    """
+
+    LOAD = 512
+
+    def __init__(self, keys: Optional[List[Tuple[int, int]]] = None):
+        """keys должны быть отсортированы"""
+        keys = keys or []
+        self._blocks: List[List[Tuple[int, int]]] = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes: List[Tuple[int, int]] = [block[-1] for block in self._blocks]
+        self._len = len(keys)
+        self._tree: List[int] = []
+        self._rebuild_tree()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _rebuild_tree(self):
+        """Дерево Фенвика по длинам блоков (после изменения списка блоков)"""
+        tree = [len(block) for block in self._blocks]
+        for position in range(len(tree)):
+            parent = position | (position + 1)
+            if parent < len(tree):
+                tree[parent] += tree[position]
+        self._tree = tree
+
+    def _update_tree(self, position: int, delta: int):
+        tree = self._tree
+        while position < len(tree):
+            tree[position] += delta
+            position |= position + 1
+
+    def _prefix(self, end: int) -> int:
+        """Суммарная длина блоков [0, end)"""
+        total = 0
+        while end > 0:
+            total += self._tree[end - 1]
+            end &= end - 1
+        return total
+
+    def add(self, key: Tuple[int, int]):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._rebuild_tree()
+            return
+        index = min(bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[index]
+        insort(block, key)
+        self._maxes[index] = block[-1]
+        self._len += 1
+        if not self._split(index):
+            self._update_tree(index, 1)
+
+    def _split(self, index: int) -> bool:
+        """Разделить слишком большой блок пополам, чтобы сдвиг при вставке оставался коротким"""
+        block = self._blocks[index]
+        if len(block) <= 2 * self.LOAD:
+            return False
+        half = block[self.LOAD:]
+        del block[self.LOAD:]
+        self._maxes[index] = block[-1]
+        self._blocks.insert(index + 1, half)
+        self._maxes.insert(index + 1, half[-1])
+        self._rebuild_tree()
+        return True
+
+    def remove(self, key: Tuple[int, int]):
+        index = bisect_left(self._maxes, key)
+        block = self._blocks[index]
+        del block[bisect_left(block, key)]
+        self._len -= 1
+        if not block:
+            del self._blocks[index]
+            del self._maxes[index]
+            self._rebuild_tree()
+            return
+        self._maxes[index] = block[-1]
+        if len(block) >= self.LOAD // 4 or len(self._blocks) == 1:
+            self._update_tree(index, -1)
+        else:
+            # Маленький блок сливается с соседним, чтобы число блоков не росло после удалений
+            if index == len(self._blocks) - 1:
+                index -= 1
+            merged = self._blocks[index] + self._blocks[index + 1]
+            del self._blocks[index + 1]
+            del self._maxes[index + 1]
+            self._blocks[index] = merged
+            self._maxes[index] = merged[-1]
+            if not self._split(index):
+                self._rebuild_tree()
+
+    def index(self, key: Tuple[int, int]) -> int:
+        """Число ключей меньше key"""
+        index = bisect_left(self._maxes, key)
+        if index == len(self._blocks):
+            return self._len
+        return self._prefix(index) + bisect_left(self._blocks[index], key)
+
+    def iter_from(self, offset: int = 0) -> Iterator[Tuple[int, int]]:
+        for block in self._blocks:
+            if offset >= len(block):
+                offset -= len(block)
+                continue
+            for position in range(offset, len(block)):
+                yield block[position]
+            offset = 0
+
+
+class GuildLeaderboard:
+    """Рейтинг одного сервера"""
+
+    def __init__(self, keys: Optional[List[Tuple[int, int]]] = None, balances: Optional[Dict[int, int]] = None):
+        self._keys = SortedKeys(keys)
+        self._balances: Dict[int, int] = balances or {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def set(self, user_id: int, balance_minor: int):
+        old = self._balances.get(user_id)
+        if old == balance_minor:
+            return
+        if old is not None:
+            self._keys.remove((-old, user_id))
+        self._balances[user_id] = balance_minor
+        self._keys.add((-balance_minor, user_id))
+
+    def remove(self, user_id: int):
+        old = self._balances.pop(user_id, None)
+        if old is not None:
+            self._keys.remove((-old, user_id))
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """Место игрока, начиная с 1 (при равных балансах выше меньший user_id)"""
+        balance = self._balances.get(user_id)
+        if balance is None:
+            return None
+        return self._keys.index((-balance, user_id)) + 1
+
+    def iter_from(self, offset: int = 0) -> Iterator[Tuple[int, Money]]:
+        for negative_balance, user_id in self._keys.iter_from(offset):
+            yield user_id, Money(-negative_balance)
+
+
+class Leaderboard:
+    """Рейтинги всех серверов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._guilds: Dict[int, GuildLeaderboard] = {}
+        self.loaded = False
+
+    def load(self, rows: Iterable[Tuple[int, int, int]]):
+        """Полностью перестроить рейтинги из строк (guild_id, user_id, баланс в минимальных единицах)"""
+        keys: Dict[int, List[Tuple[int, int]]] = {}
+        balances: Dict[int, Dict[int, int]] = {}
+        for guild_id, user_id, balance in rows:
+            balance = balance or 0
+            keys.setdefault(guild_id, []).append((-balance, user_id))
+            balances.setdefault(guild_id, {})[user_id] = balance
+
+        guilds = {}
+        for guild_id, guild_keys in keys.items():
+            guild_keys.sort()
+            guilds[guild_id] = GuildLeaderboard(guild_keys, balances[guild_id])
+
+        with self._lock:
+            self._guilds = guilds
+            self.loaded = True
+
+    def update(self, guild_id: int, user_id: int, balance: Money):
+        with self._lock:
+            board = self._guilds.get(guild_id)
+            if board is None:
+                board = self._guilds[guild_id] = GuildLeaderboard()
+            board.set(user_id, Money.from_major(balance).minor)
+
+    def remove(self, guild_id: int, user_id: int):
+        with self._lock:
+            board = self._guilds.get(guild_id)
+            if board is not None:
+                board.remove(user_id)
+
+    def top(self, guild_id: int, limit: int = 10, offset: int = 0,
+            predicate: Optional[Callable[[int], bool]] = None) -> List[Tuple[int, Money]]:
+        """Первые limit игроков начиная с offset; с predicate учитываются только подходящие user_id"""
+        result = []
+        skipped = 0
+        with self._lock:
+            board = self._guilds.get(guild_id)
+            if board is None:
+                return result
+            for user_id, balance in board.iter_from(0 if predicate else offset):
+                if predicate is not None:
+                    if not predicate(user_id):
+                        continue
+                    if skipped < offset:
+                        skipped += 1
+                        continue
+                result.append((user_id, balance))
+                if len(result) >= limit:
+                    break
+        return result
+
+    def rank(self, guild_id: int, user_id: int) -> Tuple[Optional[int], int]:
+        """Место игрока и число игроков в рейтинге сервера"""
+        with self._lock:
+            board = self._guilds.get(guild_id)
+            if board is None:
+                return None, 0
+            return board.rank(user_id), len(board)
+
+
+class FactionLeaderboards:
+    """Рейтинги участников фракций для топа участников без JOIN faction_members × users"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards: Dict[int, GuildLeaderboard] = {}
+        self._member_faction: Dict[Tuple[int, int], int] = {}  # (guild_id, user_id) -> faction_id
+        self.loaded = False
+
+    def load(self, rows: Iterable[Tuple[int, int, int, Optional[int]]]):
+        """Перестроить из строк (faction_id, guild_id, user_id, баланс или None, если записи игрока нет)"""
+        boards: Dict[int, GuildLeaderboard] = {}
+        member_faction = {}
+        for faction_id, guild_id, user_id, balance in rows:
+            member_faction[(guild_id, user_id)] = faction_id
+            board = boards.setdefault(faction_id, GuildLeaderboard())
+            if balance is not None:
+                board.set(user_id, balance)
+        with self._lock:
+            self._boards = boards
+            self._member_faction = member_faction
+            self.loaded = True
+
+    def join(self, faction_id: int, guild_id: int, user_id: int, balance: Optional[Money]):
+        with self._lock:
+            self._member_faction[(guild_id, user_id)] = faction_id
+            board = self._boards.setdefault(faction_id, GuildLeaderboard())
+            if balance is not None:
+                board.set(user_id, Money.from_major(balance).minor)
+
+    def leave(self, guild_id: int, user_id: int):
+        with self._lock:
+            faction_id = self._member_faction.pop((guild_id, user_id), None)
+            board = self._boards.get(faction_id)
+            if board is not None:
+                board.remove(user_id)
+
+    def update_balance(self, guild_id: int, user_id: int, balance: Money):
+        """Новый баланс игрока; учитывается, только если игрок состоит во фракции"""
+        with self._lock:
+            faction_id = self._member_faction.get((guild_id, user_id))
+            if faction_id is not None:
+                self._boards.setdefault(faction_id, GuildLeaderboard()).set(user_id, Money.from_major(balance).minor)
+
+    def top(self, faction_id: int, limit: int = 3) -> List[Tuple[int, Money]]:
+        with self._lock:
+            board = self._boards.get(faction_id)
+            if board is None:
+                return []
+            result = []
+            for item in board.iter_from(0):
+                result.append(item)
+                if len(result) >= limit:
+                    break
+            return result
+
+
+leaderboard = Leaderboard()
+faction_leaderboards = FactionLeaderboards()
@@ -0,0 +1,91 @@
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from money import Amount
+
+# Журнал операций с двойной записью. Каждое движение денег — это проводка из двух
+# строк таблицы ledger с общим entry_id: списание со счета-источника (amount < 0)
+# и зачисление на счет-получатель (amount > 0). Сумма строк одной проводки равна нулю,
+# баланс счета равен сумме его строк. Строки журнала не изменяются и не удаляются.
+
+# Счет выпуска: с него приходят начальные балансы и начисления администраторов,
+# на него уходят списания. Его баланс — минус вся выпущенная на сервере валюта.
+MINT_ACCOUNT = 'mint'
+
+
+def user_account(user_id: int) -> str:
+    return f'user:{user_id}'
+
+
+def faction_account(faction_id: int) -> str:
+    return f'faction:{faction_id}'
+
+
+def post_entry(c, guild_id: int, from_account: str, to_account: str, amount: Amount, kind: str,
+               memo: Optional[str] = None, actor_id: Optional[int] = None) -> Optional[int]:
+    """Записать проводку в текущей транзакции. Возвращает entry_id (None для нулевой суммы)"""
+    if not amount:
+        return None
+    if amount < 0:
+        from_account, to_account, amount = to_account, from_account, -amount
+
+    now = datetime.now().isoformat()
+    # entry_id — id первой строки проводки; запись идет под блокировкой BEGIN IMMEDIATE
+    c.execute('''INSERT INTO ledger (entry_id, guild_id, account, amount, kind, memo, actor_id, created_at)
+                 VALUES ((SELECT COALESCE(MAX(id), 0) + 1 FROM ledger), ?, ?, ?, ?, ?, ?, ?)''',
+              (guild_id, from_account, -amount, kind, memo, actor_id, now))
+    entry_id = c.lastrowid
+    c.execute('''INSERT INTO ledger (entry_id, guild_id, account, amount, kind, memo, actor_id, created_at)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+              (entry_id, guild_id, to_account, amount, kind, memo, actor_id, now))
+    return entry_id
+
+
+def post_entries(c, guild_id: int, from_account: str, credits: List[Tuple[str, Amount]], kind: str,
+                 memo: Optional[str] = None, actor_id: Optional[int] = None) -> int:
+    """Записать пачку проводок с одного счета одним executemany. Возвращает число проводок.
+
+    Суммы должны быть положительными; нулевые пропускаются.
+    """
+    credits = [(account, amount) for account, amount in credits if amount]
+    if not credits:
+        return 0
+
+    # id строк назначаются явно, подряд после последнего выданного AUTOINCREMENT
+    c.execute('''SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'ledger'), 0),
+                            COALESCE((SELECT MAX(id) FROM ledger), 0))''')
+    base = c.fetchone()[0]
+    now = datetime.now().isoformat()
+    rows = []
+    for index, (to_account, amount) in enumerate(credits):
+        entry_id = base + 2 * index + 1
+        rows.append((entry_id, entry_id, guild_id, from_account, -amount, kind, memo, actor_id, now))
+        rows.append((entry_id + 1, entry_id, guild_id, to_account, amount, kind, memo, actor_id, now))
+    c.executemany('''INSERT INTO ledger (id, entry_id, guild_id, account, amount, kind, memo, actor_id, created_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    return len(credits)
+
+
+# Названия видов операций для истории
+KIND_LABELS = {
+    'opening': 'Начальный остаток',
+    'grant': 'Стартовый баланс',
+    'transfer': 'Перевод',
+    'faction_transfer': 'Перевод во фракцию',
+    'admin': 'Администратор',
+    'set': 'Установка баланса',
+    'salary': 'Зарплата',
+    'adjust': 'Изменение баланса',
+}
+
+
+def describe_account(account: Optional[str]) -> str:
+    """Счет в виде, пригодном для сообщения Discord"""
+    if not account or account == MINT_ACCOUNT:
+        return "сервер"
+    kind, _, account_id = account.partition(':')
+    if kind == 'user':
+        return f"<@{account_id}>"
+    if kind == 'faction':
+        return f"фракция #{account_id}"
+    return account
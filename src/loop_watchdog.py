@@ -0,0 +1,135 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import List, Optional
+
+from health import metric
+
+# Сторож цикла событий. Цикл раз в interval отмечает heartbeat через call_later;
+# задержка срабатывания относительно расписания — это лаг цикла. Отдельный поток проверяет,
+# как давно был heartbeat, и если цикл не отвечает дольше порога, снимает стек потока цикла:
+# в нем видна команда или функция database.py, которая выполняется синхронно и блокирует цикл.
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _project_frames(frame) -> List[str]:
+    """Кадры стека из файлов бота (без библиотек), от внешнего к внутреннему"""
+    return [f"{os.path.basename(item.filename)}:{item.lineno} {item.name}"
+            for item in traceback.extract_stack(frame)
+            if os.path.abspath(item.filename).startswith(_PROJECT_DIR) and item.filename != __file__]
+
+
+class LoopWatchdog:
+    """Измерение лага цикла событий и снятие стека при зависании"""
+
+    def __init__(self, threshold_ms: float = 250, interval: float = 0.1):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.max_stall = 0.0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._last_beat = 0.0
+        self._expected = 0.0
+        # Снят ли стек потоком сторожа во время текущего зависания
+        self._stack_captured = False
+
+    def start(self, threshold_ms: Optional[float] = None):
+        """Запуск из потока цикла событий (например, в setup_hook)"""
+        if self._thread is not None:
+            return
+        if threshold_ms is not None:
+            self.threshold = threshold_ms / 1000
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._last_beat = time.monotonic()
+        self._expected = self._last_beat + self.interval
+        self._handle = self._loop.call_later(self.interval, self._beat)
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._expected)
+        with self._lock:
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self._last_beat = now
+            captured, self._stack_captured = self._stack_captured, False
+            stalled = lag >= self.threshold
+            if stalled:
+                self.stalls += 1
+                self.stall_seconds += lag
+                self.max_stall = max(self.max_stall, lag)
+
+        if stalled:
+            # Длинное зависание поток сторожа уже описал со стеком; короткое он может не застать
+            note = "" if captured else " (стек не снят)"
+            print(f"Цикл событий был заблокирован на {lag * 1000:.0f} мс{note}")
+
+        self._expected = now + self.interval
+        self._handle = self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                last_beat = self._last_beat
+                captured = self._stack_captured
+            blocked = time.monotonic() - last_beat - self.interval
+            if blocked < self.threshold or captured:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            where = _project_frames(frame)
+            stack = ''.join(traceback.format_stack(frame))
+            del frame
+
+            with self._lock:
+                # Цикл мог ожить, пока снимался стек: тогда стек уже не о зависании
+                if self._last_beat != last_beat:
+                    continue
+                self._stack_captured = True
+
+            print(f"Цикл событий не отвечает {blocked * 1000:.0f} мс, "
+                  f"блокирует: {' → '.join(where[-4:]) or 'код вне бота'}\n{stack}")
+
+    def prometheus(self) -> List[str]:
+        """Лаг и зависания цикла событий в текстовом формате Prometheus"""
+        with self._lock:
+            lag, max_lag = self.lag, self.max_lag
+            stalls, stall_seconds, max_stall = self.stalls, self.stall_seconds, self.max_stall
+        lines = []
+        lines += metric('loop_lag_seconds', lag, 'Последний измеренный лаг цикла событий')
+        lines += metric('loop_lag_max_seconds', max_lag, 'Максимальный лаг цикла событий')
+        lines += metric('loop_stalls_total', stalls, 'Зависания цикла событий дольше порога', 'counter')
+        lines += metric('loop_stall_seconds_total', stall_seconds, 'Суммарное время зависаний цикла событий',
+                        'counter')
+        lines += metric('loop_stall_max_seconds', max_stall, 'Самое долгое зависание цикла событий')
+        return lines
+
+
+loop_watchdog = LoopWatchdog()
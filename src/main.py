@@ -2,13 +2,23 @@ import discord
 from discord.ext import commands
 import json
 import asyncio
+import hashlib
 from datetime import datetime
-# Flask сервер для обработки HTTP запросов
-from flask import Flask
-from threading import Thread
 
 # Импортируем модули
-from database import init_db, cleanup_expired_transfers
+from database import (
+    db, init_db, preload_ui_settings, preload_faction_index, preload_leaderboard, clear_pending_transfers
+)
+from async_db import (
+    take_all_balance_snapshots, recount_guild_stats, pay_all_salaries,
+    get_meta, set_meta, group_commit, shutdown as shutdown_db
+)
+from scheduler import scheduler
+from pending_transfers import pending_transfers
+from health import HealthServer, metric_family
+from metrics import metrics
+from slow_queries import slow_query_log
+from loop_watchdog import loop_watchdog
 from balance import setup_balance_commands
 from fractions import setup_fraction_commands
 from admin import setup_admin_commands
@@ -29,24 +39,143 @@ intents.members = True
 intents.message_content = True
 intents.guilds = True
 
-app = Flask('')
 
-@app.route('/')
-def home():
-    return "Bot is alive!"
+def command_tree_hash(tree: discord.app_commands.CommandTree) -> str:
+    """Хэш описания слэш-команд: меняется только при изменении команд, параметров или описаний"""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda item: item['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class EconomyBot(commands.Bot):
+    """Бот с однократной инициализацией: setup_hook выполняется один раз за процесс,
+    а on_ready — после каждого переподключения"""
+
+    async def setup_hook(self):
+        # Инициализируем базу данных
+        init_db()
+
+        # HTTP-сервер проверки состояния и метрик на цикле событий бота
+        await health_server.start()
+
+        # Загружаем настройки интерфейса всех серверов в кэш
+        preload_ui_settings()
+
+        # Строим индекс названий фракций для автодополнения
+        preload_faction_index()
+
+        # Строим рейтинг игроков по балансу и топы участников фракций
+        preload_leaderboard()
+
+        # Ожидающие переводы хранятся в памяти; строки в таблице могли остаться от прежних версий
+        removed = clear_pending_transfers()
+        if removed > 0:
+            print(f"Удалено {removed} ожидающих переводов, оставшихся после перезапуска")
+
+        # Сторож цикла событий: синхронная загрузка выше ожидаема, поэтому он запускается после нее
+        if config.get('loop_stall_ms', 250) is not None:
+            loop_watchdog.start(config.get('loop_stall_ms', 250))
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
+        # Запускаем фоновые задачи (снимки, пересчет счетчиков, зарплаты)
+        await start_jobs()
 
-Thread(target=run).start()
+        await self.sync_commands()
 
-bot = commands.Bot(
+    async def sync_commands(self):
+        """Синхронизировать слэш-команды, только если они изменились с прошлой синхронизации"""
+        key = f'command_tree_hash:{self.application_id}'
+        tree_hash = command_tree_hash(self.tree)
+        if await get_meta(key) == tree_hash:
+            print("Команды не изменились, синхронизация не нужна")
+            return
+
+        try:
+            synced = await self.tree.sync()
+            await set_meta(key, tree_hash)
+            print(f"Синхронизировано {len(synced)} команд")
+        except Exception as e:
+            print(f"Ошибка синхронизации команд: {e}")
+
+    async def close(self):
+        # Фиксируем поставленные в очередь изменения балансов до закрытия соединений
+        try:
+            loop_watchdog.stop()
+            await scheduler.stop()
+            await group_commit.flush()
+            await health_server.stop()
+        finally:
+            await super().close()
+            shutdown_db()
+            db.close_all()
+
+
+bot = EconomyBot(
     command_prefix=PREFIX,
     intents=intents,
-    help_command=None
+    help_command=None,
+    activity=discord.Activity(
+        type=discord.ActivityType.watching,
+        name=f"админ-панель | {PREFIX}помощь"
+    )
 )
 
 
+def app_metrics():
+    """Метрики базы данных, групповой фиксации и ожидающих переводов"""
+    lines = []
+    lines += metric_family('db', 'Счетчики соединений и транзакций SQLite', 'gauge',
+                           (({'counter': name}, value) for name, value in db.stats().items()))
+    lines += metric_family('group_commit', 'Групповая фиксация изменений балансов', 'gauge',
+                           (({'counter': name}, value) for name, value in group_commit.stats().items()))
+    lines += metric_family('pending_transfers', 'Ожидающие подтверждения переводы', 'gauge',
+                           (({'counter': name}, value) for name, value in pending_transfers.stats().items()))
+    return lines
+
+
+health_server = HealthServer(bot, config.get('health_host', '0.0.0.0'), config.get('health_port', 8080))
+health_server.add_metrics(loop_watchdog.prometheus)
+health_server.add_metrics(app_metrics)
+health_server.add_metrics(metrics.prometheus)
+
+# Замер времени и ошибок всех команд (функции базы данных замеряются в database.py)
+metrics.install_command_hooks(bot)
+
+# Журнал медленных запросов: порог в миллисекундах (null — выключен) и файл с ротацией
+slow_query_log.configure(config.get('slow_query_ms', 100), config.get('slow_query_log_file', 'slow_queries.log'))
+
+
+# Фоновые задачи (выполняются планировщиком, расписание хранится в таблице jobs)
+# Периодические снимки балансов: восстановление и сверка счета идут от снимка, а не с начала журнала
+async def balance_snapshots_job():
+    written = await take_all_balance_snapshots()
+    if written > 0:
+        print(f"Снимок балансов: {written} счетов")
+
+
+# Сверка счетчиков админ-панели с полным пересчетом: исправляет расхождения, если они появились
+async def guild_stats_recount_job():
+    drifted = await recount_guild_stats()
+    if drifted:
+        print(f"Исправлены счетчики серверов: {', '.join(map(str, drifted))}")
+
+
+async def salaries_job():
+    results = await pay_all_salaries(bot.guilds, DEFAULT_BALANCE)
+    paid = sum(count for count, _ in results.values())
+    if paid > 0:
+        print(f"Выплачено зарплат: {paid}")
+
+
+async def start_jobs():
+    await scheduler.add_job('balance_snapshots', balance_snapshots_job,
+                            config.get('snapshot_interval_hours', 6) * 3600, jitter=300)
+    await scheduler.add_job('guild_stats_recount', guild_stats_recount_job,
+                            config.get('stats_recount_interval_hours', 24) * 3600, jitter=600)
+    # Автоматическая выплата зарплат включается ключом salary_interval_hours
+    if config.get('salary_interval_hours'):
+        await scheduler.add_job('salaries', salaries_job, config['salary_interval_hours'] * 3600)
+    scheduler.start()
+
+
 # Функция для загрузки конфигурации
 def get_config():
     return {
@@ -59,30 +188,9 @@ def get_config():
 
 @bot.event
 async def on_ready():
+    # Вызывается и после каждого переподключения: вся инициализация — в EconomyBot.setup_hook
     print(f'{bot.user} подключился к Discord!')
 
-    # Инициализируем базу данных
-    init_db()
-
-    # Очищаем просроченные переводы при запуске
-    expired = cleanup_expired_transfers()
-    if expired > 0:
-        print(f"Очищено {expired} просроченных переводов")
-
-    # Устанавливаем статус бота
-    activity = discord.Activity(
-        type=discord.ActivityType.watching,
-        name=f"админ-панель | {PREFIX}помощь"
-    )
-    await bot.change_presence(activity=activity)
-
-    # Синхронизируем команды
-    try:
-        synced = await bot.tree.sync()
-        print(f"Синхронизировано {len(synced)} команд")
-    except Exception as e:
-        print(f"Ошибка синхронизации команд: {e}")
-
 
 # Загружаем конфигурацию
 config_data = get_config()
@@ -108,6 +216,8 @@ async def help_bot(ctx):
             name="💰 Экономика",
             value=f"`{PREFIX}баланс [@участник]` - Показать баланс\n"
                   f"`{PREFIX}перевод @участник сумма` - Перевести деньги (с подтверждением)\n"
+                  f"`{PREFIX}история [@участник]` - История операций\n"
+                  f"`{PREFIX}топ [страница]` - Самые богатые игроки\n"
                   f"`{PREFIX}перевод_фракции название сумма` - Перевести деньги в любую фракцию (с подтверждением)",
             inline=False
         )
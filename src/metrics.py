@@ -0,0 +1,188 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from discord.ext import commands
+
+from health import histogram_family, metric_family
+
+# Замеры времени выполнения команд бота и функций database.py.
+# Для каждой команды и функции хранятся количество вызовов, ошибки, суммарное и максимальное время,
+# гистограмма по фиксированным корзинам (для /metrics) и окно последних замеров,
+# по которому считаются p50/p95/p99 (для админ-команды).
+
+# Границы корзин гистограммы, секунды
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+COMMAND = 'command'
+QUERY = 'query'
+
+# Журнал библиотеки, в который пишет стандартный обработчик ошибок команд
+_command_log = logging.getLogger('discord.ext.commands.bot')
+
+
+class LatencyStats:
+    """Счетчики и задержки одной команды или функции"""
+
+    __slots__ = ('count', 'errors', 'total', 'max', 'buckets', 'recent')
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Последняя корзина — значения больше BUCKETS[-1]
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds: float, error: bool):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.recent.append(seconds)
+
+
+class MetricSummary:
+    """Снимок LatencyStats для вывода"""
+
+    __slots__ = ('name', 'count', 'errors', 'total', 'max', 'p50', 'p95', 'p99')
+
+    def __init__(self, name: str, stats: LatencyStats):
+        self.name = name
+        self.count = stats.count
+        self.errors = stats.errors
+        self.total = stats.total
+        self.max = stats.max
+        samples = sorted(stats.recent)
+        self.p50, self.p95, self.p99 = (_quantile(samples, q) for q in QUANTILES)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+def _quantile(samples: List[float], q: float) -> float:
+    """Квантиль по методу ближайшего ранга; samples отсортированы"""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, int(q * len(samples) + 0.5) - 1))]
+
+
+class Metrics:
+    """Реестр замеров. Функции базы данных выполняются в потоках пула, поэтому доступ под блокировкой"""
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.started_at = time.time()
+        self._series: Dict[Tuple[str, str], LatencyStats] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind: str, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            stats = self._series.get((kind, name))
+            if stats is None:
+                stats = self._series[kind, name] = LatencyStats(self.window)
+            stats.observe(seconds, error)
+
+    def summary(self, kind: str, limit: Optional[int] = None) -> List[MetricSummary]:
+        """Замеры одного вида, отсортированные по суммарному времени"""
+        with self._lock:
+            result = [MetricSummary(name, stats) for (series_kind, name), stats in self._series.items()
+                      if series_kind == kind]
+        result.sort(key=lambda item: item.total, reverse=True)
+        return result[:limit] if limit is not None else result
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self.started_at = time.time()
+
+    def timed(self, kind: str, name: str) -> Callable:
+        """Декоратор синхронной функции: время вызова и исключение записываются под именем name"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                error = True
+                try:
+                    result = func(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    self.observe(kind, name, time.perf_counter() - started, error)
+
+            return wrapper
+
+        return decorator
+
+    def instrument_module(self, namespace: dict, kind: str = QUERY):
+        """Обернуть все публичные функции, объявленные в модуле (передается globals() модуля).
+
+        Вложенные вызовы тоже попадают в замеры, так как функции модуля вызывают друг друга через globals.
+        """
+        module = namespace['__name__']
+        for name, value in list(namespace.items()):
+            if (not name.startswith('_') and callable(value) and not isinstance(value, type)
+                    and getattr(value, '__module__', None) == module):
+                namespace[name] = self.timed(kind, name)(value)
+
+    def install_command_hooks(self, bot: commands.Bot):
+        """Замер всех команд бота (префиксных и слэш) через общие хуки before/after invoke"""
+
+        async def before_invoke(ctx):
+            ctx.metrics_started = time.perf_counter()
+
+        async def after_invoke(ctx):
+            # Префиксная группа вызывается перед своей подкомандой — замеряется только подкоманда
+            if ctx.invoked_subcommand is not None and ctx.command is not ctx.invoked_subcommand:
+                return
+            started = getattr(ctx, 'metrics_started', None)
+            if started is not None and ctx.command is not None:
+                self.observe(COMMAND, ctx.command.qualified_name, time.perf_counter() - started, ctx.command_failed)
+
+        async def on_command_error(ctx, error):
+            # Команда не дошла до выполнения (не пройдена проверка, неверные аргументы) — хуки не вызывались
+            if getattr(ctx, 'metrics_started', None) is None and ctx.command is not None:
+                self.observe(COMMAND, ctx.command.qualified_name, 0.0, True)
+
+            # С этим обработчиком стандартный BotBase.on_command_error ничего не пишет в журнал,
+            # поэтому ошибки (кроме ожидаемых проверок и неверного ввода) журналируются здесь
+            if isinstance(error, (commands.CheckFailure, commands.UserInputError)):
+                return
+            if ctx.command is not None and ctx.command.has_error_handler():
+                return
+            if ctx.cog is not None and ctx.cog.has_error_handler():
+                return
+            _command_log.error('Ignoring exception in command %s', ctx.command, exc_info=error)
+
+        bot.before_invoke(before_invoke)
+        bot.after_invoke(after_invoke)
+        bot.add_listener(on_command_error, 'on_command_error')
+
+    def prometheus(self) -> List[str]:
+        """Гистограммы и счетчики ошибок в текстовом формате Prometheus"""
+        with self._lock:
+            series = [(kind, name, list(stats.buckets), stats.total, stats.count, stats.errors)
+                      for (kind, name), stats in sorted(self._series.items())]
+
+        lines = []
+        for kind, label, title in ((COMMAND, 'command', 'команд бота'), (QUERY, 'function', 'функций базы данных')):
+            rows = [row for row in series if row[0] == kind]
+            lines += histogram_family(f'{kind}_duration_seconds', f'Время выполнения {title}', BUCKETS,
+                                      (({label: name}, buckets, total, count)
+                                       for _, name, buckets, total, count, _ in rows))
+            lines += metric_family(f'{kind}_errors_total', f'Количество ошибок {title}', 'counter',
+                                   (({label: name}, errors) for _, name, _, _, _, errors in rows))
+        return lines
+
+
+metrics = Metrics()
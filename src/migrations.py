@@ -0,0 +1,351 @@
+import sqlite3
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from ledger import MINT_ACCOUNT, user_account, faction_account, post_entry
+from money import MINOR_UNITS
+
+# Нумерованные миграции схемы. Каждая применяется ровно один раз,
+# номер последней примененной хранится в таблице schema_version.
+
+
+def _m001_initial_schema(c):
+    """Начальная схема (таблицы, которые раньше создавались при каждом запуске)"""
+    # Таблица пользователей
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (user_id INTEGER, guild_id INTEGER, balance REAL,
+                  PRIMARY KEY (user_id, guild_id))''')
+
+    # Таблица фракций
+    c.execute('''CREATE TABLE IF NOT EXISTS factions
+                 (faction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  guild_id INTEGER, name TEXT, balance REAL,
+                  leader_id INTEGER, color TEXT, created_at TEXT,
+                  description TEXT DEFAULT '', role_id INTEGER DEFAULT NULL,
+                  is_role_based INTEGER DEFAULT 0)''')
+
+    # Таблица членов фракций
+    c.execute('''CREATE TABLE IF NOT EXISTS faction_members
+                 (user_id INTEGER, guild_id INTEGER, faction_id INTEGER,
+                  role TEXT, joined_at TEXT)''')
+
+    # Таблица настроек интерфейса
+    c.execute('''CREATE TABLE IF NOT EXISTS ui_settings
+                 (guild_id INTEGER PRIMARY KEY,
+                  embed_color TEXT, footer_text TEXT,
+                  admin_channel_id INTEGER)''')
+
+    # Проверяем наличие столбцов
+    c.execute("PRAGMA table_info(factions)")
+    columns = [column[1] for column in c.fetchall()]
+
+    if 'role_id' not in columns:
+        c.execute('ALTER TABLE factions ADD COLUMN role_id INTEGER DEFAULT NULL')
+    if 'is_role_based' not in columns:
+        c.execute('ALTER TABLE factions ADD COLUMN is_role_based INTEGER DEFAULT 0')
+
+    # Таблица ролей с доступом к админ-панели
+    c.execute('''CREATE TABLE IF NOT EXISTS admin_roles
+                 (guild_id INTEGER, role_id INTEGER,
+                  added_by INTEGER, added_at TEXT,
+                  PRIMARY KEY (guild_id, role_id))''')
+
+    # Таблица пользователей с доступом к админ-панели
+    c.execute('''CREATE TABLE IF NOT EXISTS admin_users
+                 (guild_id INTEGER, user_id INTEGER,
+                  added_by INTEGER, added_at TEXT,
+                  PRIMARY KEY (guild_id, user_id))''')
+
+    # Таблица зарплат по ролям
+    c.execute('''CREATE TABLE IF NOT EXISTS role_salaries
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  guild_id INTEGER, role_id INTEGER,
+                  salary_amount REAL, added_by INTEGER,
+                  added_at TEXT, last_paid TEXT,
+                  UNIQUE(guild_id, role_id))''')
+
+    # Таблица истории выплат
+    c.execute('''CREATE TABLE IF NOT EXISTS salary_history
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  guild_id INTEGER, user_id INTEGER,
+                  role_id INTEGER, amount REAL,
+                  paid_at TEXT, paid_by TEXT DEFAULT 'system')''')
+
+    # Таблица ожидающих переводов. Больше не используется: переводы хранятся в памяти
+    # (pending_transfers.py), при запуске таблица только очищается от строк прежних версий
+    c.execute('''CREATE TABLE IF NOT EXISTS pending_transfers
+                 (transfer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  guild_id INTEGER, from_user_id INTEGER, to_user_id INTEGER,
+                  to_faction_id INTEGER, amount REAL, type TEXT,
+                  created_at TEXT, expires_at TEXT)''')
+
+
+def _m002_secondary_indexes(c):
+    """Вторичные индексы для частых выборок"""
+    # Фракция пользователя, вступление и выход
+    c.execute('CREATE INDEX IF NOT EXISTS idx_faction_members_user ON faction_members (user_id, guild_id)')
+    # Списки и количество участников фракции
+    c.execute('CREATE INDEX IF NOT EXISTS idx_faction_members_faction ON faction_members (faction_id, user_id)')
+    # Поиск фракции по точному названию и сортировка списка фракций
+    c.execute('CREATE INDEX IF NOT EXISTS idx_factions_guild_lower_name ON factions (guild_id, LOWER(name))')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_factions_guild_name ON factions (guild_id, name)')
+    # Балансы и суммы по серверу
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_guild_balance ON users (guild_id, balance DESC)')
+    # Очистка просроченных переводов
+    c.execute('CREATE INDEX IF NOT EXISTS idx_pending_transfers_expires ON pending_transfers (expires_at)')
+    # История выплат по серверу в порядке времени
+    c.execute('CREATE INDEX IF NOT EXISTS idx_salary_history_guild_paid ON salary_history (guild_id, paid_at)')
+
+
+def faction_name_key(name: str) -> str:
+    """Ключ поиска по названию фракции (без учета регистра, в том числе для кириллицы)"""
+    return (name or "").casefold()
+
+
+def _m003_faction_name_search(c):
+    """Ключ названия фракции и триграммный индекс FTS5 для поиска по подстроке"""
+    c.execute('ALTER TABLE factions ADD COLUMN name_key TEXT')
+    c.execute('SELECT faction_id, name FROM factions')
+    c.executemany('UPDATE factions SET name_key = ? WHERE faction_id = ?',
+                  [(faction_name_key(name), faction_id) for faction_id, name in c.fetchall()])
+    c.execute('CREATE INDEX IF NOT EXISTS idx_factions_guild_name_key ON factions (guild_id, name_key)')
+    # LOWER() не учитывает регистр кириллицы, индекс по нему заменен ключом name_key
+    c.execute('DROP INDEX IF EXISTS idx_factions_guild_lower_name')
+
+    # Триграммный токенизатор есть в SQLite 3.34+; без него поиск по подстроке идет через instr()
+    try:
+        c.execute("CREATE VIRTUAL TABLE faction_search USING fts5(name_key, tokenize = 'trigram')")
+    except sqlite3.OperationalError as e:
+        print(f"Триграммный индекс FTS5 недоступен, используется поиск без индекса: {e}")
+        return
+
+    c.execute('INSERT INTO faction_search (rowid, name_key) SELECT faction_id, name_key FROM factions')
+    c.execute('''CREATE TRIGGER factions_search_insert AFTER INSERT ON factions BEGIN
+                     INSERT INTO faction_search (rowid, name_key) VALUES (new.faction_id, new.name_key);
+                 END''')
+    c.execute('''CREATE TRIGGER factions_search_update AFTER UPDATE OF name_key ON factions BEGIN
+                     DELETE FROM faction_search WHERE rowid = old.faction_id;
+                     INSERT INTO faction_search (rowid, name_key) VALUES (new.faction_id, new.name_key);
+                 END''')
+    c.execute('''CREATE TRIGGER factions_search_delete AFTER DELETE ON factions BEGIN
+                     DELETE FROM faction_search WHERE rowid = old.faction_id;
+                 END''')
+
+
+def _m004_ledger(c):
+    """Журнал операций с двойной записью и снимки балансов"""
+    c.execute('''CREATE TABLE IF NOT EXISTS ledger
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  entry_id INTEGER NOT NULL, guild_id INTEGER NOT NULL,
+                  account TEXT NOT NULL, amount REAL NOT NULL,
+                  kind TEXT NOT NULL, memo TEXT, actor_id INTEGER,
+                  created_at TEXT NOT NULL)''')
+    # История счета (постранично по id) и сумма хвоста после снимка
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ledger_account ON ledger (guild_id, account, id)')
+    # Вторая сторона проводки
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ledger_entry ON ledger (entry_id)')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger BEGIN
+                     SELECT RAISE(ABORT, 'ledger is append-only');
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger BEGIN
+                     SELECT RAISE(ABORT, 'ledger is append-only');
+                 END''')
+
+    # Снимок: баланс счета с учетом всех строк журнала до ledger_id включительно
+    c.execute('''CREATE TABLE IF NOT EXISTS balance_snapshots
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  guild_id INTEGER NOT NULL, account TEXT NOT NULL,
+                  balance REAL NOT NULL, ledger_id INTEGER NOT NULL,
+                  taken_at TEXT NOT NULL)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_balance_snapshots_account
+                 ON balance_snapshots (guild_id, account, ledger_id)''')
+
+    # Начальные проводки: текущие балансы приходят со счета выпуска
+    c.execute('SELECT guild_id, user_id, balance FROM users WHERE balance IS NOT NULL AND balance != 0')
+    openings = [(guild_id, user_account(user_id), balance) for guild_id, user_id, balance in c.fetchall()]
+    c.execute('SELECT guild_id, faction_id, balance FROM factions WHERE balance IS NOT NULL AND balance != 0')
+    openings += [(guild_id, faction_account(faction_id), balance) for guild_id, faction_id, balance in c.fetchall()]
+    for guild_id, account, balance in openings:
+        post_entry(c, guild_id, MINT_ACCOUNT, account, balance, 'opening')
+
+
+def _rebuild_table(c, table: str, columns_sql: str, money_columns: Tuple[str, ...]):
+    """Пересоздать таблицу с новыми типами столбцов, сохранив данные, индексы и триггеры.
+
+    Денежные столбцы переводятся из основных единиц (REAL) в минимальные (INTEGER).
+    """
+    c.execute(f"PRAGMA table_info({table})")
+    columns = [column[1] for column in c.fetchall()]
+    c.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL",
+              (table,))
+    dependents = [row[0] for row in c.fetchall()]
+
+    c.execute(f'CREATE TABLE {table}_new ({columns_sql})')
+    select = ', '.join(f'CAST(ROUND({column} * {MINOR_UNITS}) AS INTEGER)' if column in money_columns else column
+                       for column in columns)
+    c.execute(f'INSERT INTO {table}_new ({", ".join(columns)}) SELECT {select} FROM {table}')
+    c.execute(f'DROP TABLE {table}')
+    c.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    for sql in dependents:
+        c.execute(sql)
+
+
+def _m005_integer_money(c):
+    """Денежные столбцы в целых минимальных единицах"""
+    _rebuild_table(c, 'users', '''user_id INTEGER, guild_id INTEGER, balance INTEGER,
+                                  PRIMARY KEY (user_id, guild_id)''', ('balance',))
+    _rebuild_table(c, 'factions', '''faction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                     guild_id INTEGER, name TEXT, balance INTEGER,
+                                     leader_id INTEGER, color TEXT, created_at TEXT,
+                                     description TEXT DEFAULT '', role_id INTEGER DEFAULT NULL,
+                                     is_role_based INTEGER DEFAULT 0, name_key TEXT''', ('balance',))
+    _rebuild_table(c, 'role_salaries', '''id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                          guild_id INTEGER, role_id INTEGER,
+                                          salary_amount INTEGER, added_by INTEGER,
+                                          added_at TEXT, last_paid TEXT,
+                                          UNIQUE(guild_id, role_id)''', ('salary_amount',))
+    _rebuild_table(c, 'salary_history', """id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                           guild_id INTEGER, user_id INTEGER,
+                                           role_id INTEGER, amount INTEGER,
+                                           paid_at TEXT, paid_by TEXT DEFAULT 'system'""", ('amount',))
+    _rebuild_table(c, 'pending_transfers', '''transfer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                              guild_id INTEGER, from_user_id INTEGER, to_user_id INTEGER,
+                                              to_faction_id INTEGER, amount INTEGER, type TEXT,
+                                              created_at TEXT, expires_at TEXT''', ('amount',))
+    _rebuild_table(c, 'ledger', '''id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                   entry_id INTEGER NOT NULL, guild_id INTEGER NOT NULL,
+                                   account TEXT NOT NULL, amount INTEGER NOT NULL,
+                                   kind TEXT NOT NULL, memo TEXT, actor_id INTEGER,
+                                   created_at TEXT NOT NULL''', ('amount',))
+    _rebuild_table(c, 'balance_snapshots', '''id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                              guild_id INTEGER NOT NULL, account TEXT NOT NULL,
+                                              balance INTEGER NOT NULL, ledger_id INTEGER NOT NULL,
+                                              taken_at TEXT NOT NULL''', ('balance',))
+
+
+# Пересчет счетчиков с нуля: при миграции и при периодической сверке
+GUILD_STATS_RECOUNT_SQL = '''
+    SELECT guild_id, SUM(user_count), SUM(user_balance), SUM(faction_count), SUM(faction_balance)
+    FROM (SELECT guild_id, COUNT(*) AS user_count, COALESCE(SUM(balance), 0) AS user_balance,
+                 0 AS faction_count, 0 AS faction_balance
+          FROM users GROUP BY guild_id
+          UNION ALL
+          SELECT guild_id, 0, 0, COUNT(*), COALESCE(SUM(balance), 0)
+          FROM factions GROUP BY guild_id)
+    GROUP BY guild_id
+'''
+
+
+def _m006_guild_stats(c):
+    """Счетчики игроков, фракций и сумм по серверу, которые ведут триггеры"""
+    c.execute('''CREATE TABLE IF NOT EXISTS guild_stats
+                 (guild_id INTEGER PRIMARY KEY,
+                  user_count INTEGER NOT NULL DEFAULT 0, user_balance INTEGER NOT NULL DEFAULT 0,
+                  faction_count INTEGER NOT NULL DEFAULT 0, faction_balance INTEGER NOT NULL DEFAULT 0)''')
+    c.execute(f'INSERT INTO guild_stats (guild_id, user_count, user_balance, faction_count, faction_balance) '
+              f'{GUILD_STATS_RECOUNT_SQL}')
+
+    for table, prefix in (('users', 'user'), ('factions', 'faction')):
+        c.execute(f'''CREATE TRIGGER {table}_stats_insert AFTER INSERT ON {table} BEGIN
+                         INSERT INTO guild_stats (guild_id, {prefix}_count, {prefix}_balance)
+                         VALUES (new.guild_id, 1, COALESCE(new.balance, 0))
+                         ON CONFLICT (guild_id) DO UPDATE SET
+                             {prefix}_count = {prefix}_count + 1,
+                             {prefix}_balance = {prefix}_balance + excluded.{prefix}_balance;
+                     END''')
+        c.execute(f'''CREATE TRIGGER {table}_stats_update AFTER UPDATE OF balance ON {table} BEGIN
+                         UPDATE guild_stats
+                         SET {prefix}_balance = {prefix}_balance + COALESCE(new.balance, 0) - COALESCE(old.balance, 0)
+                         WHERE guild_id = new.guild_id;
+                     END''')
+        c.execute(f'''CREATE TRIGGER {table}_stats_delete AFTER DELETE ON {table} BEGIN
+                         UPDATE guild_stats
+                         SET {prefix}_count = {prefix}_count - 1,
+                             {prefix}_balance = {prefix}_balance - COALESCE(old.balance, 0)
+                         WHERE guild_id = old.guild_id;
+                     END''')
+
+
+def _m007_jobs(c):
+    """Фоновые задачи: время следующего запуска и статистика выполнения"""
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (name TEXT PRIMARY KEY,
+                  interval_seconds REAL NOT NULL, jitter_seconds REAL NOT NULL DEFAULT 0,
+                  next_run_at REAL NOT NULL, last_run_at REAL, last_duration REAL,
+                  max_duration REAL NOT NULL DEFAULT 0, total_duration REAL NOT NULL DEFAULT 0,
+                  run_count INTEGER NOT NULL DEFAULT 0, failure_count INTEGER NOT NULL DEFAULT 0,
+                  last_error TEXT)''')
+
+
+def _m008_faction_member_count(c):
+    """Количество участников фракции в самой строке factions, его ведут триггеры faction_members"""
+    c.execute('ALTER TABLE factions ADD COLUMN member_count INTEGER NOT NULL DEFAULT 0')
+    c.execute('''UPDATE factions SET member_count =
+                     (SELECT COUNT(*) FROM faction_members fm WHERE fm.faction_id = factions.faction_id)''')
+    c.execute('''CREATE TRIGGER faction_members_count_insert AFTER INSERT ON faction_members BEGIN
+                     UPDATE factions SET member_count = member_count + 1 WHERE faction_id = new.faction_id;
+                 END''')
+    c.execute('''CREATE TRIGGER faction_members_count_delete AFTER DELETE ON faction_members BEGIN
+                     UPDATE factions SET member_count = member_count - 1 WHERE faction_id = old.faction_id;
+                 END''')
+    c.execute('''CREATE TRIGGER faction_members_count_update AFTER UPDATE OF faction_id ON faction_members
+                 WHEN new.faction_id IS NOT old.faction_id BEGIN
+                     UPDATE factions SET member_count = member_count - 1 WHERE faction_id = old.faction_id;
+                     UPDATE factions SET member_count = member_count + 1 WHERE faction_id = new.faction_id;
+                 END''')
+
+
+def _m009_meta(c):
+    """Служебные значения бота (например, хэш последней синхронизации команд)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS meta
+                 (key TEXT PRIMARY KEY, value TEXT, updated_at TEXT)''')
+
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "Начальная схема", _m001_initial_schema),
+    (2, "Вторичные индексы", _m002_secondary_indexes),
+    (3, "Поиск фракций по названию", _m003_faction_name_search),
+    (4, "Журнал операций", _m004_ledger),
+    (5, "Суммы в целых минимальных единицах", _m005_integer_money),
+    (6, "Счетчики сервера", _m006_guild_stats),
+    (7, "Фоновые задачи", _m007_jobs),
+    (8, "Количество участников фракции", _m008_faction_member_count),
+    (9, "Служебные значения", _m009_meta),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(c) -> int:
+    """Текущая версия схемы (0 для новой базы)"""
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+    if not c.fetchone():
+        return 0
+    c.execute('SELECT MAX(version) FROM schema_version')
+    result = c.fetchone()
+    return result[0] if result and result[0] is not None else 0
+
+
+def migrate(db) -> List[int]:
+    """Применить недостающие миграции. Возвращает номера примененных миграций"""
+    with db.cursor() as c:
+        if get_schema_version(c) >= LATEST_VERSION:
+            return []
+
+    applied = []
+    with db.transaction() as c:
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                     (version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)''')
+        current = get_schema_version(c)
+
+        for version, description, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            migration(c)
+            c.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                      (version, description, datetime.now().isoformat()))
+            applied.append(version)
+
+    for version in applied:
+        print(f"Применена миграция схемы {version}")
+    return applied
@@ -0,0 +1,119 @@
+import sqlite3
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Union
+
+# Денежные суммы хранятся в целых минимальных единицах (сотых долях валюты),
+# поэтому суммы и сравнения в SQL и Python точные, без накопления ошибки float.
+
+MINOR_UNITS = 100
+
+Number = Union[int, float, str, Decimal]
+
+
+class Money:
+    """Сумма в минимальных единицах валюты. Сравнивается и складывается с Money и с обычными числами"""
+
+    __slots__ = ('minor',)
+
+    def __init__(self, minor: int = 0):
+        self.minor = int(minor)
+
+    @classmethod
+    def from_major(cls, value: Union['Money', Number, None]) -> 'Money':
+        """Сумма из основных единиц (12.345 -> 12.35); Money возвращается как есть"""
+        if isinstance(value, Money):
+            return value
+        if value is None:
+            return cls(0)
+        if isinstance(value, float):
+            value = repr(value)
+        try:
+            amount = Decimal(value)
+        except InvalidOperation:
+            raise ValueError(f"Некорректная сумма: {value}")
+        if not amount.is_finite():
+            raise ValueError(f"Некорректная сумма: {value}")
+        return cls(int((amount * MINOR_UNITS).to_integral_value(rounding=ROUND_HALF_UP)))
+
+    @classmethod
+    def from_db(cls, value) -> 'Money':
+        """Значение столбца в минимальных единицах (NULL — ноль)"""
+        return cls(value or 0)
+
+    @property
+    def major(self) -> Decimal:
+        return Decimal(self.minor) / MINOR_UNITS
+
+    @staticmethod
+    def _minor(other) -> int:
+        if isinstance(other, Money):
+            return other.minor
+        if isinstance(other, (int, float, Decimal)) and not isinstance(other, bool):
+            return Money.from_major(other).minor
+        raise TypeError
+
+    def _binary(self, other, op):
+        try:
+            return op(self.minor, self._minor(other))
+        except TypeError:
+            return NotImplemented
+
+    def __add__(self, other):
+        result = self._binary(other, int.__add__)
+        return result if result is NotImplemented else Money(result)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        result = self._binary(other, int.__sub__)
+        return result if result is NotImplemented else Money(result)
+
+    def __rsub__(self, other):
+        result = self._binary(other, int.__sub__)
+        return result if result is NotImplemented else Money(-result)
+
+    def __neg__(self):
+        return Money(-self.minor)
+
+    def __abs__(self):
+        return Money(abs(self.minor))
+
+    def __eq__(self, other):
+        return self._binary(other, int.__eq__)
+
+    def __lt__(self, other):
+        return self._binary(other, int.__lt__)
+
+    def __le__(self, other):
+        return self._binary(other, int.__le__)
+
+    def __gt__(self, other):
+        return self._binary(other, int.__gt__)
+
+    def __ge__(self, other):
+        return self._binary(other, int.__ge__)
+
+    def __hash__(self):
+        return hash(self.major)
+
+    def __bool__(self):
+        return self.minor != 0
+
+    def __float__(self):
+        return self.minor / MINOR_UNITS
+
+    def __format__(self, spec: str) -> str:
+        return format(self.major, spec or '.2f')
+
+    def __str__(self):
+        return format(self, '.2f')
+
+    def __repr__(self):
+        return f"Money({self})"
+
+
+# Сумма на входе функций database.py: Money или число в основных единицах
+Amount = Union[Money, Number]
+
+# В запросах Money подставляется как целое число минимальных единиц
+sqlite3.register_adapter(Money, lambda money: money.minor)
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+import discord
+
+# Ленивый постраничный просмотр списков. Страница читается по ключу последней строки
+# предыдущей страницы (WHERE key > ? LIMIT n) и строится только когда ее открывают,
+# поэтому память и время первого ответа не зависят от длины списка.
+# Несколько недавно открытых страниц хранятся в небольшом LRU-кэше.
+
+# fetch(после_ключа, limit) -> строки страницы; после_ключа None — первая страница
+FetchPage = Callable[[Optional[Any], int], Awaitable[List[Any]]]
+# render(строки, номер страницы с 1) -> embed
+RenderPage = Callable[[List[Any], int], discord.Embed]
+
+
+class Paginator:
+    """Страницы списка, читаемые по ключу"""
+
+    def __init__(self, fetch: FetchPage, key: Callable[[Any], Any], render: RenderPage,
+                 per_page: int = 10, cache_size: int = 4):
+        self.fetch = fetch
+        self.key = key
+        self.render = render
+        self.per_page = per_page
+        self.cache_size = cache_size
+        self.page = 0
+        # Ключ, после которого начинается каждая из уже открытых страниц
+        self._cursors: List[Optional[Any]] = [None]
+        self._cache: 'OrderedDict[int, Tuple[discord.Embed, bool]]' = OrderedDict()
+
+    async def _load(self, page: int) -> Tuple[discord.Embed, bool]:
+        cached = self._cache.get(page)
+        if cached is not None:
+            self._cache.move_to_end(page)
+            return cached
+
+        rows = await self.fetch(self._cursors[page], self.per_page + 1)
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if has_more and len(self._cursors) == page + 1:
+            self._cursors.append(self.key(rows[-1]))
+
+        result = self.render(rows, page + 1), has_more
+        self._cache[page] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    async def current(self) -> Tuple[discord.Embed, bool]:
+        """Embed текущей страницы и есть ли следующая"""
+        return await self._load(self.page)
+
+    async def move(self, step: int) -> Tuple[discord.Embed, bool]:
+        self.page = max(0, min(self.page + step, len(self._cursors) - 1))
+        return await self.current()
+
+
+class PaginatorView(discord.ui.View):
+    """Кнопки «Назад» и «Вперед» для Paginator; листать может только автор команды"""
+
+    def __init__(self, paginator: Paginator, author: discord.abc.User, has_more: bool,
+                 prev_label: str = "⬅️ Назад", next_label: str = "Вперед ➡️", timeout: float = 120):
+        super().__init__(timeout=timeout)
+        self.paginator = paginator
+        self.author = author
+        self.prev_button.label = prev_label
+        self.next_button.label = next_label
+        self.update_buttons(has_more)
+
+    def update_buttons(self, has_more: bool):
+        self.prev_button.disabled = self.paginator.page == 0
+        self.next_button.disabled = not has_more
+
+    async def _turn(self, interaction: discord.Interaction, step: int):
+        if interaction.user != self.author:
+            await interaction.response.send_message("❌ Только автор команды может листать страницы!",
+                                                    ephemeral=True)
+            return
+
+        embed, has_more = await self.paginator.move(step)
+        self.update_buttons(has_more)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="⬅️ Назад", style=discord.ButtonStyle.secondary)
+    async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, -1)
+
+    @discord.ui.button(label="Вперед ➡️", style=discord.ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, 1)
+
+
+async def send_paginated(ctx, paginator: Paginator, **view_options):
+    """Отправить первую страницу; кнопки добавляются, только если страниц больше одной"""
+    embed, has_more = await paginator.current()
+    if has_more:
+        await ctx.send(embed=embed, view=PaginatorView(paginator, ctx.author, has_more, **view_options))
+    else:
+        await ctx.send(embed=embed)
@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from database import TransferNotFound
+from money import Money
+
+# Ожидающие подтверждения переводы хранятся в памяти. Истечение обслуживает один таймер:
+# куча (срок, transfer_id) и одна задача, которая спит до ближайшего срока. Подтвержденные
+# и отмененные переводы из кучи не удаляются — они пропускаются, когда подходит их срок.
+# Кнопки подтверждения не переживают перезапуск, поэтому переводы в базу не записываются.
+
+TRANSFER_TTL = 300  # секунд на подтверждение
+
+
+class PendingTransfer:
+    """Ожидающий перевод"""
+
+    __slots__ = ('transfer_id', 'guild_id', 'from_user_id', 'to_user_id', 'to_faction_id',
+                 'amount', 'transfer_type', 'created_at', 'expires_at', 'on_expire')
+
+    def __init__(self, transfer_id: int, guild_id: int, from_user_id: int, to_user_id: Optional[int],
+                 to_faction_id: Optional[int], amount: Money, transfer_type: str, expires_at: float):
+        self.transfer_id = transfer_id
+        self.guild_id = guild_id
+        self.from_user_id = from_user_id
+        self.to_user_id = to_user_id
+        self.to_faction_id = to_faction_id
+        self.amount = amount
+        self.transfer_type = transfer_type
+        self.created_at = time.time()
+        self.expires_at = expires_at
+        # Вызывается при истечении срока (например, чтобы погасить кнопки подтверждения)
+        self.on_expire: Optional[Callable[[], Awaitable]] = None
+
+
+class PendingTransferStore:
+    """Ожидающие переводы в памяти с одним таймером истечения"""
+
+    def __init__(self, ttl: float = TRANSFER_TTL):
+        self.ttl = ttl
+        self._transfers: Dict[int, PendingTransfer] = {}
+        self._deadlines: List[Tuple[float, int]] = []
+        self._ids = itertools.count(1)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._transfers)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _spawn(self, coro):
+        """Фоновая задача, ошибки которой только выводятся"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Ошибка ожидающего перевода: {task.exception()}")
+
+    def create(self, guild_id: int, from_user_id: int, to_user_id: Optional[int],
+               to_faction_id: Optional[int], amount: Money, transfer_type: str) -> PendingTransfer:
+        """Создать ожидающий перевод со сроком подтверждения ttl секунд"""
+        self._ensure_started()
+        pending = PendingTransfer(next(self._ids), guild_id, from_user_id, to_user_id, to_faction_id,
+                                  Money.from_major(amount), transfer_type, time.time() + self.ttl)
+        self._transfers[pending.transfer_id] = pending
+        earliest = self._deadlines[0][0] if self._deadlines else None
+        heapq.heappush(self._deadlines, (pending.expires_at, pending.transfer_id))
+        if earliest is None or pending.expires_at < earliest:
+            self._wakeup.set()
+
+        return pending
+
+    def get(self, transfer_id: int) -> Optional[PendingTransfer]:
+        return self._transfers.get(transfer_id)
+
+    def _forget(self, transfer_id: int) -> Optional[PendingTransfer]:
+        return self._transfers.pop(transfer_id, None)
+
+    def take(self, transfer_id: int) -> PendingTransfer:
+        """Забрать перевод для выполнения. Повторный вызов (двойное нажатие) — TransferNotFound"""
+        pending = self._forget(transfer_id)
+        if pending is None or pending.expires_at <= time.time():
+            raise TransferNotFound("Перевод не найден или истекло время подтверждения")
+        return pending
+
+    def cancel(self, transfer_id: int) -> bool:
+        """Отменить перевод. False, если его уже нет"""
+        return self._forget(transfer_id) is not None
+
+    def expire_due(self, now: Optional[float] = None) -> List[PendingTransfer]:
+        """Удалить переводы с истекшим сроком и вернуть их"""
+        now = time.time() if now is None else now
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, transfer_id = heapq.heappop(self._deadlines)
+            pending = self._forget(transfer_id)
+            if pending is not None:
+                expired.append(pending)
+        self.expired += len(expired)
+        return expired
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            for pending in self.expire_due():
+                if pending.on_expire is not None:
+                    self._spawn(pending.on_expire())
+
+            delay = self._deadlines[0][0] - time.time() if self._deadlines else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': len(self._transfers),
+            'timers': len(self._deadlines),
+            'expired': self.expired,
+        }
+
+
+pending_transfers = PendingTransferStore()
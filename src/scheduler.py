@@ -0,0 +1,121 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from async_db import register_job, record_job_run
+
+# Планировщик фоновых задач. Время следующего запуска и статистика хранятся в таблице
+# jobs, поэтому после перезапуска бота расписание продолжается, а не начинается заново.
+# Все задачи обслуживает один таймер на цикле событий бота; сами задачи — корутины,
+# работа с базой в них идет через пулы потоков async_db и не блокирует команды.
+
+
+class Job:
+    """Периодическая задача"""
+
+    __slots__ = ('name', 'func', 'interval', 'jitter', 'next_run_at', 'running')
+
+    def __init__(self, name: str, func: Callable[[], Awaitable], interval: float, jitter: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.next_run_at = 0.0
+        self.running = False
+
+    def schedule_after(self, now: float) -> float:
+        """Время следующего запуска: через интервал плюс случайный разброс"""
+        return now + self.interval + random.uniform(0, self.jitter)
+
+
+class Scheduler:
+    """Один таймер для всех фоновых задач"""
+
+    def __init__(self, idle_wait: float = 60.0):
+        self.idle_wait = idle_wait
+        self._jobs: Dict[str, Job] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+
+    async def add_job(self, name: str, func: Callable[[], Awaitable], interval: float,
+                      jitter: float = 0.0, run_on_start: bool = False):
+        """Зарегистрировать задачу (интервал и разброс в секундах).
+
+        Для новой задачи первый запуск — сразу (run_on_start) или через интервал.
+        Для уже известной берется сохраненное время: если оно прошло за время простоя,
+        задача выполняется один раз сразу, пропущенные запуски не повторяются.
+        """
+        if name in self._jobs:
+            return  # on_ready вызывается и при переподключении
+        job = Job(name, func, interval, jitter)
+        now = time.time()
+        first_run_at = now if run_on_start else job.schedule_after(now)
+        job.next_run_at = await register_job(name, interval, jitter, first_run_at)
+        self._jobs[name] = job
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        """Запустить таймер на текущем цикле событий (повторный вызов ничего не делает)"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановить таймер и дождаться выполняющихся задач"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._running:
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            for job in self._jobs.values():
+                if not job.running and job.next_run_at <= now:
+                    job.running = True
+                    self._running[job.name] = asyncio.create_task(self._execute(job))
+
+            waiting = [job.next_run_at for job in self._jobs.values() if not job.running]
+            delay = min(waiting) - time.time() if waiting else self.idle_wait
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, min(delay, self.idle_wait)))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job: Job):
+        started_at = time.time()
+        started = time.perf_counter()
+        error = None
+        try:
+            await job.func()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"Ошибка в фоновой задаче {job.name}: {e}")
+        duration = time.perf_counter() - started
+
+        # Следующий запуск считается от окончания: долгая задача не запускается внахлест
+        job.next_run_at = job.schedule_after(time.time())
+        try:
+            await record_job_run(job.name, started_at, duration, job.next_run_at, error)
+        except Exception as e:
+            print(f"Ошибка при сохранении задачи {job.name}: {e}")
+        finally:
+            job.running = False
+            self._running.pop(job.name, None)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def jobs(self) -> List[Job]:
+        return list(self._jobs.values())
+
+
+scheduler = Scheduler()
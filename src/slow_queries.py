@@ -0,0 +1,244 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+
+# Журнал медленных запросов. Все соединения ConnectionManager создают TimedCursor,
+# который замеряет execute/executemany и последующие fetch* одного запроса.
+# Запрос дольше порога попадает в кольцевой буфер последних записей, в сводку по нормализованному SQL
+# и в файл с ротацией; план (EXPLAIN QUERY PLAN) снимается один раз на каждый нормализованный запрос.
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+_SPACE_RE = re.compile(r'\s+')
+# План имеет смысл только для запросов к данным
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def normalize_sql(sql: str) -> str:
+    """SQL без литералов и лишних пробелов: запросы, отличающиеся только значениями, совпадают"""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('IN (...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+def params_shape(params) -> str:
+    """Типы параметров без значений: (int, int, float) или {name: str}"""
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in params.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+
+
+class SlowQuery:
+    """Одна запись журнала"""
+
+    __slots__ = ('at', 'sql', 'params', 'duration', 'rows', 'plan')
+
+    def __init__(self, at: float, sql: str, params: str, duration: float, rows: int, plan: Optional[List[str]]):
+        self.at = at
+        self.sql = sql
+        self.params = params
+        self.duration = duration
+        self.rows = rows
+        self.plan = plan
+
+    def to_dict(self) -> dict:
+        return {'at': self.at, 'sql': self.sql, 'params': self.params, 'duration_ms': round(self.duration * 1000, 2),
+                'rows': self.rows, 'plan': self.plan}
+
+
+class SlowQueryStats:
+    """Сводка медленных выполнений одного нормализованного запроса"""
+
+    __slots__ = ('sql', 'count', 'total', 'max', 'params', 'plan', 'last_at')
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.params = ''
+        self.plan: Optional[List[str]] = None
+        self.last_at = 0.0
+
+
+class SlowQueryLog:
+    """Порог, кольцевой буфер, сводка и файл медленных запросов"""
+
+    def __init__(self, threshold_ms: Optional[float] = 100, capacity: int = 200):
+        self.threshold = threshold_ms / 1000 if threshold_ms is not None else None
+        self.recent: deque = deque(maxlen=capacity)
+        self._stats: Dict[str, SlowQueryStats] = {}
+        self._plans: Dict[str, Optional[List[str]]] = {}
+        self._lock = threading.Lock()
+        self._logger: Optional[logging.Logger] = None
+
+    def configure(self, threshold_ms: Optional[float] = 100, path: Optional[str] = None,
+                  max_bytes: int = 1024 * 1024, backup_count: int = 3):
+        """Порог в миллисекундах (None — журнал выключен) и файл с ротацией (None — только в памяти)"""
+        self.threshold = threshold_ms / 1000 if threshold_ms is not None else None
+        logger = None
+        if path:
+            logger = logging.getLogger('economy.slow_queries')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logger.addHandler(handler)
+        self._logger = logger
+
+    def _explain(self, conn: sqlite3.Connection, sql: str, params) -> Optional[List[str]]:
+        if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        # Обычный курсор, чтобы снятие плана само не замерялось
+        c = sqlite3.Cursor(conn)
+        try:
+            c.execute('EXPLAIN QUERY PLAN ' + sql, params if params is not None else ())
+            return [row[3] for row in c.fetchall()]
+        except sqlite3.Error as e:
+            return [f'план недоступен: {e}']
+        finally:
+            c.close()
+
+    def record(self, conn: sqlite3.Connection, sql: str, params, duration: float, rows: int):
+        normalized = normalize_sql(sql)
+        with self._lock:
+            known = normalized in self._plans
+            plan = self._plans.get(normalized)
+        if not known:
+            plan = self._explain(conn, sql, params)
+
+        entry = SlowQuery(time.time(), normalized, params_shape(params), duration, rows, plan)
+        with self._lock:
+            self._plans.setdefault(normalized, plan)
+            self.recent.append(entry)
+            stats = self._stats.get(normalized)
+            if stats is None:
+                stats = self._stats[normalized] = SlowQueryStats(normalized)
+            stats.count += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+            stats.params = entry.params
+            stats.plan = plan
+            stats.last_at = entry.at
+
+        if self._logger is not None:
+            try:
+                self._logger.info(json.dumps(entry.to_dict(), ensure_ascii=False))
+            except Exception as e:
+                print(f"Ошибка записи журнала медленных запросов: {e}")
+
+    def worst(self, limit: int = 10) -> List[SlowQueryStats]:
+        """Запросы с наибольшим суммарным временем медленных выполнений"""
+        with self._lock:
+            result = sorted(self._stats.values(), key=lambda item: item.total, reverse=True)
+        return result[:limit]
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self._stats.clear()
+            self._plans.clear()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий запрос от execute до последнего fetch (или следующего execute/close)"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        super().__init__(conn)
+        self._sql: Optional[str] = None
+        self._params = None
+        self._elapsed = 0.0
+        self._rows = 0
+
+    def _finish(self):
+        sql, self._sql = self._sql, None
+        if sql is None:
+            return
+        log = self.connection.slow_log
+        if log.threshold is not None and self._elapsed >= log.threshold:
+            log.record(self.connection, sql, self._params, self._elapsed, self._rows)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql, self._params, self._rows = sql, parameters, 0
+            self._elapsed = time.perf_counter() - started
+            # Запрос без результата (запись, BEGIN, PRAGMA) завершен уже в execute
+            if self.description is None:
+                self._finish()
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # Для плана берем первый набор параметров, если последовательность это позволяет
+            first = seq_of_parameters[0] if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters else None
+            self._sql, self._params, self._rows = sql, first, 0
+            self._elapsed = time.perf_counter() - started
+            self._finish()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - started
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого — TimedCursor (передается в sqlite3.connect как factory)"""
+
+    slow_log: SlowQueryLog
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# Общий журнал; порог и файл задаются в main.py из config.json
+slow_query_log = SlowQueryLog()